@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+CACHE_FOLDER = 'cache'
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+def content_hash(content):
+    """
+    Returns the SHA-256 hex digest of the given text or bytes.
+    """
+
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+class AnalysisCache:
+    """
+    Persistent cache of analysis results keyed by content hash and prompt/schema version.
+
+    Each entry is stored as a small JSON file under `cache_dir`, sharded by the first
+    two characters of its key. Because keys depend only on the file content and the
+    version, the same cache directory can be shared by several branches or checkouts
+    of a repository. When the total size exceeds `max_bytes`, the least recently used
+    entries (by file modification time, refreshed on every hit) are evicted.
+    """
+
+    def __init__(self, cache_dir, version, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    def key(self, content, namespace=''):
+        """
+        Returns the cache key of the given content.
+        """
+
+        return content_hash(f"{self.version}\0{namespace}\0{content_hash(content)}")
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        Returns the cached value for the key, or None if it is not cached.
+        Safe to call from several threads.
+        """
+
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                value = json.load(file)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Stores the value for the key, evicting old entries if the cache is too large.
+        Safe to call from several threads.
+        """
+
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, _, size in self._scan())
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self.evict()
+
+    def _scan(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is below 90% of its limit.
+        """
+
+        entries = sorted(self._scan(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import time
+
+JOURNAL_FILENAME = 'analysis_journal.jsonl'
+
+class AnalysisJournal:
+    """
+    Append-only JSONL journal of per-file analysis results.
+
+    Every record is written and flushed as soon as it is appended, so it survives a
+    crash of the process. fsync is batched: it runs every `fsync_every` records or
+    `fsync_interval` seconds, whichever comes first, and on close.
+    With a `store` (repo_store.RepositoryStore), each result is also committed to the
+    row of its file (see RepositoryStore.add_files).
+    """
+
+    def __init__(self, path, reset=False, fsync_every=16, fsync_interval=1.0, store=None):
+        self.path = path
+        self.store = store
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'w' if reset else 'a', encoding='utf-8')
+        if not reset and self._file.tell() > 0:
+            # Terminate a line cut off by a crash so that it does not swallow the next record
+            with open(path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def append(self, record):
+        """
+        Appends a record to the journal.
+        """
+
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+        if self.store:
+            self.store.update_file(record['path'], record['analysis'], record['modified_time'])
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """
+        Syncs and closes the journal.
+        """
+
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_journal(path):
+    """
+    Replays the journal and returns the latest record for each file path.
+
+    A line cut off by a crash (or otherwise unreadable) is skipped.
+    """
+
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and 'path' in record:
+                records[record['path']] = record
+    return records
@@ -1,16 +1,51 @@
 import os
-import fnmatch
 import json
 import time
 import sys
+import functools
+import contextlib
+import threading
+from dataclasses import dataclass, field
 from pydantic import BaseModel
-from openai_utils import get_parsed_completion, get_token_count, estimate_cost_for_gpt4o_0806
+import openai_utils
+from openai_utils import get_parsed_completion, get_token_count, estimate_cost_for_gpt4o_0806, get_response_format_param, configure_endpoint
+from scheduler import RateLimiter, ScheduledTask, run_tasks
+from analysis_cache import AnalysisCache, CACHE_FOLDER, DEFAULT_MAX_CACHE_BYTES, content_hash
+from analysis_journal import AnalysisJournal, JOURNAL_FILENAME, read_journal
+from repo_model import RepositoryModel, FileRecord, NOT_ANALYZED, FILE_READ_ERROR, STATUS_LABELS
+from repo_store import STATS_STORE_FILENAME, RepositoryStore, is_store_file, load_stats, save_stats, latest_stats_filename
+from ignore_rules import IgnoreEngine
+from chunking import chunk_content, merge_unique
+from context_scope import StructureContext, CONTEXT_STRATEGIES, DEFAULT_CONTEXT_TOKENS, extract_import_hints
+from file_classifier import DEFAULT_MAX_FILE_BYTES, classify_file
+from git_changes import GIT_STATE_FILENAME, head_commit, read_git_state, write_git_state, changed_files, worktree_sizes
+from local_extractors import extract_files, is_complete
+from dedup import DEFAULT_NEAR_DUPLICATE_THRESHOLD, find_duplicate_groups
+from dependency_graph import DependencyGraph, ReferenceResolver, DEPENDENCY_GRAPH_FILENAME, load_or_build_graph
+from batch_api import (AzureBatchClient, LocalBatchClient, BATCH_REQUESTS_FILENAME, BATCH_STATE_FILENAME,
+                       build_batch_request, write_batch_file, parse_batch_output, wait_for_batch, read_batch_state, write_batch_state)
+from repo_walker import walk_repository
+from sharding import SHARDS_FOLDER, parse_shard, shard_paths, shard_filename, write_partial, find_partials, merge_partials
+from repo_watcher import WATCH_BACKENDS, DEFAULT_WATCH_DEBOUNCE, DEFAULT_POLL_INTERVAL, open_watcher, wait_for_changes, changes_from_paths
+from metrics import (METRICS_FOLDER, NORMAL, VERBOSE, VERBOSITY_LEVELS, echo, set_verbosity, start_run, current_run,
+                     phase, count, record_file, take_api_usage)
 
 STATS_FINAL_FILENAME = 'stats_final.json'
 STATS_INTERMEDIATE_FILENAME = 'stats_intermediate.json'
 IGNORE_FILENAME = '.repodocignore'
 REPODOC_FOLDER = '.repodoc'
 
+# Bump when the analysis prompt changes so that cached analyses are not reused
+ANALYSIS_PROMPT_VERSION = 1
+
+DEFAULT_MAX_FILE_TOKENS = 30000
+DEFAULT_CHUNK_TOKENS = 8000
+DEFAULT_PACK_TOKENS = 0
+DEFAULT_PACK_FILES = 16
+ANALYSIS_ORDERS = ['structure', 'dependency']
+# Tokens of the dependency summaries added to the prompt of a file with order 'dependency'
+DEPENDENCY_SUMMARY_TOKENS = 2000
+
 class FileContent(BaseModel):
     type: str
     file_type: str
@@ -18,6 +53,35 @@ class FileContent(BaseModel):
     references: list[str]
     entry_points: list[str]
 
+class FileSummary(BaseModel):
+    type: str
+    file_type: str
+    description: str
+
+class PackedFileContent(BaseModel):
+    path: str
+    type: str
+    file_type: str
+    description: str
+    references: list[str]
+    entry_points: list[str]
+
+class PackedFileContents(BaseModel):
+    files: list[PackedFileContent]
+
+class FileDescription(BaseModel):
+    description: str
+
+class PackedFileDescription(BaseModel):
+    path: str
+    description: str
+
+class PackedFileDescriptions(BaseModel):
+    files: list[PackedFileDescription]
+
+# Response format of a packed request, by the response format of its files
+PACKED_RESPONSE_FORMATS = {FileContent: PackedFileContents, FileDescription: PackedFileDescriptions}
+
 def read_repodocignore_setting(folder_path):
     """
     Reads the .repodocignore file in the specified folder and returns a list of patterns to ignore.
@@ -31,184 +95,170 @@ def read_repodocignore_setting(folder_path):
 
     return patterns
 
-def read_gitignore_setting(folder_path):
+def build_ignore_engine(folder_path):
     """
-    Reads the .gitignore file in the specified folder and returns a list of patterns to ignore.
+    Builds the ignore rules of the folder: .gitignore files and the global .repodocignore patterns.
     """
 
-    gitignore_path = os.path.join(folder_path, '.gitignore')
-    patterns = []
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r') as file:
-            patterns = [line.strip() for line in file if line.strip() and not line.startswith('#')]
-
-    # Add patterns for files starting with a dot and containing "ignore"
-    patterns.append('.*ignore*')
-    return patterns
-
-def should_ignore(path, patterns):
-    """
-    Checks if the given path matches any of the ignore patterns.
-    """
-
-    for pattern in patterns:
-        if fnmatch.fnmatch(path, pattern):
-            return True
-    return False
+    global_ignore_patterns = read_repodocignore_setting(folder_path)
+    # The .repodoc folder holds repodoc's own outputs (stats, cache)
+    global_ignore_patterns.append(f"/{REPODOC_FOLDER}/")
+    return IgnoreEngine(folder_path, global_ignore_patterns)
 
-def analyze_folder(folder_path):
+def analyze_folder(folder_path, walk_workers=1):
     """
     Analyzes the folder structure, counting the number of files and directories,
     and calculating the total size of files.
+
+    Entries are filtered with the .gitignore files of every level and the global
+    .repodocignore patterns, following gitignore semantics.
     """
 
     # Initialize counters, total size, and structure
     num_files = 0
     num_dirs = 0
     total_size = 0
-    structure = []
-
-    global_ignore_patterns = read_repodocignore_setting(folder_path)
+    repo = RepositoryModel(os.path.basename(folder_path))
+    engine = build_ignore_engine(folder_path)
 
     # Walk through the directory
-    for root, dirs, files in os.walk(folder_path):
-        # Read .gitignore patterns for the current directory
-        ignore_patterns = read_gitignore_setting(root)
+    with phase('analyze_folder'):
+        for root, dirs, files in walk_repository(folder_path, engine, workers=walk_workers):
+            # Only store the structure if there are files or directories
+            if dirs or files:
+                repo.add_directory(root, dirs, [name for name, _ in files])
 
-        # Combine global and local ignore patterns
-        ignore_patterns += global_ignore_patterns
+            num_dirs += len(dirs)
+            num_files += len(files)
+            total_size += sum(size for _, size in files)
 
-        # Filter out directories and files based on .gitignore patterns
-        filtered_dirs = [d for d in dirs if not should_ignore(os.path.relpath(os.path.join(root, d), root), ignore_patterns)]
-        filtered_files = [f for f in files if not should_ignore(os.path.relpath(os.path.join(root, f), root), ignore_patterns)]
+    # Return the statistics and structure
+    repo.num_files = num_files
+    repo.num_dirs = num_dirs
+    repo.total_size = total_size
+    return repo
 
-        # Only store the structure if there are files or directories
-        if filtered_dirs or filtered_files:
-            structure.append((root, filtered_dirs, filtered_files, [], []))
+def apply_file_changes(repo, folder_path, changes, engine):
+    """
+    Applies the changes since the analyzed commit (see git_changes.changed_files) to the model,
+    without walking the folder.
 
-        num_dirs += len(filtered_dirs)
-        num_files += len(filtered_files)
-        for file in filtered_files:
-            file_path = os.path.join(root, file)
-            total_size += os.path.getsize(file_path)
+    Deleted files are removed, added files inserted and renamed files moved with their
+    analysis; files ignored by `engine` are left out. The totals are updated with the
+    sizes at the commit and in the working tree of the changed files only.
 
-        # Update dirs in-place to continue walking
-        dirs[:] = filtered_dirs
+    Returns:
+        list[str]: Paths of the added, modified and renamed files, to analyze again.
+    """
 
-    # Return the statistics and structure
-    return {
-        'folder_name': os.path.basename(folder_path),
-        'num_files': num_files,
-        'num_dirs': num_dirs,
-        'total_size': total_size,
-        'structure': structure
-    }
+    def absolute(rel_path):
+        return os.path.join(folder_path, *rel_path.split('/'))
+
+    def current_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    for rel_path in changes.deleted:
+        if repo.remove_file(absolute(rel_path)) is not None:
+            repo.total_size -= changes.old_sizes.get(rel_path, 0)
+
+    paths = []
+    for old_rel_path, rel_path in changes.renamed:
+        old_record = repo.remove_file(absolute(old_rel_path))
+        if old_record is not None:
+            repo.total_size -= changes.old_sizes.get(old_rel_path, 0)
+        path = absolute(rel_path)
+        if engine.is_ignored(rel_path) or not os.path.isfile(path):
+            continue
+        record = repo.add_file(path)
+        if old_record is not None:
+            # Unchanged content keeps its analysis (same modified time, or found in the cache)
+            record.analysis, record.modified_time = old_record.analysis, old_record.modified_time
+        repo.total_size += current_size(path)
+        paths.append(path)
+
+    for rel_path in changes.added + changes.modified:
+        path = absolute(rel_path)
+        if engine.is_ignored(rel_path) or not os.path.isfile(path):
+            continue
+        if repo.get_file(path) is None:
+            repo.add_file(path)
+            repo.total_size += current_size(path)
+        elif rel_path in changes.old_sizes:
+            repo.total_size += current_size(path) - changes.old_sizes[rel_path]
+        paths.append(path)
+    return list(dict.fromkeys(paths))
+
+def record_analyzed_commit(folder_path, filename, commit):
+    """
+    Records the commit the analysis corresponds to (None outside of a git repository),
+    with the sizes of the files of the working tree differing from it.
+    """
 
-def format_structure(structure):
+    if commit:
+        write_git_state(filename, commit, worktree_sizes(folder_path, commit, build_ignore_engine(folder_path)))
+        print(f"Analyzed commit {commit} has been recorded to {filename}")
+
+def format_structure(repo):
     """
     Formats the folder structure into a readable string format.
     """
 
     lines = []
-    for root, dirs, files, analyses, modified_time in structure:
-        indent_level = root.count(os.sep)
+    for directory in repo.directories:
+        indent_level = directory.root.count(os.sep)
         indent = ' ' * 4 * indent_level
-        lines.append(f"{indent}{os.path.basename(root)}/")
-        #for d in dirs:
+        lines.append(f"{indent}{os.path.basename(directory.root)}/")
+        #for d in directory.dirs:
         #    lines.append(f"{indent}    {d}/")
-        for index, f in enumerate(files):
-            lines.append(f"{indent}    {f}")
-            if index < len(analyses) and analyses[index]:
-                analysis = analyses[index]
+        for record in directory.files:
+            lines.append(f"{indent}    {record.name}")
+            if record.analysis:
+                analysis = record.analysis
                 if isinstance(analysis, dict):
                     file_type = analysis.get('file_type', '---')
                     description = analysis.get('description', '---')
                     lines.append(f"{indent}    {file_type}")
                     lines.append(f"{indent}    {description}\n")
-                elif analysis == "NOT_ANALYZED":
-                    lines.append(f"{indent}    ※解析対象外\n")
-                elif analysis == "FILE_READ_ERROR":
-                    lines.append(f"{indent}    ※ファイル読み取りエラー\n")
+                elif analysis in STATUS_LABELS:
+                    lines.append(f"{indent}    ※{STATUS_LABELS[analysis]}\n")
                 else:
                     raise ValueError(f"Unexpected analysis result: {analysis}")
 
     return '\n'.join(lines)
 
-def write_stats_to_file(stats, filename):
+def write_stats_to_file(repo, filename):
     """
-    Writes the statistics to a JSON file.
+    Writes the statistics to a JSON file, or to a SQLite store (.sqlite).
     """
 
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, 'w', encoding='utf-8') as file:
-        json.dump(stats, file, indent=4, ensure_ascii=False)
+    with phase('write_stats'):
+        save_stats(repo, filename)
 
-def read_stats_from_file(filename):
+def open_result_store(repo, filename):
     """
-    Reads the statistics from a JSON file.
+    Opens the final file for committing each analysis result as it arrives (pass it to
+    AnalysisJournal) when it is a SQLite store, with rows for the files of `repo` that
+    are not stored yet. Returns an empty context (None) for a JSON file, which is only
+    written at the end.
     """
 
-    with open(filename, 'r', encoding='utf-8') as file:
-        return json.load(file)
-    
-def gpt_analyze(structure, structure_text, interactive=True):
+    if not is_store_file(filename):
+        return contextlib.nullcontext()
+    store = RepositoryStore(filename)
+    store.add_files(repo)
+    return store
+
+def read_stats_from_file(filename):
     """
-    Analyzes the folder structure using GPT and updates the structure with the analysis results.
+    Reads the statistics from a JSON file, or from a SQLite store (.sqlite).
     """
 
-    print("Analyzing structure...")
-    print(structure_text)
-    print("====")
-
-    total_input_tokens = 0
-    total_output_tokens = 0
-
-    flag_yesall = False
-
-    for root, dirs, files, analyses, modified_time in structure:
-        for index, file in enumerate(files):
-            file_path = os.path.join(root, file)
-            print("************************************")
-            print("Analyzing file:", file_path)
-            print("************************************")
-            try:
-                # Get the last modified time
-                last_modified_time = time.ctime(os.path.getmtime(file_path))
-
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    print("-----------------")
-                    print(f"Content of {file_path}:")
-                    print(content)
-
-                    user_prompt = f"""\
-# Content of {file_path}:
-{content}
-"""
-
-                    token_num = get_token_count(content)
-                    token_numk = token_num / 1000                    
-
-                    print("====>> TOKEN SIZE(k): ", token_numk)
-                    print("====>> FILE_NAME: ", file_path)
-
-                    if index < len(modified_time) and last_modified_time == modified_time[index]:
-                        print("Skip because this file has not been modified since the last analysis.")
-                        choice = 'no'
-                    elif flag_yesall:
-                        choice = 'yes'
-                    elif not interactive:
-                        choice = 'yes'
-                    else:
-                        choice = input("Do you want to start a new GPT analysis or skip this file? (yes/no or yesall)(y/n/a): ").strip().lower()
-                        if choice == 'yesall' or choice == 'a':
-                            flag_yesall = True
-                            choice = 'yes'
-
-                    if choice == 'yes' or choice == 'y':
-                        print("Starting GPT analysis...")
-
-                        code_description_short_sample = """\
+    return load_stats(filename)
+    
+CODE_DESCRIPTION_SHORT_SAMPLE = """\
 # ClassName
 The overview of the class including its responsibilities and main functionalities.
 
@@ -219,7 +269,7 @@ Overview of the processing of Method1, its inputs and outputs, and the flow
 Overview of the processing of Method2, its inputs and outputs, and the flow
 """
 
-                        code_description_long_sample = """\
+CODE_DESCRIPTION_LONG_SAMPLE = """\
 # Class: ClassName
 
 ## Overview
@@ -244,9 +294,22 @@ This class is responsible for [brief description of the class's purpose]. It pro
 - (ReturnType): Description of the return value
 """
 
-                        code_description_sample = code_description_short_sample
-                        # Add GPT analysis code here
-                        system_prompt = f"""\
+def build_system_prompt(structure_text, scoped=False, description_only=False):
+    """
+    Builds the system prompt for analyzing a single file.
+    `scoped` tells that the structure text only covers the surroundings of the file.
+    `description_only` asks for the description alone, the other fields being extracted locally.
+    """
+
+    code_description_sample = CODE_DESCRIPTION_SHORT_SAMPLE
+    structure_heading = "The file structure around this file is as follows." if scoped else "The overall file structure is as follows."
+    if description_only:
+        fields = """\
+Analyze the given file name and file content, and write the following information
+(the type, references and entry points of the file are extracted separately):
+"""
+    else:
+        fields = """\
 Analyze the given file name and file content, and extract the following information:
 
 - type
@@ -254,7 +317,16 @@ Classification of the file as either code, config, or document
 
 - file_type
 Analysis result of the file content, such as whether the file is Java code, GitHub Actions YAML, etc.
+"""
+    references_fields = "" if description_only else """
+- references
+The destination files called from this file
 
+- entry_points
+The entry points when this file is called (such as public methods in the case of a program)
+"""
+    return f"""\
+{fields}
 - description
 Write a brief summary of the file contents in Japanese.
 For program code, describe the processing content and each function. (Refer to the sample description below)
@@ -262,56 +334,979 @@ For documents or configuration files, please explain the purpose of the file and
 Regardless of the type of text, please keep the content as concise as possible.
 And please add appropriate bullet points and line breaks to make it easier to read.
 **The descrption should be Japanese.**
-
-- references
-The destination files called from this file
-
-- entry_points
-The entry points when this file is called (such as public methods in the case of a program)
-
+{references_fields}
 ===== Sample description for program code
 {code_description_sample}
 
-===== The overall file structure is as follows.
+===== {structure_heading}
 {structure_text}
 """
-                        messages = [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt},
-                        ]
-
-                        result, input_tokens, output_tokens = get_parsed_completion(messages, FileContent)
-                        print(result)
-                        total_input_tokens += input_tokens
-                        total_output_tokens += output_tokens
-
-                        # Add GPT analysis result to the corresponding file in stats['structure']
-                        for item in stats['structure']:
-                            if item[0] == root:
-                                item[3].append(result.dict())
-                                item[4].append(last_modified_time)
-
-                    else:
-                        print(f"Skipping {file_path}")
-                        for item in stats['structure']:
-                            if item[0] == root:
-                                item[3].append("NOT_ANALYZED")
-                                item[4].append(last_modified_time)
 
-            except Exception as e:
-                print(f"Could not read {file_path}: {e}")
-                for item in stats['structure']:
-                    if item[0] == root:
-                        item[3].append("FILE_READ_ERROR")
+def build_user_prompt(file_path, content):
+    """
+    Builds the user prompt carrying the file content.
+    """
+
+    return f"""\
+# Content of {file_path}:
+{content}
+"""
+
+def build_dependency_user_prompt(item, summaries):
+    """
+    Builds the user prompt of a pending file preceded by the descriptions of the files
+    it depends on (see order_by_dependencies), within DEPENDENCY_SUMMARY_TOKENS.
+    `summaries` holds the descriptions written in this run, by path (None while a file
+    is pending or if its analysis failed); the other files use their stored analysis.
+    """
+
+    blocks = []
+    used = 0
+    for record in item.dependencies:
+        if record.path in summaries:
+            description = summaries[record.path]
+        else:
+            description = record.analysis.get('description') if isinstance(record.analysis, dict) else None
+        if not description:
+            continue
+        block = f"## {record.path}\n{description}\n"
+        tokens = get_token_count(block)
+        if used + tokens > DEPENDENCY_SUMMARY_TOKENS:
+            break
+        blocks.append(block)
+        used += tokens
+    if not blocks:
+        return item.user_prompt
+    count('files_dependency_summaries')
+    return "# Descriptions of the files this file depends on (already analyzed):\n" + '\n'.join(blocks) + '\n' + item.user_prompt
+
+def analyze_file_with_dependencies(item, summaries, estimated_tokens=0, limiter=None):
+    """
+    Analyzes a pending file with the descriptions of its dependencies, read when the request starts.
+    """
+
+    return analyze_file(item.system_prompt, build_dependency_user_prompt(item, summaries), estimated_tokens, limiter, item.response_format)
+
+def analyze_file(system_prompt, user_prompt, estimated_tokens=0, limiter=None, response_format=FileContent):
+    """
+    Analyzes a single file with GPT.
+
+    Returns:
+        tuple: FileContent (or `response_format`), input token count, output token count.
+    """
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    result, input_tokens, output_tokens = get_parsed_completion(messages, response_format)
+    if limiter:
+        limiter.adjust(input_tokens + output_tokens - estimated_tokens)
+    return result, input_tokens, output_tokens
+
+def build_packed_user_prompt(file_contents):
+    """
+    Builds the user prompt carrying several small files analyzed in one request.
+
+    Args:
+        file_contents (list[tuple]): (file path, content) pairs.
+    """
+
+    header = f"""\
+The following {len(file_contents)} files are analyzed together.
+Analyze each file separately and return one entry per file, with `path` set to the path in its "Content of" heading.
+
+"""
+    return header + '\n'.join(build_user_prompt(file_path, content) for file_path, content in file_contents)
+
+def analyze_packed_files(file_contents, system_prompt, estimated_tokens=0, limiter=None, response_format=FileContent):
+    """
+    Analyzes several small files in one GPT request and splits the result by path.
+
+    Files missing from the response are analyzed one by one. The token counts of the
+    packed request are shared among the files in proportion to their content size.
+
+    Args:
+        file_contents (list[tuple]): (file path, content) pairs.
+        response_format: Response format of each file, FileContent or FileDescription.
+
+    Returns:
+        list[tuple]: FileContent (or `response_format`), input token count, output token count of each file, in order.
+    """
+
+    packed, input_tokens, output_tokens = analyze_file(system_prompt, build_packed_user_prompt(file_contents),
+                                                       estimated_tokens, limiter, PACKED_RESPONSE_FORMATS[response_format])
+    by_path = {}
+    for entry in packed.files:
+        by_path.setdefault(entry.path, response_format(**entry.model_dump(exclude={'path'})))
+
+    sizes = [len(content) + 1 for _, content in file_contents]
+    total_size = sum(sizes)
+    outcomes = []
+    for (file_path, content), size in zip(file_contents, sizes):
+        result = by_path.get(file_path)
+        if result is None:
+            # Retrying alone is charged to the rate limiter outside of the scheduled estimate
+            print(f"{file_path} was missing from the packed response, analyzing it alone.")
+            user_prompt = build_user_prompt(file_path, content)
+            if limiter:
+                limiter.acquire(get_token_count(system_prompt) + get_token_count(user_prompt))
+            outcomes.append(analyze_file(system_prompt, user_prompt, response_format=response_format))
+            continue
+        outcomes.append((result, input_tokens * size // total_size, output_tokens * size // total_size))
+    return outcomes
+
+def build_chunk_user_prompt(file_path, first_line, last_line, index, num_chunks, text):
+    """
+    Builds the user prompt carrying one chunk of a large file.
+    """
+
+    return f"""\
+# Content of {file_path} (part {index + 1}/{num_chunks}, lines {first_line}-{last_line}):
+This is only a part of the file. Describe this part; the parts are merged afterwards.
+{text}
+"""
+
+def build_reduce_user_prompt(file_path, chunk_results):
+    """
+    Builds the user prompt merging the analyses of the chunks of a large file.
+    """
+
+    parts = []
+    for index, (first_line, last_line, result) in enumerate(chunk_results):
+        parts.append(f"""\
+## Part {index + 1} (lines {first_line}-{last_line}): {result.file_type}
+{result.description}
+""")
+    return f"""\
+# Analyses of the consecutive parts of {file_path}:
+The file was too large to analyze at once. Merge the analyses of its parts below into
+the type, file_type and description of the whole file.
+
+{''.join(parts)}"""
+
+def analyze_large_file(file_path, content, system_prompt, cache=None, limiter=None, concurrency=1, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                       slots=None):
+    """
+    Analyzes a file larger than the context budget with map-reduce.
+
+    The content is split along syntax-aware boundaries into chunks of at most
+    `chunk_tokens` tokens, the chunks are analyzed in parallel (each cached by its
+    own content), and the results are reduced into a single FileContent: GPT merges
+    the descriptions, and the references and entry points are merged locally.
+    Each request holds one of `slots` (see scheduler.run_tasks), shared with the
+    other files being analyzed, so that large files in flight together do not
+    exceed the overall concurrency.
+
+    Returns:
+        tuple: FileContent, input token count, output token count.
+    """
+
+    chunks = chunk_content(content, os.path.basename(file_path), chunk_tokens, get_token_count)
+    system_prompt_tokens = get_token_count(system_prompt)
+    print(f"Large file: {file_path} is analyzed in {len(chunks)} chunks.")
+
+    chunk_results = [None] * len(chunks)
+    chunk_keys = [None] * len(chunks)
+    tasks = []
+    task_indexes = []
+    for index, (first_line, last_line, text) in enumerate(chunks):
+        if cache:
+            chunk_keys[index] = cache.key(text, namespace='chunk')
+            cached = cache.get(chunk_keys[index])
+            if cached is not None:
+                chunk_results[index] = FileContent(**cached)
+                continue
+        user_prompt = build_chunk_user_prompt(file_path, first_line, last_line, index, len(chunks), text)
+        estimated_tokens = system_prompt_tokens + get_token_count(user_prompt)
+        tasks.append(ScheduledTask(
+            functools.partial(analyze_file, system_prompt, user_prompt, estimated_tokens, limiter),
+            estimated_tokens,
+            f"{file_path}:{first_line}-{last_line}",
+        ))
+        task_indexes.append(index)
+
+    total_input_tokens = 0
+    total_output_tokens = 0
+    outcomes, _ = run_tasks(tasks, concurrency=concurrency, limiter=limiter, slots=slots)
+    for index, outcome in zip(task_indexes, outcomes):
+        if isinstance(outcome, Exception):
+            raise outcome
+        result, input_tokens, output_tokens = outcome
+        total_input_tokens += input_tokens
+        total_output_tokens += output_tokens
+        chunk_results[index] = result
+        if cache:
+            cache.put(chunk_keys[index], result.model_dump())
+
+    merged_results = [(first_line, last_line, result) for (first_line, last_line, _), result in zip(chunks, chunk_results)]
+    user_prompt = build_reduce_user_prompt(file_path, merged_results)
+    reduce_key = cache.key(user_prompt, namespace='reduce') if cache else None
+    cached = cache.get(reduce_key) if cache else None
+    if cached is not None:
+        summary = FileSummary(**cached)
+    else:
+        estimated_tokens = system_prompt_tokens + get_token_count(user_prompt)
+        with slots or contextlib.nullcontext():
+            if limiter:
+                limiter.acquire(estimated_tokens)
+            summary, input_tokens, output_tokens = analyze_file(system_prompt, user_prompt, estimated_tokens, limiter, FileSummary)
+        total_input_tokens += input_tokens
+        total_output_tokens += output_tokens
+        if cache:
+            cache.put(reduce_key, summary.model_dump())
+
+    result = FileContent(
+        type=summary.type,
+        file_type=summary.file_type,
+        description=summary.description,
+        references=merge_unique(result.references for result in chunk_results),
+        entry_points=merge_unique(result.entry_points for result in chunk_results),
+    )
+    return result, total_input_tokens, total_output_tokens
+
+def open_analysis_cache(folder_path, cache_dir=None, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Opens the analysis cache of the repository.
+
+    The cache lives in the .repodoc folder unless `cache_dir` (or the REPODOC_CACHE_DIR
+    environment variable) points to a directory shared with other checkouts.
+    """
+
+    cache_dir = cache_dir or os.getenv('REPODOC_CACHE_DIR') or os.path.join(folder_path, REPODOC_FOLDER, CACHE_FOLDER)
+    schema = json.dumps(FileContent.model_json_schema(), sort_keys=True)
+    version = f"{ANALYSIS_PROMPT_VERSION}:{openai_utils.model_deployment_name}:{schema}"
+    return AnalysisCache(cache_dir, version, max_bytes=max_bytes)
+
+@dataclass
+class PendingAnalysis:
+    """
+    A file selected for GPT analysis by plan_analysis, with its prompts.
+    `local` holds the fields extracted locally (see local_extractors), in which
+    case GPT only writes the description. `dependencies` holds the records of the
+    files whose descriptions go into its prompt (see order_by_dependencies).
+    """
+    file_record: FileRecord
+    content: str
+    last_modified_time: str
+    cache_key: str | None
+    system_prompt: str
+    system_prompt_tokens: int
+    user_prompt: str
+    token_num: int
+    local: dict | None = None
+    dependencies: list[FileRecord] = field(default_factory=list)
+
+    @property
+    def response_format(self):
+        return FileContent if self.local is None else FileDescription
+
+def complete_with_local(item, result):
+    """
+    Completes the GPT result of a pending file with its locally extracted fields.
+
+    Returns:
+        FileContent: The description of `result` with the local type, file type, references
+        and entry points, or `result` itself if nothing was extracted locally.
+    """
+
+    if item.local is None:
+        return result
+    return FileContent(**{**item.local, 'description': result.description})
+
+def store_result(item, analysis, input_tokens, output_tokens, cache=None, journal=None):
+    """
+    Stores the analysis result of a pending file in the cache and journal.
+    """
+
+    if cache:
+        cache.put(item.cache_key, analysis)
+    if journal:
+        journal.append({
+            'path': item.file_record.path,
+            'content_hash': content_hash(item.content),
+            'modified_time': item.last_modified_time,
+            'analysis': analysis,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+        })
+
+def record_api_usage(items, outcomes):
+    """
+    Records the API calls made by the current thread for the files of a request in the run
+    metrics, sharing cached tokens among the files like their input tokens.
+    """
+
+    usage = take_api_usage()
+    if usage is None:
+        return
+    total_input_tokens = sum(input_tokens for _, input_tokens, _ in outcomes) or 1
+    for item, (_, input_tokens, _) in zip(items, outcomes):
+        record_file(item.file_record.path, api_calls=usage['api_calls'], api_latency=usage['api_latency'],
+                    cached_tokens=usage['cached_tokens'] * input_tokens // total_input_tokens)
+
+def record_packed_analysis(items, analyze, cache=None, journal=None, summaries=None):
+    """
+    Analyzes pending files packed in one request with `analyze` and stores each result
+    in the cache and journal, and its description in `summaries` (see build_dependency_user_prompt).
+    """
+
+    # Count the calls of this request only (the thread may have run other work before)
+    take_api_usage()
+    outcomes = [(complete_with_local(item, result), input_tokens, output_tokens)
+                for item, (result, input_tokens, output_tokens) in zip(items, analyze())]
+    record_api_usage(items, outcomes)
+    for item, (result, input_tokens, output_tokens) in zip(items, outcomes):
+        store_result(item, result.model_dump(), input_tokens, output_tokens, cache, journal)
+        if summaries is not None:
+            summaries[item.file_record.path] = result.description
+    return outcomes
+
+def record_analysis(item, analyze, cache=None, journal=None, summaries=None):
+    """
+    Analyzes a pending file with `analyze` and stores the result in the cache and journal as soon as it arrives,
+    and its description in `summaries`. Returns a one-element list, like record_packed_analysis.
+    """
+
+    take_api_usage()
+    result, input_tokens, output_tokens = analyze()
+    result = complete_with_local(item, result)
+    record_api_usage([item], [(result, input_tokens, output_tokens)])
+    store_result(item, result.model_dump(), input_tokens, output_tokens, cache, journal)
+    if summaries is not None:
+        summaries[item.file_record.path] = result.description
+    return [(result, input_tokens, output_tokens)]
+
+def plan_analysis(repo, structure_text, interactive=True, cache=None, resume_records=None,
+                  context_strategy='full', context_tokens=DEFAULT_CONTEXT_TOKENS, extract_workers=0, max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+                  paths=None):
+    """
+    Collects the files to analyze with GPT, including the interactive confirmation.
+
+    Binary files, files larger than `max_file_bytes` and generated files get a skip
+    status without being read (see file_classifier.classify_file). Files whose content
+    is found in the analysis cache, or in `resume_records` replayed from the journal of
+    an interrupted run, get their analysis right away. `paths` restricts the files
+    looked at (every file of the repository if None).
+    With context_strategy 'scoped', each prompt carries only the part of the structure
+    around the file (see context_scope.StructureContext) within `context_tokens`, unless
+    the full structure is smaller.
+    With extract_workers > 0, the confirmed files first go through the local extractors
+    (see local_extractors) in that many processes: files they analyze fully get their
+    analysis right away, and files they partly analyze only ask GPT for the description.
+
+    Returns:
+        tuple: List of PendingAnalysis, and the structure tokens saved vs the full tree (None if not scoped).
+    """
+
+    flag_yesall = False
+
+    full_system_prompt = build_system_prompt(structure_text)
+    full_system_prompt_tokens = get_token_count(full_system_prompt)
+    structure_context = StructureContext(repo, context_tokens, get_token_count) if context_strategy == 'scoped' else None
+    saved_context_tokens = 0
+
+    root = repo.directories[0].root if repo.directories else ''
+    queued = []
+    pending = []
+
+    file_records = repo.iter_files() if paths is None else [repo.get_file(path) for path in paths]
+    for file_record in file_records:
+        file_path = file_record.path
+        echo("************************************")
+        echo("Analyzing file:", file_path)
+        echo("************************************")
+        try:
+            # Get the last modified time
+            last_modified_time = time.ctime(os.path.getmtime(file_path))
+
+            # Binary, oversized and generated files are classified from their first bytes, without reading them
+            status = classify_file(file_path, root, max_file_bytes)
+            if status is not None:
+                echo(f"Skip because {STATUS_LABELS[status]} ({status}).")
+                count(f"files_{status.lower()}")
+                repo.set_analysis(file_path, status, last_modified_time)
+                continue
+
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+
+            cache_key = cache.key(content) if cache else None
+            cached = cache.get(cache_key) if cache else None
+            if cached is not None:
+                echo("Skip because the analysis of this content is cached.")
+                count('files_cached')
+                repo.set_analysis(file_path, cached, last_modified_time)
+                continue
+
+            journal_record = resume_records.get(file_path) if resume_records else None
+            if journal_record and journal_record.get('content_hash') == content_hash(content):
+                echo("Skip because this file was analyzed before the interruption.")
+                count('files_resumed')
+                repo.set_analysis(file_path, journal_record['analysis'], last_modified_time)
+                continue
+
+            if file_record.analysis is not None and last_modified_time == file_record.modified_time:
+                # Analyses stored before the cache existed are kept and moved into the cache
+                echo("Skip because this file has not been modified since the last analysis.")
+                count('files_unchanged')
+                if cache and isinstance(file_record.analysis, dict):
+                    cache.put(cache_key, file_record.analysis)
+                continue
+
+            # Echoing every file is slow on large repositories: only at the highest verbosity
+            echo("-----------------", level=VERBOSE)
+            echo(f"Content of {file_path}:", level=VERBOSE)
+            echo(content, level=VERBOSE)
+
+            token_num = get_token_count(content)
+            token_numk = token_num / 1000
+
+            echo("====>> TOKEN SIZE(k): ", token_numk)
+            echo("====>> FILE_NAME: ", file_path)
+
+            if flag_yesall:
+                choice = 'yes'
+            elif not interactive:
+                choice = 'yes'
+            else:
+                choice = input("Do you want to start a new GPT analysis or skip this file? (yes/no or yesall)(y/n/a): ").strip().lower()
+                if choice == 'yesall' or choice == 'a':
+                    flag_yesall = True
+                    choice = 'yes'
+
+            if choice == 'yes' or choice == 'y':
+                echo("Queued for GPT analysis.")
+                queued.append((file_record, content, last_modified_time, cache_key, token_num))
+            else:
+                print(f"Skipping {file_path}")
+                repo.set_analysis(file_path, NOT_ANALYZED, last_modified_time)
+
+        except Exception as e:
+            print(f"Could not read {file_path}: {e}")
+            repo.set_analysis(file_path, FILE_READ_ERROR)
+
+    if extract_workers > 0:
+        print(f"Running the local extractors on {len(queued)} files (processes: {extract_workers})...")
+        with phase('local_extract'):
+            extractions = extract_files([(file_record.path, content) for file_record, content, _, _, _ in queued], extract_workers)
+    else:
+        extractions = [None] * len(queued)
+
+    if extract_workers > 0:
+        description_system_prompt = build_system_prompt(structure_text, description_only=True)
+        description_system_prompt_tokens = get_token_count(description_system_prompt)
+
+    num_local = 0
+    for (file_record, content, last_modified_time, cache_key, token_num), local in zip(queued, extractions):
+        file_path = file_record.path
+        if is_complete(local):
+            echo(f"Analyzed locally: {file_path}")
+            count('files_local')
+            repo.set_analysis(file_path, local, last_modified_time)
+            if cache:
+                cache.put(cache_key, local)
+            num_local += 1
+            continue
+
+        user_prompt = build_user_prompt(file_path, content)
+        description_only = local is not None
+        if description_only:
+            system_prompt = description_system_prompt
+            system_prompt_tokens = description_system_prompt_tokens
+        else:
+            system_prompt = full_system_prompt
+            system_prompt_tokens = full_system_prompt_tokens
+        if structure_context:
+            # On small trees the scoped text (with its summary of the rest) can be larger than the full tree: keep the smaller one
+            scoped_system_prompt = build_system_prompt(structure_context.build(file_path, content), scoped=True, description_only=description_only)
+            scoped_system_prompt_tokens = get_token_count(scoped_system_prompt)
+            if scoped_system_prompt_tokens < system_prompt_tokens:
+                saved_context_tokens += system_prompt_tokens - scoped_system_prompt_tokens
+                system_prompt = scoped_system_prompt
+                system_prompt_tokens = scoped_system_prompt_tokens
+            else:
+                count('files_full_context')
+        pending.append(PendingAnalysis(file_record, content, last_modified_time, cache_key,
+                                       system_prompt, system_prompt_tokens, user_prompt, token_num, local))
+
+    if extract_workers > 0:
+        num_description_only = sum(1 for item in pending if item.local is not None)
+        print(f"Local extractors: {num_local} files analyzed without GPT, {num_description_only} files only ask GPT for the description")
+
+    return pending, saved_context_tokens if structure_context else None
+
+def order_by_dependencies(repo, pending, graph_filename=None):
+    """
+    Orders the pending files so that the files they depend on are analyzed first, and
+    sets the `dependencies` of each file: the files it depends on that come before it
+    (in a dependency cycle, the later files are left out) or are not pending. Their
+    descriptions are added to its prompt (see build_dependency_user_prompt), and
+    run_analysis_tasks holds it until the pending ones are analyzed.
+
+    Dependencies are taken from the dependency graph of the previous analysis
+    (`graph_filename`, if saved) and from the import statements of the pending contents.
+
+    Returns:
+        list[PendingAnalysis]: The pending files in dependency order.
+    """
+
+    graph = DependencyGraph()
+    if graph_filename and os.path.exists(graph_filename):
+        try:
+            graph = DependencyGraph.load(graph_filename)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read the dependency graph {graph_filename}: {e}")
+
+    root = repo.directories[0].root if repo.directories else ''
+    resolver = ReferenceResolver([record.path for record in repo.iter_files()], root)
+    for item in pending:
+        graph.add_references(item.file_record.path, extract_import_hints(item.content), resolver)
+
+    items = {item.file_record.path: item for item in pending}
+    ordered = [items[path] for path in graph.dependency_order(list(items))]
+    earlier = set()
+    for item in ordered:
+        path = item.file_record.path
+        targets = [target for target in sorted(graph.forward.get(path, ())) if target != path and (target in earlier or target not in items)]
+        item.dependencies = [record for record in map(repo.get_file, targets) if record is not None]
+        earlier.add(path)
+    return ordered
+
+def deduplicate_pending(pending, threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD):
+    """
+    Keeps one representative of each group of identical files among the pending files,
+    and with threshold > 0 of each group of near-identical files (see dedup.find_duplicate_groups).
+
+    Returns:
+        tuple: The pending representatives and other files, and
+        {representative path: [(duplicate PendingAnalysis, similarity)]}.
+    """
+
+    groups = find_duplicate_groups([item.content for item in pending], threshold)
+    duplicates = {}
+    skipped = set()
+    for group in groups:
+        representative = pending[group[0][0]]
+        duplicates[representative.file_record.path] = [(pending[index], similarity) for index, similarity in group[1:]]
+        skipped.update(index for index, _ in group[1:])
+    return [item for index, item in enumerate(pending) if index not in skipped], duplicates
+
+def fan_out_duplicates(representatives, duplicates, root, cache=None, journal=None):
+    """
+    Gives the duplicates of each analyzed representative its analysis. Fields extracted
+    locally from a duplicate (references of its own package, ...) are kept, and the
+    description of a near-identical file gets a note naming the file it comes from.
+
+    Returns:
+        int: Estimated output tokens saved (the size of the reused analyses).
+    """
+
+    saved_output_tokens = 0
+    for representative in representatives:
+        copies = duplicates.get(representative.file_record.path)
+        if not copies:
+            continue
+        analysis = representative.file_record.analysis
+        for item, similarity in copies:
+            file_record = item.file_record
+            if not isinstance(analysis, dict):
+                file_record.analysis = analysis
+                file_record.modified_time = None
+                continue
+            copy = dict(analysis)
+            if item.local is not None:
+                copy.update({key: value for key, value in item.local.items() if key != 'description'})
+            if similarity < 1.0:
+                source = os.path.relpath(representative.file_record.path, root).replace(os.sep, '/')
+                copy['description'] = (f"{copy['description']}\n\n※ {source} とほぼ同じ内容のファイルです（類似度 {similarity:.0%}）。"
+                                       f"説明はそのファイルの解析結果を元にしています。")
+            file_record.analysis = copy
+            file_record.modified_time = item.last_modified_time
+            store_result(item, copy, 0, 0, cache, journal)
+            saved_output_tokens += get_token_count(json.dumps(analysis, ensure_ascii=False))
+    return saved_output_tokens
+
+def dedup_savings(pending, representatives, duplicates, saved_output_tokens, pack_tokens=DEFAULT_PACK_TOKENS, pack_files=DEFAULT_PACK_FILES):
+    """
+    Sums up what deduplication saved: files and requests not sent, and their estimated tokens.
+    """
+
+    copies = [(item, similarity) for group in duplicates.values() for item, similarity in group]
+    return {
+        'files': len(copies),
+        'identical': sum(1 for _, similarity in copies if similarity == 1.0),
+        'requests': len(pack_small_files(pending, pack_tokens, pack_files)) - len(pack_small_files(representatives, pack_tokens, pack_files)),
+        'input_tokens': sum(item.system_prompt_tokens + item.token_num for item, _ in copies),
+        'output_tokens': saved_output_tokens,
+    }
+
+def pack_small_files(pending, pack_tokens=DEFAULT_PACK_TOKENS, max_files=DEFAULT_PACK_FILES):
+    """
+    Bin-packs the pending files sharing a system prompt into groups of at most `pack_tokens`
+    content tokens and `max_files` files (first-fit decreasing), to analyze each group in one request.
+    Files of `pack_tokens` or more stay alone, and so do files with dependencies (see
+    order_by_dependencies), whose prompt carries their descriptions; pack_tokens 0 disables packing.
+
+    Returns:
+        list[list[PendingAnalysis]]: Groups ordered by their first file, files in pending order.
+    """
+
+    if pack_tokens <= 0:
+        return [[item] for item in pending]
+
+    order = {id(item): position for position, item in enumerate(pending)}
+    groups = []
+    bins_by_prompt = {}
+    for item in sorted(pending, key=lambda item: -item.token_num):
+        if item.token_num >= pack_tokens or item.dependencies:
+            groups.append([item])
+            continue
+        bins = bins_by_prompt.setdefault(item.system_prompt, [])
+        for bin in bins:
+            if bin[0] + item.token_num <= pack_tokens and len(bin[1]) < max_files:
+                bin[0] += item.token_num
+                bin[1].append(item)
+                break
+        else:
+            bins.append([item.token_num, [item]])
+            groups.append(bins[-1][1])
+
+    for group in groups:
+        group.sort(key=lambda item: order[id(item)])
+    groups.sort(key=lambda group: order[id(group[0])])
+    return groups
+
+def build_analysis_task(group, limiter=None, cache=None, journal=None, concurrency=1,
+                        max_file_tokens=DEFAULT_MAX_FILE_TOKENS, chunk_tokens=DEFAULT_CHUNK_TOKENS, slots=None, summaries=None):
+    """
+    Builds the scheduled task analyzing a group of pending files (see pack_small_files).
+    A single file larger than `max_file_tokens` is analyzed in chunks, each chunk request holding one of `slots`
+    (without the descriptions of its dependencies). The task returns a list of
+    (FileContent, input tokens, output tokens), one per file, and writes the descriptions to `summaries`.
+    """
+
+    if len(group) > 1:
+        item = group[0]
+        label = f"{item.file_record.path} (+{len(group) - 1} files)"
+        estimated_tokens = item.system_prompt_tokens + sum(get_token_count(item.user_prompt) for item in group)
+        file_contents = [(item.file_record.path, item.content) for item in group]
+        analyze = functools.partial(analyze_packed_files, file_contents, item.system_prompt, estimated_tokens, limiter, item.response_format)
+        return ScheduledTask(functools.partial(record_packed_analysis, group, analyze, cache, journal, summaries), estimated_tokens, label)
+
+    item = group[0]
+    file_path = item.file_record.path
+    if item.token_num > max_file_tokens:
+        # Chunks are charged to the rate limiter and take a concurrency slot one by one
+        analyze = functools.partial(analyze_large_file, file_path, item.content, item.system_prompt, cache, limiter, concurrency, chunk_tokens, slots)
+        estimated_tokens, requests = 0, 0
+    else:
+        estimated_tokens = item.system_prompt_tokens + get_token_count(item.user_prompt)
+        if item.dependencies and summaries is not None:
+            # The limiter is corrected with the actual usage, descriptions included
+            analyze = functools.partial(analyze_file_with_dependencies, item, summaries, estimated_tokens, limiter)
+        else:
+            analyze = functools.partial(analyze_file, item.system_prompt, item.user_prompt, estimated_tokens, limiter, item.response_format)
+        requests = 1
+    return ScheduledTask(functools.partial(record_analysis, item, analyze, cache, journal, summaries), estimated_tokens, file_path, requests=requests)
+
+def run_analysis_tasks(pending, concurrency=1, limiter=None, cache=None, journal=None,
+                       max_file_tokens=DEFAULT_MAX_FILE_TOKENS, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                       pack_tokens=DEFAULT_PACK_TOKENS, pack_files=DEFAULT_PACK_FILES):
+    """
+    Analyzes the pending files with up to `concurrency` workers and writes the results to their file records.
+    With pack_tokens > 0, small files are packed into shared requests (see pack_small_files).
+    A file with pending dependencies (see order_by_dependencies) starts once they are analyzed.
+
+    Returns:
+        tuple: Total input tokens, total output tokens, RunStats.
+    """
+
+    total_input_tokens = 0
+    total_output_tokens = 0
+
+    groups = pack_small_files(pending, pack_tokens, pack_files)
+    # One bound for the requests of the files and of the chunks of large files analyzed meanwhile
+    slots = threading.BoundedSemaphore(max(concurrency, 1))
+    # Descriptions written in this run, by path, for the prompts of the files depending on them
+    summaries = {item.file_record.path: None for item in pending}
+    tasks = [build_analysis_task(group, limiter, cache, journal, concurrency, max_file_tokens, chunk_tokens, slots, summaries) for group in groups]
+    group_indexes = {item.file_record.path: index for index, group in enumerate(groups) for item in group}
+    for index, (group, task) in enumerate(zip(groups, tasks)):
+        task.after = sorted({group_indexes[record.path] for item in group for record in item.dependencies
+                             if group_indexes.get(record.path, index) < index})
+    print(f"Starting GPT analysis of {len(pending)} files in {len(tasks)} requests (concurrency: {concurrency})...")
+    with phase('gpt_requests'):
+        outcomes, run_stats = run_tasks(tasks, concurrency=concurrency, limiter=limiter, slots=slots)
+
+    # Add GPT analysis results to the corresponding files
+    for group, outcome, (queue_wait, rate_limit_wait, latency) in zip(groups, outcomes, run_stats.task_timings):
+        for position, item in enumerate(group):
+            file_record = item.file_record
+            record_file(file_record.path, content_tokens=item.token_num, request_files=len(group),
+                        queue_wait=queue_wait, rate_limit_wait=rate_limit_wait, latency=latency)
+            if isinstance(outcome, Exception):
+                print(f"Could not analyze {file_record.path}: {outcome}")
+                record_file(file_record.path, error=str(outcome))
+                file_record.analysis = FILE_READ_ERROR
+                file_record.modified_time = None
+                continue
+            result, input_tokens, output_tokens = outcome[position]
+            record_file(file_record.path, input_tokens=input_tokens, output_tokens=output_tokens)
+            echo("************************************")
+            echo("Analyzed file:", file_record.path)
+            echo(result, level=VERBOSE)
+            total_input_tokens += input_tokens
+            total_output_tokens += output_tokens
+            file_record.analysis = result.model_dump()
+            file_record.modified_time = item.last_modified_time
+
+    return total_input_tokens, total_output_tokens, run_stats
+
+def print_analysis_summary(total_input_tokens, total_output_tokens, run_stats=None, saved_context_tokens=None, cache=None, dedup_stats=None):
+    """
+    Prints the token usage, estimated cost and run statistics of an analysis.
+    """
 
     print("*****************")
     print("Total input tokens:", total_input_tokens)
     print("Total output tokens:", total_output_tokens)
     print("-----------------")
     print("Estimated cost (gpt-4o-08-06 global): $", estimate_cost_for_gpt4o_0806(total_input_tokens, total_output_tokens))
+    if run_stats:
+        print("-----------------")
+        print(run_stats.summary())
+    if saved_context_tokens is not None:
+        print(f"Structure context tokens saved vs full tree (per prompt, chunks excluded): {saved_context_tokens}")
+    if cache:
+        print(f"Analysis cache: {cache.hits} hits / {cache.misses} misses")
+    if dedup_stats and dedup_stats['files']:
+        saved_cost = estimate_cost_for_gpt4o_0806(dedup_stats['input_tokens'], dedup_stats['output_tokens'])
+        print(f"Deduplication: {dedup_stats['files']} files reused an analysis ({dedup_stats['identical']} identical, "
+              f"{dedup_stats['files'] - dedup_stats['identical']} near-identical), saving {dedup_stats['requests']} requests, "
+              f"about {dedup_stats['input_tokens']} input / {dedup_stats['output_tokens']} output tokens ($ {saved_cost:.4f})")
     print("*****************")
 
-    return stats
+def gpt_analyze(repo, structure_text, interactive=True, concurrency=1, requests_per_minute=None, tokens_per_minute=None,
+                cache=None, journal=None, resume_records=None, max_file_tokens=DEFAULT_MAX_FILE_TOKENS, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                context_strategy='full', context_tokens=DEFAULT_CONTEXT_TOKENS, pack_tokens=DEFAULT_PACK_TOKENS, pack_files=DEFAULT_PACK_FILES,
+                order='structure', graph_filename=None, extract_workers=0, max_file_bytes=DEFAULT_MAX_FILE_BYTES, paths=None,
+                near_duplicate_threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD):
+    """
+    Analyzes the folder structure using GPT and updates the repository model with the analysis results.
+
+    Files to analyze are collected first (see plan_analysis), then analyzed by up to
+    `concurrency` workers within the requests/tokens per minute budgets. Each new
+    result is appended to `journal` as soon as it arrives. Files larger than
+    `max_file_tokens` are analyzed in chunks (see analyze_large_file), and files smaller
+    than `pack_tokens` are packed into shared requests (see pack_small_files). With
+    order 'dependency', each file is analyzed after the files it depends on, with their
+    descriptions in its prompt (see order_by_dependencies).
+    With extract_workers > 0, the local extractors run first, and `paths` restricts the
+    files looked at (see plan_analysis). Only one of identical files, and with
+    near_duplicate_threshold > 0 of near-identical files, is sent (see deduplicate_pending).
+    """
+
+    print("Analyzing structure...")
+    echo(structure_text, level=VERBOSE)
+    print("====")
+
+    with phase('gpt_analyze'):
+        with phase('plan_analysis'):
+            pending, saved_context_tokens = plan_analysis(repo, structure_text, interactive, cache, resume_records, context_strategy, context_tokens,
+                                                          extract_workers, max_file_bytes, paths)
+        with phase('deduplicate'):
+            representatives, duplicates = deduplicate_pending(pending, near_duplicate_threshold)
+        if duplicates:
+            print(f"Deduplication: {len(pending) - len(representatives)} files reuse the analysis of {len(duplicates)} files")
+        if order == 'dependency':
+            representatives = order_by_dependencies(repo, representatives, graph_filename)
+
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        total_input_tokens, total_output_tokens, run_stats = run_analysis_tasks(
+            representatives, concurrency, limiter, cache, journal, max_file_tokens, chunk_tokens, pack_tokens, pack_files)
+        root = repo.directories[0].root if repo.directories else ''
+        saved_output_tokens = fan_out_duplicates(representatives, duplicates, root, cache, journal)
+        dedup_stats = dedup_savings(pending, representatives, duplicates, saved_output_tokens, pack_tokens, pack_files)
+    count('files_duplicate', dedup_stats['files'])
+
+    print_analysis_summary(total_input_tokens, total_output_tokens, run_stats, saved_context_tokens, cache, dedup_stats)
+
+    return repo
+
+def gpt_batch_analyze(repo, structure_text, batch_client, batch_filename, state_filename, cache=None, journal=None, resume_records=None,
+                      max_file_tokens=DEFAULT_MAX_FILE_TOKENS, chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                      context_strategy='full', context_tokens=DEFAULT_CONTEXT_TOKENS, poll_interval=60, extract_workers=0,
+                      max_file_bytes=DEFAULT_MAX_FILE_BYTES, near_duplicate_threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD):
+    """
+    Analyzes the folder structure with the Batch API and updates the repository model with the analysis results.
+
+    The pending files (see plan_analysis) are written to a batch input file with the
+    same prompts and response formats as gpt_analyze, submitted with `batch_client`,
+    polled until done and merged back. The submitted batch is recorded in
+    `state_filename`, so an interrupted run resumes polling the same batch.
+    Files larger than `max_file_tokens`, and pending files not covered by a resumed
+    batch, are analyzed online afterwards. Duplicates are left out as in gpt_analyze.
+    """
+
+    print("Analyzing structure (batch)...")
+    echo(structure_text, level=VERBOSE)
+    print("====")
+
+    with phase('plan_analysis'):
+        pending, saved_context_tokens = plan_analysis(repo, structure_text, False, cache, resume_records, context_strategy, context_tokens,
+                                                      extract_workers, max_file_bytes)
+    with phase('deduplicate'):
+        representatives, duplicates = deduplicate_pending(pending, near_duplicate_threshold)
+    online = [item for item in representatives if item.token_num > max_file_tokens]
+    batch_items = {item.file_record.path: item for item in representatives if item.token_num <= max_file_tokens}
+
+    total_input_tokens = 0
+    total_output_tokens = 0
+
+    state = read_batch_state(state_filename)
+    if state:
+        print(f"Resuming batch {state['batch_id']}")
+    elif batch_items:
+        files = {}
+        requests = []
+        for index, item in enumerate(batch_items.values()):
+            custom_id = f"file-{index}"
+            files[custom_id] = {'path': item.file_record.path, 'content_hash': content_hash(item.content)}
+            messages = [
+                {"role": "system", "content": item.system_prompt},
+                {"role": "user", "content": item.user_prompt},
+            ]
+            requests.append(build_batch_request(custom_id, openai_utils.model_deployment_name, messages, get_response_format_param(item.response_format)))
+        write_batch_file(batch_filename, requests)
+        print(f"Batch requests have been written to {batch_filename} ({len(requests)} files)")
+        state = {'batch_id': batch_client.submit(batch_filename), 'files': files}
+        write_batch_state(state_filename, state)
+        print(f"Submitted batch {state['batch_id']}")
+
+    if state:
+        with phase('batch_wait'):
+            status, output_text, error_text = wait_for_batch(batch_client, state['batch_id'], poll_interval)
+        results = parse_batch_output(error_text)
+        results.update(parse_batch_output(output_text))
+        for custom_id, submitted in state['files'].items():
+            item = batch_items.get(submitted['path'])
+            if item is None or content_hash(item.content) != submitted['content_hash']:
+                # Already merged, or changed since the submission
+                continue
+            content, input_tokens, output_tokens, error = results.get(custom_id, (None, 0, 0, f"no result (batch {status})"))
+            total_input_tokens += input_tokens
+            total_output_tokens += output_tokens
+            file_record = item.file_record
+            record_file(file_record.path, content_tokens=item.token_num, batch=True, input_tokens=input_tokens, output_tokens=output_tokens)
+            try:
+                if error or content is None:
+                    raise ValueError(error)
+                analysis = complete_with_local(item, item.response_format.model_validate_json(content)).model_dump()
+            except Exception as e:
+                print(f"Could not analyze {file_record.path}: {e}")
+                file_record.analysis = FILE_READ_ERROR
+                file_record.modified_time = None
+                del batch_items[submitted['path']]
+                continue
+            store_result(item, analysis, input_tokens, output_tokens, cache, journal)
+            file_record.analysis = analysis
+            file_record.modified_time = item.last_modified_time
+            del batch_items[submitted['path']]
+        os.remove(state_filename)
+
+    online += batch_items.values()
+    run_stats = None
+    if online:
+        input_tokens, output_tokens, run_stats = run_analysis_tasks(online, cache=cache, journal=journal,
+                                                                    max_file_tokens=max_file_tokens, chunk_tokens=chunk_tokens)
+        total_input_tokens += input_tokens
+        total_output_tokens += output_tokens
+    root = repo.directories[0].root if repo.directories else ''
+    saved_output_tokens = fan_out_duplicates(representatives, duplicates, root, cache, journal)
+    dedup_stats = dedup_savings(pending, representatives, duplicates, saved_output_tokens)
+    count('files_duplicate', dedup_stats['files'])
+
+    print_analysis_summary(total_input_tokens, total_output_tokens, run_stats, saved_context_tokens, cache, dedup_stats)
+
+    return repo
+
+def watch_repository(folder_path, stats_filename, output_filename, analyze, journal_filename, git_state_filename, graph_filename,
+                     backend='auto', debounce=DEFAULT_WATCH_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL, metrics_dir=None):
+    """
+    Keeps the final stats file up to date with the working tree until interrupted (Ctrl-C).
+
+    The changes since the last analysis are applied first (from git when an analyzed
+    commit is recorded, otherwise by looking at every file). Then the repository is
+    watched (see repo_watcher.open_watcher); each burst of changes, once no change
+    arrived for `debounce` seconds, is applied to the model (see apply_file_changes),
+    the changed files are analyzed with `analyze(repo, structure_text, journal=..., paths=...)`
+    and the stats file, the analyzed commit and the dependency graph are written again,
+    as well as the run metrics to `metrics_dir` (if given).
+    Changes arriving during an analysis wait in the watcher for the next round.
+    """
+
+    repo = read_stats_from_file(stats_filename)
+    engine = build_ignore_engine(folder_path)
+    root = repo.directories[0].root if repo.directories else folder_path
+    sizes = {}
+    for record in repo.iter_files():
+        try:
+            sizes[os.path.relpath(record.path, root).replace(os.sep, '/')] = os.path.getsize(record.path)
+        except OSError:
+            pass
+
+    def refresh(changes, commit):
+        paths = apply_file_changes(repo, folder_path, changes, engine)
+        for rel_path in changes.deleted + [old_rel_path for old_rel_path, _ in changes.renamed]:
+            sizes.pop(rel_path, None)
+        for path in paths:
+            try:
+                sizes[os.path.relpath(path, root).replace(os.sep, '/')] = os.path.getsize(path)
+            except OSError:
+                pass
+        print(f"{len(changes.added)} added, {len(changes.modified)} modified, {len(changes.deleted)} deleted, "
+              f"{len(changes.renamed)} renamed -> {len(paths)} files to check")
+        if not paths and not changes.deleted and not changes.renamed:
+            return
+        with phase('watch_refresh'):
+            with open_result_store(repo, output_filename) as store, AnalysisJournal(journal_filename, reset=True, store=store) as journal:
+                analyze(repo, format_structure(repo), journal=journal, paths=paths)
+            # Readers (chat.py, report.py) only ever see a complete file: stats files are replaced atomically
+            write_stats_to_file(repo, output_filename)
+            record_analyzed_commit(folder_path, git_state_filename, commit)
+            with phase('dependency_graph'):
+                graph = load_or_build_graph(repo, output_filename, graph_filename)
+        print(f"Updated {output_filename} ({repo.num_files} files, dependency graph: {graph.num_edges} references)")
+        if metrics_dir and current_run():
+            current_run().write(metrics_dir)
+
+    # Watch before catching up, so that the changes made meanwhile are not missed
+    watcher = open_watcher(folder_path, engine, backend, poll_interval)
+    try:
+        commit = head_commit(folder_path)
+        git_state = read_git_state(git_state_filename)
+        changes = changed_files(folder_path, git_state['commit'], git_state.get('sizes'), engine) if git_state else None
+        if changes is None:
+            changes = changes_from_paths(repo, folder_path, {''}, engine, sizes)
+        print("Applying the changes since the last analysis:")
+        refresh(changes, commit)
+        while True:
+            print(f"Waiting for changes in {folder_path} (Ctrl-C to stop)...")
+            rel_paths, rescan = wait_for_changes(watcher, debounce)
+            commit = head_commit(folder_path)
+            if rescan:
+                # Lost events or changed ignore rules: look at the whole repository again
+                print("Rescanning the whole repository...")
+                engine = build_ignore_engine(folder_path)
+                watcher.reset(engine)
+                rel_paths = {''}
+            refresh(changes_from_paths(repo, folder_path, rel_paths, engine, sizes), commit)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        watcher.close()
 
 if __name__ == "__main__":
     # メイン処理開始
@@ -325,8 +1320,41 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--folder', type=str, help='解析対象のフォルダパス')
-    parser.add_argument('--mode', type=str, default='new', help='new/inter/update/final など')
+    parser.add_argument('--mode', type=str, default='new', help='new/inter/update/batch/watch/merge/final など')
+    parser.add_argument('--shard', type=str, default=None, help='i/N: パスのハッシュでN分割したファイルのうちi番目のみを解析（new/inter モード、結果は merge モードでまとめる）')
+    parser.add_argument('--concurrency', type=int, default=1, help='GPT解析の同時実行数')
+    parser.add_argument('--rpm', type=int, default=None, help='1分あたりのリクエスト数上限')
+    parser.add_argument('--tpm', type=int, default=None, help='1分あたりのトークン数上限')
+    parser.add_argument('--max-file-tokens', type=int, default=DEFAULT_MAX_FILE_TOKENS, help='これを超えるトークン数のファイルは分割して解析')
+    parser.add_argument('--max-file-bytes', type=int, default=DEFAULT_MAX_FILE_BYTES, help='これを超えるサイズ(バイト)のファイルは読み込まずに解析対象外とする（0: 上限なし）')
+    parser.add_argument('--chunk-tokens', type=int, default=DEFAULT_CHUNK_TOKENS, help='分割解析時の1チャンクあたりのトークン数')
+    parser.add_argument('--pack-tokens', type=int, default=DEFAULT_PACK_TOKENS, help='これ未満のトークン数の小さいファイルを合計この数まで1リクエストにまとめて解析（0: まとめない）')
+    parser.add_argument('--pack-files', type=int, default=DEFAULT_PACK_FILES, help='1リクエストにまとめるファイル数の上限')
+    parser.add_argument('--context', type=str, default='full', choices=CONTEXT_STRATEGIES, help='解析プロンプトに含めるフォルダ構成の範囲（full: 全体 / scoped: 対象ファイルの周辺のみ）')
+    parser.add_argument('--context-tokens', type=int, default=DEFAULT_CONTEXT_TOKENS, help='scoped 指定時にフォルダ構成へ割り当てるトークン数')
+    parser.add_argument('--order', type=str, default='structure', choices=ANALYSIS_ORDERS, help='GPT解析の順序（structure: フォルダ構成順 / dependency: 依存先のファイルを先に解析し、その説明を依存元のプロンプトに含める）')
+    parser.add_argument('--near-duplicate-threshold', type=float, default=DEFAULT_NEAR_DUPLICATE_THRESHOLD, help='内容の類似度（0〜1）がこれ以上のファイルは1ファイルのみ解析して結果を共有（0: 同一内容のファイルのみ）')
+    parser.add_argument('--extract-workers', type=int, default=0, help='GPT解析の前にローカル解析（import・公開メソッドの抽出など）を行うプロセス数（0: 行わない）')
+    parser.add_argument('--walk-workers', type=int, default=1, help='フォルダ走査の並列数（ネットワークファイルシステム向け）')
+    parser.add_argument('--cache-dir', type=str, default=None, help='解析キャッシュのフォルダパス（複数のチェックアウトで共有する場合に指定）')
+    parser.add_argument('--batch-client', type=str, default='azure', choices=['azure', 'local'], help='batch モードの送信先（azure: Azure OpenAI Batch API / local: ネットワークを使わない動作確認用）')
+    parser.add_argument('--batch-poll-interval', type=int, default=60, help='batch モードで完了を確認する間隔(秒)')
+    parser.add_argument('--store', type=str, default='json', choices=['json', 'sqlite'], help='最終ファイルの保存形式（json: stats_final.json / sqlite: stats_final.sqlite）')
+    parser.add_argument('--watch-backend', type=str, default='auto', choices=WATCH_BACKENDS, help='watch モードの変更検知方法（auto: inotify が使えなければポーリング / inotify / poll）')
+    parser.add_argument('--watch-debounce', type=float, default=DEFAULT_WATCH_DEBOUNCE, help='watch モードで変更が途切れてから解析を始めるまでの秒数')
+    parser.add_argument('--watch-interval', type=float, default=DEFAULT_POLL_INTERVAL, help='watch モードのポーリング間隔(秒)')
+    parser.add_argument('--cache-size-mb', type=int, default=DEFAULT_MAX_CACHE_BYTES // (1024 * 1024), help='解析キャッシュの最大サイズ(MB)')
+    parser.add_argument('--verbosity', type=int, default=None, choices=VERBOSITY_LEVELS, help='表示の詳細度（0: 集計とエラーのみ / 1: ファイルごとに1行 / 2: ファイル内容・フォルダ構成・解析結果も表示）。既定は --folder 指定時 1、対話型モード 2')
+    parser.add_argument('--metrics-dir', type=str, default=None, help='実行記録（JSON）と Prometheus テキストファイルの出力先（既定: <フォルダ>/.repodoc/metrics）')
+    parser.add_argument('--no-metrics', action='store_true', help='実行記録・メトリクスを書き出さない')
+    parser.add_argument('--profile', type=str, default='', help='cProfile で計測するフェーズ（カンマ区切り、all: すべて）。結果は <metrics-dir>/profiles/ に出力')
     args = parser.parse_args()
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
 
     if args.folder:
         # 自動実行モード
@@ -342,23 +1370,55 @@ Select an option:
     - Start a new analysis: (new)/(n)
     - Continue from an intermediate file: (inter)/(i)
     - Update the analysis with GPT *File update only: (update)/(u)
+    - Analyze with the Batch API (asynchronous, lower cost): (batch)/(b)
+    - Keep the analysis up to date while files change: (watch)/(w)
+    - Merge the results of the shards (--shard i/N): (merge)/(m)
     - Confirm a final file: (final)/(f)
 >""").strip().lower()
         interactive = True
 
+    # 実行記録: フェーズごとの経過時間、ファイルごとの API レイテンシ・待ち時間・トークン数を記録する
+    set_verbosity(args.verbosity if args.verbosity is not None else (VERBOSE if interactive else NORMAL))
+    metrics_dir = None if args.no_metrics else args.metrics_dir or os.path.join(folder_path, REPODOC_FOLDER, METRICS_FOLDER)
+    run_metrics = start_run(f"analyze_shard{shard[0]}of{shard[1]}" if shard else 'analyze', os.path.basename(folder_path),
+                            [name.strip() for name in args.profile.split(',') if name.strip()], {'mode': choice})
+
     # 統計ファイル名の設定
     stats_intermediate_filename = os.path.join(folder_path, REPODOC_FOLDER, STATS_INTERMEDIATE_FILENAME)
-    stats_final_filename = os.path.join(folder_path, REPODOC_FOLDER, STATS_FINAL_FILENAME)
+    # 最終ファイルは --store で指定した形式で書き込み、読み込みは新しい方から行う
+    stats_final_json_filename = os.path.join(folder_path, REPODOC_FOLDER, STATS_FINAL_FILENAME)
+    stats_final_store_filename = os.path.join(folder_path, REPODOC_FOLDER, STATS_STORE_FILENAME)
+    stats_final_output_filename = stats_final_store_filename if args.store == 'sqlite' else stats_final_json_filename
+    stats_final_filename = latest_stats_filename(stats_final_json_filename, stats_final_store_filename)
+    journal_filename = os.path.join(folder_path, REPODOC_FOLDER, JOURNAL_FILENAME)
+    batch_filename = os.path.join(folder_path, REPODOC_FOLDER, BATCH_REQUESTS_FILENAME)
+    batch_state_filename = os.path.join(folder_path, REPODOC_FOLDER, BATCH_STATE_FILENAME)
+    dependency_graph_filename = os.path.join(folder_path, REPODOC_FOLDER, DEPENDENCY_GRAPH_FILENAME)
+    git_state_filename = os.path.join(folder_path, REPODOC_FOLDER, GIT_STATE_FILENAME)
+    # 解析開始時点のコミットを記録し、次回の update ではこのコミットからの変更ファイルのみを解析する
+    analyzed_commit = head_commit(folder_path)
+    if shard:
+        # シャードごとに中間ファイル・ジャーナルを分け、結果は部分ファイルに書き込む（同じフォルダで並列に実行可能）
+        if choice not in ['new', 'n', 'inter', 'i']:
+            parser.error("--shard is only used with the new and inter modes")
+        shard_index, shard_count = shard
+        stats_intermediate_filename = shard_filename(folder_path, REPODOC_FOLDER, STATS_INTERMEDIATE_FILENAME, shard_index, shard_count)
+        journal_filename = shard_filename(folder_path, REPODOC_FOLDER, JOURNAL_FILENAME, shard_index, shard_count)
+        shard_output_filename = shard_filename(folder_path, REPODOC_FOLDER, 'stats_shard.json', shard_index, shard_count)
+        # シャードごとのエンドポイント・デプロイメント（AZURE_OPENAI_ENDPOINT_SHARD<i> など）があれば使用する
+        if configure_endpoint(f"SHARD{shard_index}"):
+            print(f"Shard {shard_index}/{shard_count}: using the endpoint settings with the suffix _SHARD{shard_index}")
+    cache = open_analysis_cache(folder_path, args.cache_dir, args.cache_size_mb * 1024 * 1024)
 
     if choice in ['new', 'n']:
-        stats = analyze_folder(folder_path)
+        stats = analyze_folder(folder_path, walk_workers=args.walk_workers)
         # 分析パスの最後のディレクトリ名に .rd 拡張子を付けたファイルに分析パスを保存する
         analysis_path_filename = os.path.basename(folder_path) + '.rd'
         with open(analysis_path_filename, 'w', encoding='utf-8') as f:
             f.write(folder_path)
-        structure_text = format_structure(stats['structure'])
-        print("====")
-        print(structure_text)
+        structure_text = format_structure(stats)
+        echo("====", level=VERBOSE)
+        echo(structure_text, level=VERBOSE)
         if not interactive:
             write_stats_to_file(stats, stats_intermediate_filename)
             print(f"Stats have been written to {stats_intermediate_filename}")
@@ -374,11 +1434,37 @@ Select an option:
         # 中間ファイルから読み込み、構造を表示し、GPT解析を実行
         if os.path.exists(stats_intermediate_filename):
             stats = read_stats_from_file(stats_intermediate_filename)
-            structure_text = format_structure(stats['structure'])
-            print("====")
-            print(structure_text)
-            stats2 = gpt_analyze(stats['structure'], structure_text, interactive=interactive)
-            write_stats_to_file(stats2, stats_final_filename)
+            structure_text = format_structure(stats)
+            echo("====", level=VERBOSE)
+            echo(structure_text, level=VERBOSE)
+            # 中断された解析のジャーナルを読み込み、解析済みのファイルはスキップする
+            resume_records = read_journal(journal_filename) if choice in ['inter', 'i'] else None
+            if resume_records:
+                print(f"Resuming from {journal_filename}: {len(resume_records)} analyzed files")
+            shard_files = None
+            if shard:
+                # プロンプトにはフォルダ構成全体を含め、解析するのはこのシャードのファイルのみ
+                shard_files = shard_paths(stats, shard_index, shard_count)
+                print(f"Shard {shard_index}/{shard_count}: {len(shard_files)} of {stats.num_files} files")
+            result_store = contextlib.nullcontext() if shard else open_result_store(stats, stats_final_output_filename)
+            with result_store as store, AnalysisJournal(journal_filename, reset=choice in ['new', 'n'], store=store) as journal:
+                stats2 = gpt_analyze(stats, structure_text, interactive=interactive,
+                                  concurrency=args.concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                  cache=cache, journal=journal, resume_records=resume_records,
+                                  max_file_tokens=args.max_file_tokens, chunk_tokens=args.chunk_tokens,
+                                  context_strategy=args.context, context_tokens=args.context_tokens,
+                                  pack_tokens=args.pack_tokens, pack_files=args.pack_files,
+                                  order=args.order, graph_filename=dependency_graph_filename,
+                                  extract_workers=args.extract_workers, max_file_bytes=args.max_file_bytes,
+                                  near_duplicate_threshold=args.near_duplicate_threshold,
+                                  paths=shard_files)
+            if shard:
+                write_partial(stats2, shard_output_filename, shard_index, shard_count, analyzed_commit)
+                print(f"Shard {shard_index}/{shard_count} result has been written to {shard_output_filename}: "
+                      f"merge the results of all the shards with --mode merge")
+            else:
+                write_stats_to_file(stats2, stats_final_output_filename)
+                record_analyzed_commit(folder_path, git_state_filename, analyzed_commit)
         else:
             print(f"No saved stats file found at {stats_intermediate_filename}")
 
@@ -386,30 +1472,122 @@ Select an option:
         # 最終ファイルから読み込み、GPT解析を再実行
         if os.path.exists(stats_final_filename):
             stats = read_stats_from_file(stats_final_filename)
-            structure_text = format_structure(stats['structure'])
-            print("====")
-            print(structure_text)
-            stats2 = gpt_analyze(stats['structure'], structure_text, interactive=interactive)
-            write_stats_to_file(stats2, stats_final_filename)
+            # 解析済みのコミットが記録されていれば、git の差分から変更ファイルのみを反映・解析する
+            git_state = read_git_state(git_state_filename)
+            engine = build_ignore_engine(folder_path)
+            changes = changed_files(folder_path, git_state['commit'], git_state.get('sizes'), engine) if git_state else None
+            update_paths = None
+            if changes is not None:
+                update_paths = apply_file_changes(stats, folder_path, changes, engine)
+                print(f"Changes since {git_state['commit']}: {len(changes.added)} added, {len(changes.modified)} modified, "
+                      f"{len(changes.deleted)} deleted, {len(changes.renamed)} renamed -> {len(update_paths)} files to check")
+            else:
+                print("No analyzed commit to compare with: checking every file of the last analysis.")
+            structure_text = format_structure(stats)
+            echo("====", level=VERBOSE)
+            echo(structure_text, level=VERBOSE)
+            with open_result_store(stats, stats_final_output_filename) as store, \
+                    AnalysisJournal(journal_filename, reset=True, store=store) as journal:
+                stats2 = gpt_analyze(stats, structure_text, interactive=interactive,
+                                  concurrency=args.concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                  cache=cache, journal=journal,
+                                  max_file_tokens=args.max_file_tokens, chunk_tokens=args.chunk_tokens,
+                                  context_strategy=args.context, context_tokens=args.context_tokens,
+                                  pack_tokens=args.pack_tokens, pack_files=args.pack_files,
+                                  order=args.order, graph_filename=dependency_graph_filename,
+                                  extract_workers=args.extract_workers, max_file_bytes=args.max_file_bytes,
+                                  near_duplicate_threshold=args.near_duplicate_threshold,
+                                  paths=update_paths)
+            write_stats_to_file(stats2, stats_final_output_filename)
+            record_analyzed_commit(folder_path, git_state_filename, analyzed_commit)
         else:
             print(f"No saved stats file found at {stats_final_filename}")
 
-    if choice in ['new', 'n', 'inter', 'i', 'final', 'f', 'update', 'u']:
+    if choice in ['batch', 'b']:
+        # 最終ファイル（なければ中間ファイル）から読み込み、Batch API でまとめて解析
+        stats_filename = stats_final_filename if os.path.exists(stats_final_filename) else stats_intermediate_filename
+        if os.path.exists(stats_filename):
+            stats = read_stats_from_file(stats_filename)
+            structure_text = format_structure(stats)
+            echo("====", level=VERBOSE)
+            echo(structure_text, level=VERBOSE)
+            batch_client = LocalBatchClient() if args.batch_client == 'local' else AzureBatchClient(openai_utils.azure_openai_client)
+            # 送信済みのバッチを待っている場合は、そのバッチに含まれないファイルの結果だけを再解析する
+            resume_records = read_journal(journal_filename) if os.path.exists(batch_state_filename) else None
+            with open_result_store(stats, stats_final_output_filename) as store, \
+                    AnalysisJournal(journal_filename, reset=resume_records is None, store=store) as journal:
+                stats2 = gpt_batch_analyze(stats, structure_text, batch_client, batch_filename, batch_state_filename,
+                                           cache=cache, journal=journal, resume_records=resume_records,
+                                           max_file_tokens=args.max_file_tokens, chunk_tokens=args.chunk_tokens,
+                                           context_strategy=args.context, context_tokens=args.context_tokens,
+                                           poll_interval=args.batch_poll_interval, extract_workers=args.extract_workers,
+                                           max_file_bytes=args.max_file_bytes, near_duplicate_threshold=args.near_duplicate_threshold)
+            write_stats_to_file(stats2, stats_final_output_filename)
+            record_analyzed_commit(folder_path, git_state_filename, analyzed_commit)
+        else:
+            print(f"No saved stats file found at {stats_intermediate_filename}")
+
+    if choice in ['watch', 'w']:
+        # 最終ファイルから読み込み、変更されたファイルを検知するたびに反映・解析する（Ctrl-C で終了）
+        if os.path.exists(stats_final_filename):
+            analyze = functools.partial(gpt_analyze, interactive=False,
+                                        concurrency=args.concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                        cache=cache, max_file_tokens=args.max_file_tokens, chunk_tokens=args.chunk_tokens,
+                                        context_strategy=args.context, context_tokens=args.context_tokens,
+                                        pack_tokens=args.pack_tokens, pack_files=args.pack_files,
+                                        order=args.order, graph_filename=dependency_graph_filename,
+                                        extract_workers=args.extract_workers, max_file_bytes=args.max_file_bytes,
+                                        near_duplicate_threshold=args.near_duplicate_threshold)
+            watch_repository(folder_path, stats_final_filename, stats_final_output_filename, analyze,
+                             journal_filename, git_state_filename, dependency_graph_filename,
+                             backend=args.watch_backend, debounce=args.watch_debounce, poll_interval=args.watch_interval,
+                             metrics_dir=metrics_dir)
+        else:
+            print(f"No saved stats file found at {stats_final_filename}: run a new analysis first")
+
+    if choice in ['merge', 'm']:
+        # 全シャードの部分ファイルを1つの最終ファイルにまとめる（ファイル数・ディレクトリ数は構成から数え直す）
+        shards_folder = os.path.join(folder_path, REPODOC_FOLDER, SHARDS_FOLDER)
+        partials = find_partials(shards_folder)
+        if partials:
+            # 分割数の異なる結果が残っている場合は最後に書き込まれたものをまとめる
+            shard_count = max(partials, key=lambda count: max(os.path.getmtime(filename) for filename in partials[count]))
+            print(f"Merging {len(partials[shard_count])} results of a run with {shard_count} shards")
+            try:
+                stats2, merged_commit = merge_partials(partials[shard_count], folder_path)
+            except ValueError as e:
+                print(f"Could not merge the shard results: {e}")
+            else:
+                write_stats_to_file(stats2, stats_final_output_filename)
+                record_analyzed_commit(folder_path, git_state_filename, merged_commit)
+                print(f"Merged stats ({stats2.num_files} files, {stats2.num_dirs} directories, {stats2.total_size} bytes) "
+                      f"have been written to {stats_final_output_filename}")
+        else:
+            print(f"No shard results found in {shards_folder}")
+
+    if choice in ['new', 'n', 'inter', 'i', 'final', 'f', 'update', 'u', 'batch', 'b', 'merge', 'm'] and not shard:
         # 最終ファイルの内容を表示
+        stats_final_filename = latest_stats_filename(stats_final_json_filename, stats_final_store_filename)
         if os.path.exists(stats_final_filename):
             stats = read_stats_from_file(stats_final_filename)
+            # 解析結果の references から依存グラフを作成（最終ファイルが更新されていなければそのまま）
+            with phase('dependency_graph'):
+                dependency_graph = load_or_build_graph(stats, stats_final_filename, dependency_graph_filename)
+            print(f"Dependency graph: {dependency_graph.num_edges} references between files ({dependency_graph_filename})")
             if not interactive:
-                structure_text = format_structure(stats['structure'])
-                print("========================")
-                print(structure_text)
+                structure_text = format_structure(stats)
+                echo("========================", level=VERBOSE)
+                echo(structure_text, level=VERBOSE)
             else:
                 user_check = input("Check the result? (yes/no)(y/n): ").strip().lower()
                 if user_check in ['yes', 'y']:
-                    structure_text = format_structure(stats['structure'])
+                    structure_text = format_structure(stats)
                     print("========================")
                     print(structure_text)
         else:
             print(f"No saved stats file found at {stats_final_filename}")
-    else:
-        print("Invalid choice. Please enter 'new' or 'inter' or 'final'.")
+    elif choice not in ['watch', 'w'] and not shard:
+        print("Invalid choice. Please enter 'new' or 'inter' or 'update' or 'batch' or 'watch' or 'merge' or 'final'.")
 
+    if metrics_dir:
+        print(f"Run metrics have been written to {run_metrics.write(metrics_dir)}")
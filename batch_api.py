@@ -0,0 +1,209 @@
+import json
+import os
+import time
+import uuid
+
+BATCH_REQUESTS_FILENAME = 'batch_requests.jsonl'
+BATCH_STATE_FILENAME = 'batch_state.json'
+BATCH_ENDPOINT = '/chat/completions'
+BATCH_COMPLETION_WINDOW = '24h'
+BATCH_FINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+def build_batch_request(custom_id, model, messages, response_format_param):
+    """
+    Builds one line of a Batch API input file.
+    """
+
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {
+            'model': model,
+            'messages': messages,
+            'response_format': response_format_param,
+        },
+    }
+
+def write_batch_file(filename, requests):
+    """
+    Writes the requests to a Batch API input file (JSONL).
+    """
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as file:
+        for request in requests:
+            file.write(json.dumps(request, ensure_ascii=False) + '\n')
+
+def parse_batch_output(text):
+    """
+    Parses a Batch API output file.
+
+    Returns:
+        dict: custom_id -> (message content or None, input tokens, output tokens, error message or None).
+    """
+
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get('response') or {}
+        body = response.get('body') or {}
+        usage = body.get('usage') or {}
+        error = item.get('error')
+        content = None
+        if response.get('status_code') == 200 and body.get('choices'):
+            message = body['choices'][0]['message']
+            content = message.get('content')
+            if message.get('refusal'):
+                error = message['refusal']
+        elif not error:
+            error = body.get('error') or f"status {response.get('status_code')}"
+        results[item['custom_id']] = (content, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), error and str(error))
+    return results
+
+class AzureBatchClient:
+    """
+    Batch client backed by the Azure OpenAI Batch API.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_filename):
+        """
+        Uploads the input file and creates a batch. Returns the batch id.
+        """
+
+        with open(input_filename, 'rb') as file:
+            uploaded = self.client.files.create(file=file, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW,
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        """
+        Returns (status, output file id, error file id) of the batch.
+        """
+
+        batch = self.client.batches.retrieve(batch_id)
+        return batch.status, batch.output_file_id, batch.error_file_id
+
+    def download(self, file_id):
+        """
+        Returns the text content of a file.
+        """
+
+        return self.client.files.content(file_id).text
+
+def placeholder_from_schema(schema):
+    """
+    Builds a minimal value matching a JSON schema (strings are empty, lists are empty).
+    """
+
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: placeholder_from_schema(prop) for name, prop in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return []
+    if kind in ('integer', 'number'):
+        return 0
+    if kind == 'boolean':
+        return False
+    return ''
+
+def local_placeholder_responder(body):
+    """
+    Responder of LocalBatchClient answering every request with a placeholder matching its schema.
+    """
+
+    schema = body['response_format']['json_schema']['schema']
+    return json.dumps(placeholder_from_schema(schema), ensure_ascii=False)
+
+class LocalBatchClient:
+    """
+    Offline stand-in for AzureBatchClient.
+
+    Requests are answered by `responder(body) -> message content` when the batch is
+    submitted, and the output is written next to the input file in the Batch API output
+    format, so the whole batch flow can run without network access. The path of the
+    output file serves as batch id and output file id.
+    """
+
+    def __init__(self, responder=local_placeholder_responder):
+        self.responder = responder
+
+    def submit(self, input_filename):
+        output_filename = os.path.splitext(input_filename)[0] + '_output.jsonl'
+        lines = []
+        with open(input_filename, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                content = self.responder(request['body'])
+                lines.append(json.dumps({
+                    'id': f"local-{uuid.uuid4().hex}",
+                    'custom_id': request['custom_id'],
+                    'response': {
+                        'status_code': 200,
+                        'body': {
+                            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}],
+                            'usage': {'prompt_tokens': 0, 'completion_tokens': 0},
+                        },
+                    },
+                    'error': None,
+                }, ensure_ascii=False))
+        with open(output_filename, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        return output_filename
+
+    def status(self, batch_id):
+        return 'completed', batch_id, None
+
+    def download(self, file_id):
+        with open(file_id, 'r', encoding='utf-8') as file:
+            return file.read()
+
+def wait_for_batch(client, batch_id, poll_interval=60, timeout=None):
+    """
+    Polls the batch until it reaches a final status.
+
+    Returns:
+        tuple: Final status, output file text (or ''), error file text (or '').
+    """
+
+    started = time.monotonic()
+    while True:
+        status, output_file_id, error_file_id = client.status(batch_id)
+        print(f"Batch {batch_id}: {status}")
+        if status in BATCH_FINAL_STATUSES:
+            output_text = client.download(output_file_id) if output_file_id else ''
+            error_text = client.download(error_file_id) if error_file_id else ''
+            return status, output_text, error_text
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError(f"Batch {batch_id} did not finish within {timeout} seconds")
+        time.sleep(poll_interval)
+
+def read_batch_state(filename):
+    """
+    Reads the state of a submitted batch, or None.
+    """
+
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def write_batch_state(filename, state):
+    """
+    Writes the state of a submitted batch, so that polling can resume after an interruption.
+    """
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=4, ensure_ascii=False)
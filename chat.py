@@ -1,11 +1,30 @@
-import json
 import os
+import re
 import sys
+import json
+import time
 from pydantic import BaseModel
-from openai_utils import get_parsed_completion, get_token_count, estimate_cost_for_gpt4o_0806
+from openai_utils import get_parsed_completion, get_streamed_parsed_completion, get_token_count, estimate_cost_for_gpt4o_0806
+from repo_model import STATUS_LABELS
+from repo_store import STATS_STORE_FILENAME, load_stats, latest_stats_filename
+from retrieval_index import RETRIEVAL_INDEX_FILENAME, load_or_build_index
+from content_slicer import FileContentCache, slice_content, allocate_budget
+from conversation_memory import ConversationMemory, DEFAULT_HISTORY_TOKENS, DEFAULT_HISTORY_TURNS
+from query_router import QueryRouter, RouteDecision, ROUTER_MODES, CHAT_ROUTE_LOG_FILENAME, MAX_ROUTED_FILES, log_route
+from dependency_graph import DEPENDENCY_GRAPH_FILENAME, DEFAULT_IMPACT_DEPTH, load_or_build_graph
+from metrics import METRICS_FOLDER, VERBOSE, VERBOSITY_LEVELS, echo, set_verbosity, start_run, phase, record_turn
 
 STATS_FINAL_FILENAME = 'stats_final.json'
 REPODOC_FOLDER = '.repodoc'
+DEFAULT_CONTEXT_TOKENS = 8000
+DEFAULT_TOP_K = 20
+DEFAULT_FILE_TOKENS = 12000
+# Estimate of the o200k_base tokens of a text: about 4 ASCII characters per token, and
+# about one token per other character (the descriptions are in Japanese)
+ASCII_CHARS_PER_TOKEN = 4
+# Tokens of the headings and bullets of a file block of format_file_description
+FILE_BLOCK_TOKENS = 30
+HIGH_SURROGATE_PATTERN = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}')
 
 class CheckRequest(BaseModel):
     complex_level: int
@@ -15,106 +34,141 @@ class AnalyzeComment(BaseModel):
     answer: str
     recommend_web_search_keywords: list[str]
 
+class ConversationSummary(BaseModel):
+    summary: str
+
 def read_stats_from_file(filename):
-    """Read JSON stats from a file."""
-    with open(filename, 'r', encoding='utf-8') as file:
-        return json.load(file)
+    """Read stats from a JSON file or a SQLite store."""
+    return load_stats(filename)
 
-def format_structure_common(structure, with_description=False):
+def format_file_description(root, record):
+    """Format the description block of an analyzed file."""
+    f = record.name
+    lines = []
+    analysis = record.analysis
+    if isinstance(analysis, dict):
+        file_type = analysis.get('file_type', '---')
+        description = analysis.get('description', '---')
+        references = analysis.get('references', [])
+        entry_points = analysis.get('entry_points', [])
+        lines.append(f"■ {f} ({file_type})")
+        lines.append(f"{description}\n")
+        lines.append(f"# 参照・呼び出し先")
+        for ref in references:
+            lines.append(f"  - {ref}")
+        lines.append(f"\n# エントリーポイント")
+        for ep in entry_points:
+            lines.append(f"  - {ep}")
+        lines.append(f"\n# ファイルパス")
+        lines.append(f"  - {root}/{f}")
+        lines.append("\n")
+    elif analysis in STATUS_LABELS:
+        lines.append(f"■ {f}")
+        lines.append(f" - ※{STATUS_LABELS[analysis]}\n")
+    else:
+        raise ValueError(f"Unexpected analysis result: {analysis}")
+    return lines
+
+def format_structure_common(repo, with_description=False):
     """Format the structure of the repository."""
     top_indent_level = 0
     lines = []
-    for root, dirs, files, analyses, modified_times in structure:
+    for directory in repo.directories:
+        root = directory.root
         if top_indent_level == 0:
             top_indent_level = root.count(os.sep)
         indent_level = root.count(os.sep) - top_indent_level
         indent = ' ' * 4 * indent_level
-        if with_description and files:
+        if with_description and directory.files:
             lines.append(f"■■ {root}/\n")
         elif not with_description:
             lines.append(f"{indent}{os.path.basename(root)}/")
-        for index, f in enumerate(files):
+        for record in directory.files:
             if with_description:
-                if 0 <= index < len(analyses):
-                    analysis = analyses[index]
-                    if isinstance(analysis, dict):
-                        file_type = analysis.get('file_type', '---')
-                        description = analysis.get('description', '---')
-                        references = analysis.get('references', [])
-                        entry_points = analysis.get('entry_points', [])
-                        lines.append(f"■ {f} ({file_type})")
-                        lines.append(f"{description}\n")
-                        lines.append(f"# 参照・呼び出し先")
-                        for ref in references:
-                            lines.append(f"  - {ref}")
-                        lines.append(f"\n# エントリーポイント")
-                        for ep in entry_points:
-                            lines.append(f"  - {ep}")
-                        lines.append(f"\n# ファイルパス")
-                        lines.append(f"  - {root}/{f}")
-                        lines.append("\n")
-                    elif analysis == "NOT_ANALYZED":
-                        lines.append(f"■ {f}")
-                        lines.append(f" - ※解析対象外\n")
-                    elif analysis == "FILE_READ_ERROR":
-                        lines.append(f"■ {f}")
-                        lines.append(f" - ※ファイル読み取りエラー\n")
-                    else:
-                        raise ValueError(f"Unexpected analysis result: {analysis}")
+                if record.analysis is not None:
+                    lines.extend(format_file_description(root, record))
             else:
-                lines.append(f"{indent}    {f}")
+                lines.append(f"{indent}    {record.name}")
     return '\n'.join(lines)
 
-def format_structure(structure):
+def format_structure(repo):
     """Format the structure of the repository without descriptions."""
-    return format_structure_common(structure, with_description=False)
+    return format_structure_common(repo, with_description=False)
 
-def format_structure_with_description(structure):
+def format_structure_with_description(repo):
     """Format the structure of the repository with descriptions."""
-    return format_structure_common(structure, with_description=True)
-
-def generate_additional_system_prompt(file_paths):
-    """Generate additional system prompt based on file paths."""
-    additional_system_prompt = ""
-    print("Try to confirm the following file paths:")
-    for file_path in file_paths:
-        print(f"  - {file_path}")
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except FileNotFoundError:
-            content = "(現在このファイルは存在しません)"
-        additional_system_prompt += f"### 参考情報 - {file_path}\n{content}\n"
-    return additional_system_prompt
-
-if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        analysis_path_file = os.path.abspath(sys.argv[1])
-        with open(analysis_path_file, 'r', encoding='utf-8') as f:
-            analysis_path = f.read().strip()
-    else:
-        analysis_path = input("Enter the analysis path: ").strip()
-        analysis_path = os.path.abspath(analysis_path)
-
-    stats_final_filename = os.path.join(analysis_path, REPODOC_FOLDER, STATS_FINAL_FILENAME)
-
-    if os.path.exists(stats_final_filename):
-        stats = read_stats_from_file(stats_final_filename)
-        structure_text = format_structure(stats['structure'])
-        print("==== REPOSITORY STRUCTURE ====")
-        print(structure_text)
-        print("==============================")
-
-        structure_with_description_text = format_structure_with_description(stats['structure'])
-        print("==== REPOSITORY WITH DESCRIPTION STRUCTURE ====")
-        print(structure_with_description_text)
-        print("===============================================")
-        print("ABOVE TEXT TOKEN SIZE(k): ", get_token_count(structure_with_description_text) / 1000)
-    else:
-        print(f"No saved stats file found at {STATS_FINAL_FILENAME}")
+    return format_structure_common(repo, with_description=True)
+
+def estimate_text_tokens(text):
+    """Estimate the tokens of a text without tokenizing it (see ASCII_CHARS_PER_TOKEN)."""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars / ASCII_CHARS_PER_TOKEN + len(text) - ascii_chars
+
+def estimate_description_tokens(repo):
+    """
+    Estimate the tokens of format_structure_with_description from the analyses, without
+    rendering and tokenizing it.
+    """
+    tokens = 0
+    for directory in repo.directories:
+        if directory.files:
+            tokens += estimate_text_tokens(directory.root) + 2
+        for record in directory.files:
+            analysis = record.analysis
+            if isinstance(analysis, dict):
+                items = analysis.get('references', []) + analysis.get('entry_points', [])
+                texts = [analysis.get('description', ''), analysis.get('file_type', ''), directory.root, record.name, record.name] + items
+                tokens += sum(estimate_text_tokens(text) for text in texts) + 2 * len(items) + FILE_BLOCK_TOKENS
+            elif analysis is not None:
+                tokens += estimate_text_tokens(f"{record.name}{STATUS_LABELS.get(analysis, '')}") + 4
+    return round(tokens)
+
+def format_compact_tree(repo, token_budget):
+    """Format the folders of the repository with their file counts, within a token budget."""
+    top_root = repo.directories[0].root if repo.directories else ''
+    lines = []
+    used = 0
+    for position, directory in enumerate(repo.directories):
+        line = f"{os.path.relpath(directory.root, top_root)}/ ({len(directory.files)})"
+        tokens = get_token_count(line) + 1
+        if used + tokens > token_budget:
+            lines.append(f"... ({len(repo.directories) - position} more folders)")
+            break
+        lines.append(line)
+        used += tokens
+    return '\n'.join(lines)
 
-    print("Let's start a new chat!")
-    check_system_prompt = f"""\
+def build_retrieval_context(repo, index, query, token_budget=DEFAULT_CONTEXT_TOKENS, top_k=DEFAULT_TOP_K):
+    """
+    Format the repository context for a question: a compact folder tree and the
+    descriptions of the files most relevant to the question, within a token budget.
+    """
+    tree_text = format_compact_tree(repo, token_budget // 4)
+    used = get_token_count(tree_text)
+    blocks = []
+    for path, _ in index.search(query, top_k):
+        record = repo.get_file(path)
+        if record is None or record.analysis is None:
+            continue
+        block = '\n'.join(format_file_description(record.directory.root, record))
+        tokens = get_token_count(block)
+        if used + tokens > token_budget:
+            continue
+        blocks.append(block)
+        used += tokens
+    print(f"Retrieved {len(blocks)} relevant files ({used} tokens)")
+    return f"""\
+Only the files relevant to the question are described below. The folder list covers the whole repository.
+
+#### Folders (file count)
+{tree_text}
+
+#### Relevant files
+""" + '\n'.join(blocks)
+
+def build_check_system_prompt(structure_text):
+    """Build the system prompt checking the complexity and necessary files of an inquiry."""
+    return f"""\
 You are an expert engineer in system development and operations projects.
 Please check the content of the user's inquiry and confirm the complexity and necessary files.
 
@@ -136,11 +190,13 @@ Your response should include the following elements:
  Only **File paths** are required. Do not point Folder paths.
 
 ### Repository Structure
-{structure_with_description_text}
+{structure_text}
 
 """
 
-    system_prompt = f"""\
+def build_answer_system_prompt(structure_text):
+    """Build the system prompt answering an inquiry."""
+    return f"""\
 You are an expert engineer in system development and operations projects.
 Please respond to user inquiries about the attached repository structure in Japanese.
 
@@ -149,11 +205,176 @@ Your response should include the following elements:
 - recommend_web_search_keywords: Web search keywords to use if additional information is needed (if any)
 
 ### Repository Structure
-{structure_with_description_text}
+{structure_text}
 
 """
 
-    messages_ex_system_prompt = []
+class StreamingFieldPrinter:
+    """
+    Prints a string field of a streamed JSON response as it arrives.
+    Called with the JSON content received so far; only the new characters are decoded and printed.
+    """
+    def __init__(self, field):
+        self.pattern = re.compile(r'"' + re.escape(field) + r'"\s*:\s*"')
+        self.position = None
+        self.done = False
+        self.printed = False
+
+    def __call__(self, snapshot):
+        if self.done:
+            return
+        if self.position is None:
+            match = self.pattern.search(snapshot)
+            if not match:
+                return
+            self.position = match.end()
+        # Decode up to the last complete escape sequence, keeping surrogate pairs together
+        end = self.position
+        while end < len(snapshot):
+            c = snapshot[end]
+            if c == '"':
+                self.done = True
+                break
+            if c == '\\':
+                if end + 1 >= len(snapshot):
+                    break
+                if snapshot[end + 1] != 'u':
+                    end += 2
+                    continue
+                length = 12 if HIGH_SURROGATE_PATTERN.match(snapshot, end) else 6
+                if end + length > len(snapshot):
+                    break
+                end += length
+                continue
+            end += 1
+        if end > self.position:
+            print(json.loads('"' + snapshot[self.position:end] + '"'), end='', flush=True)
+            self.printed = True
+            self.position = end
+
+def summarize_conversation(summary, messages):
+    """Fold older chat messages into the running summary of the conversation."""
+    conversation = '\n\n'.join(f"[{message['role']}]\n{message['content']}" for message in messages)
+    summary_messages = [
+        {"role": "system", "content": """\
+You maintain the running summary of a conversation about a software repository.
+Update the current summary with the new messages, in Japanese and as concisely as possible.
+Keep the questions asked, the conclusions, the file paths, class and method names mentioned, and any open issues.
+"""},
+        {"role": "user", "content": f"### Current summary\n{summary or '(none)'}\n\n### New messages\n{conversation}"},
+    ]
+    completion, input_tokens, output_tokens = get_parsed_completion(summary_messages, ConversationSummary)
+    return completion.summary, input_tokens, output_tokens
+
+def generate_additional_system_prompt(file_paths, query, content_cache, token_budget=DEFAULT_FILE_TOKENS):
+    """
+    Generate additional system prompt with the contents of the files.
+    Files that do not fit in the token budget are sliced to the parts relevant to the query.
+    """
+    print("Try to confirm the following file paths:")
+    files = []
+    for file_path in file_paths:
+        print(f"  - {file_path}")
+        try:
+            files.append((file_path, content_cache.get(file_path)))
+        except FileNotFoundError:
+            files.append((file_path, "(現在このファイルは存在しません)"))
+        except (OSError, UnicodeDecodeError):
+            files.append((file_path, "(このファイルは読み取れません)"))
+
+    budgets = allocate_budget([entry[1] if isinstance(entry, tuple) else 0 for _, entry in files], token_budget)
+    additional_system_prompt = ""
+    for (file_path, entry), budget in zip(files, budgets):
+        if not isinstance(entry, tuple):
+            content = entry
+        elif entry[1] <= budget:
+            content = entry[0]
+        else:
+            content, used_tokens = slice_content(entry[2], query, budget)
+            print(f"    {os.path.basename(file_path)}: {used_tokens}/{entry[1]} tokens (relevant parts only)")
+        additional_system_prompt += f"### 参考情報 - {file_path}\n{content}\n"
+    return additional_system_prompt
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('analysis_path_file', nargs='?', help='分析パスファイル')
+    parser.add_argument('--context-tokens', type=int, default=DEFAULT_CONTEXT_TOKENS, help='1回の質問でプロンプトに含めるリポジトリ情報のトークン数上限')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help='1回の質問でプロンプトに含める関連ファイル数の上限')
+    parser.add_argument('--file-tokens', type=int, default=DEFAULT_FILE_TOKENS, help='1回の質問でプロンプトに含める元ファイル内容のトークン数上限')
+    parser.add_argument('--history-tokens', type=int, default=DEFAULT_HISTORY_TOKENS, help='プロンプトに含める会話履歴のトークン数上限（超えた分は要約）')
+    parser.add_argument('--history-turns', type=int, default=DEFAULT_HISTORY_TURNS, help='そのまま残す直近の会話数（それより前は要約）')
+    parser.add_argument('--no-stream', action='store_true', help='回答をストリーミングせず、すべて受信してから表示する')
+    parser.add_argument('--router', type=str, default='local', choices=ROUTER_MODES, help='確認すべきファイルの判定方法（local: ローカルで判定し、判断できない場合のみGPT / llm: 常にGPT）')
+    parser.add_argument('--impact-depth', type=int, default=DEFAULT_IMPACT_DEPTH, help='影響範囲の質問で依存グラフをたどる深さ')
+    parser.add_argument('--full-context', action='store_true', help='検索インデックスを使わず、常にリポジトリ全体の説明をプロンプトに含める')
+    parser.add_argument('--verbosity', type=int, default=VERBOSE, choices=VERBOSITY_LEVELS, help='表示の詳細度（2: 開始時にリポジトリ構成と説明を表示 / 1, 0: 表示しない）')
+    parser.add_argument('--metrics-dir', type=str, default=None, help='実行記録（JSON）と Prometheus テキストファイルの出力先（既定: <分析パス>/.repodoc/metrics）')
+    parser.add_argument('--no-metrics', action='store_true', help='実行記録・メトリクスを書き出さない')
+    parser.add_argument('--profile', type=str, default='', help='cProfile で計測するフェーズ（カンマ区切り、all: すべて）。結果は <metrics-dir>/profiles/ に出力')
+    args = parser.parse_args()
+
+    if args.analysis_path_file:
+        analysis_path_file = os.path.abspath(args.analysis_path_file)
+        with open(analysis_path_file, 'r', encoding='utf-8') as f:
+            analysis_path = f.read().strip()
+    else:
+        analysis_path = input("Enter the analysis path: ").strip()
+        analysis_path = os.path.abspath(analysis_path)
+
+    stats_final_filename = latest_stats_filename(os.path.join(analysis_path, REPODOC_FOLDER, STATS_FINAL_FILENAME),
+                                                 os.path.join(analysis_path, REPODOC_FOLDER, STATS_STORE_FILENAME))
+
+    # 実行記録: 会話ごとの経過時間・レイテンシ・トークン数を記録する
+    set_verbosity(args.verbosity)
+    metrics_dir = None if args.no_metrics else args.metrics_dir or os.path.join(analysis_path, REPODOC_FOLDER, METRICS_FOLDER)
+    run_metrics = start_run('chat', os.path.basename(analysis_path), [name.strip() for name in args.profile.split(',') if name.strip()],
+                            {'router': args.router, 'stream': not args.no_stream})
+
+    if not os.path.exists(stats_final_filename):
+        print(f"No saved stats file found at {stats_final_filename}: run analyze_repo.py first")
+        sys.exit(1)
+
+    stats = read_stats_from_file(stats_final_filename)
+    if args.verbosity >= VERBOSE:
+        echo("==== REPOSITORY STRUCTURE ====")
+        echo(format_structure(stats))
+        echo("==============================")
+
+    # リポジトリ全体の説明がトークン数上限を超える場合は、質問ごとに関連ファイルのみを検索してプロンプトに含める
+    # （説明全体を生成してトークン数を数えるのは大規模リポジトリで遅いため、解析結果の文字数から見積もる）
+    description_tokens = estimate_description_tokens(stats)
+    use_retrieval = not args.full_context and description_tokens > args.context_tokens
+    structure_with_description_text = None
+    if not use_retrieval or args.verbosity >= VERBOSE:
+        structure_with_description_text = format_structure_with_description(stats)
+        echo("==== REPOSITORY WITH DESCRIPTION STRUCTURE ====", level=VERBOSE)
+        echo(structure_with_description_text, level=VERBOSE)
+        echo("===============================================", level=VERBOSE)
+    if use_retrieval:
+        print(f"Repository description: about {description_tokens / 1000}k tokens (over --context-tokens)")
+    else:
+        print("ABOVE TEXT TOKEN SIZE(k): ", get_token_count(structure_with_description_text) / 1000)
+
+    retrieval_index_filename = os.path.join(analysis_path, REPODOC_FOLDER, RETRIEVAL_INDEX_FILENAME)
+    if use_retrieval:
+        retrieval_index = load_or_build_index(stats, stats_final_filename, retrieval_index_filename)
+    dependency_graph = load_or_build_graph(stats, stats_final_filename,
+                                           os.path.join(analysis_path, REPODOC_FOLDER, DEPENDENCY_GRAPH_FILENAME))
+    print(f"Dependency graph: {dependency_graph.num_edges} references between files")
+
+    router = QueryRouter(stats, dependency_graph, args.impact_depth)
+    content_cache = FileContentCache(get_token_count)
+    route_log_filename = os.path.join(analysis_path, REPODOC_FOLDER, CHAT_ROUTE_LOG_FILENAME)
+
+    print("Let's start a new chat!")
+    if use_retrieval:
+        print(f"Answering from the retrieval index ({retrieval_index_filename})")
+    else:
+        check_system_prompt = build_check_system_prompt(structure_with_description_text)
+        system_prompt = build_answer_system_prompt(structure_with_description_text)
+
+    memory = ConversationMemory(get_token_count, summarize_conversation, args.history_tokens, args.history_turns)
 
     total_input_tokens = 0
     total_output_tokens = 0
@@ -165,57 +386,93 @@ Your response should include the following elements:
         if user_input in ['n', 'ｎ', 'Ｎ', 'N']:
             print("Goodbye!")
             break
-                
-        check_messages = [
-            {"role": "system", "content": check_system_prompt},
-        ]
-
-        for message in messages_ex_system_prompt:
-            check_messages.append(message)
-        check_messages.append({"role": "user", "content": user_input})
-
-        completion, input_tokens, output_tokens = get_parsed_completion(check_messages, CheckRequest)
-        total_input_tokens += input_tokens
-        total_output_tokens += output_tokens
 
-        complex_level = completion.complex_level
-
-        print("COMPLEX LEVEL = ", complex_level)
+        turn_started = time.perf_counter()
+        input_tokens_before, output_tokens_before = total_input_tokens, total_output_tokens
+        with phase('chat_turn'):
+            if use_retrieval:
+                # 直前の質問も検索語に含め、続けての質問でも関連ファイルを引き継ぐ
+                previous_inputs = [message['content'] for message in memory.messages() if message['role'] == 'user'][-1:]
+                query = '\n'.join(previous_inputs + [user_input])
+                with phase('chat_retrieval'):
+                    retrieval_text = build_retrieval_context(stats, retrieval_index, query, args.context_tokens, args.top_k)
+                check_system_prompt = build_check_system_prompt(retrieval_text)
+                system_prompt = build_answer_system_prompt(retrieval_text)
+
+            if args.router == 'local':
+                decision = router.route(user_input)
+                reason = 'ambiguous for the local router'
+            else:
+                decision = None
+                reason = 'local router disabled'
+
+            if decision is None:
+                # ローカルで判断できない質問のみ、GPTで複雑度と確認すべきファイルを判定する
+                started = time.perf_counter()
+                check_messages = [
+                    {"role": "system", "content": check_system_prompt},
+                ]
+
+                for message in memory.messages():
+                    check_messages.append(message)
+                check_messages.append({"role": "user", "content": user_input})
+
+                completion, input_tokens, output_tokens = get_parsed_completion(check_messages, CheckRequest)
+                total_input_tokens += input_tokens
+                total_output_tokens += output_tokens
+
+                need_files = completion.complex_level in [1, 3, 4]
+                file_paths = completion.need_file_confirmation if need_files else []
+                if completion.complex_level == 4:
+                    # 影響範囲の調査は、GPTが挙げたファイルから依存グラフをたどって補う
+                    impacted = dependency_graph.impacted(file_paths, args.impact_depth)
+                    file_paths = list(dict.fromkeys(file_paths + [path for path, _ in impacted]))[:max(MAX_ROUTED_FILES, len(file_paths))]
+                decision = RouteDecision(need_files, file_paths, completion.complex_level,
+                                         'llm', reason, time.perf_counter() - started)
+
+            log_route(route_log_filename, user_input, decision)
+            print("COMPLEX LEVEL = ", decision.complex_level)
+
+            with phase('chat_files'):
+                additional_system_prompt = generate_additional_system_prompt(decision.file_paths, user_input, content_cache, args.file_tokens) if decision.need_files else ""
 
-        if complex_level == 0 or complex_level == 2:
-            new_messages = [{"role": "system", "content": system_prompt}]
-            for message in messages_ex_system_prompt:
+            new_messages = [{"role": "system", "content": system_prompt + additional_system_prompt}]
+            for message in memory.messages():
                 new_messages.append(message)
             new_messages.append({"role": "user", "content": user_input})
-            completion, input_tokens, output_tokens = get_parsed_completion(new_messages, AnalyzeComment)
+            answer_started = time.perf_counter()
+            first_token_latency = None
+            if args.no_stream:
+                completion, input_tokens, output_tokens = get_parsed_completion(new_messages, AnalyzeComment)
+                print("==============================")
+                print(completion.answer)
+            else:
+                # 回答は届いた分から順に表示し、検索キーワードは最後にまとめて受け取る
+                print("==============================")
+                answer_printer = StreamingFieldPrinter('answer')
+                completion, input_tokens, output_tokens, first_token_latency = get_streamed_parsed_completion(
+                    new_messages, AnalyzeComment, on_content=answer_printer)
+                if answer_printer.printed:
+                    print()
+                else:
+                    print(completion.answer)
+                print(f"* Latency: first token {first_token_latency or 0:.2f}s / total {time.perf_counter() - answer_started:.2f}s")
+            answer_latency = time.perf_counter() - answer_started
             total_input_tokens += input_tokens
             total_output_tokens += output_tokens
 
-            messages_ex_system_prompt.append({"role": "user", "content": user_input})
-            messages_ex_system_prompt.append({"role": "assistant", "content": completion.answer})
-
-            print("==============================")
-            print(completion.answer)
-
             if completion.recommend_web_search_keywords:
                 print("* Recommend Web Search Keywords: ", completion.recommend_web_search_keywords)
 
-        if complex_level == 1 or complex_level == 3 or complex_level == 4:
-            additional_system_prompt = generate_additional_system_prompt(completion.need_file_confirmation)
-            
-            new_messages = [{"role": "system", "content": system_prompt + additional_system_prompt}]
-            for message in messages_ex_system_prompt:
-                new_messages.append(message)
-            new_messages.append({"role": "user", "content": user_input})
-            completion, input_tokens, output_tokens = get_parsed_completion(new_messages, AnalyzeComment)
+            # 古い会話は要約にまとめ、履歴をトークン数上限内に保つ
+            input_tokens, output_tokens = memory.add_turn(user_input, completion.answer)
             total_input_tokens += input_tokens
             total_output_tokens += output_tokens
 
-            messages_ex_system_prompt.append({"role": "user", "content": user_input})
-            messages_ex_system_prompt.append({"role": "assistant", "content": completion.answer})
-
-            print("==============================")
-            print(completion.answer)
-
-            if completion.recommend_web_search_keywords:
-                print("* Recommend Web Search Keywords: ", completion.recommend_web_search_keywords)
\ No newline at end of file
+        record_turn(route=decision.source, complex_level=decision.complex_level, files=len(decision.file_paths) if decision.need_files else 0,
+                    route_latency=decision.latency, first_token_latency=first_token_latency, answer_latency=answer_latency,
+                    latency=time.perf_counter() - turn_started,
+                    input_tokens=total_input_tokens - input_tokens_before, output_tokens=total_output_tokens - output_tokens_before)
+        if metrics_dir:
+            # 会話を終えずに閉じても記録が残るよう、1回ごとに書き出す
+            run_metrics.write(metrics_dir)
@@ -0,0 +1,155 @@
+import os
+import re
+import zlib
+
+BRACE_LANGUAGE_EXTENSIONS = {
+    '.java', '.kt', '.kts', '.scala', '.groovy', '.gradle', '.c', '.h', '.cc', '.cpp', '.hpp', '.cs',
+    '.js', '.jsx', '.ts', '.tsx', '.go', '.rs', '.swift', '.php', '.dart',
+}
+MARKDOWN_EXTENSIONS = {'.md', '.markdown', '.rst', '.txt'}
+SQL_EXTENSIONS = {'.sql'}
+PYTHON_EXTENSIONS = {'.py', '.pyi'}
+
+CHUNK_ANCHOR_MODULUS = 4
+
+PYTHON_BOUNDARY = re.compile(r'^(?:async\s+def|def|class)\s|^@')
+PYTHON_METHOD_BOUNDARY = re.compile(r'^\s{1,8}(?:async\s+def|def)\s|^\s{1,8}@')
+
+def _boundaries_python(lines):
+    starts = set()
+    for index, line in enumerate(lines):
+        if PYTHON_BOUNDARY.match(line) or PYTHON_METHOD_BOUNDARY.match(line):
+            # Decorators belong to the definition below them
+            if index > 0 and lines[index - 1].lstrip().startswith('@'):
+                continue
+            starts.add(index)
+    return starts
+
+def _boundaries_braces(lines):
+    # Class members start where the brace depth is back at the top or class level
+    starts = set()
+    depth = 0
+    previous_closed = True
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if depth <= 1 and stripped and previous_closed:
+            starts.add(index)
+        code = re.sub(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|//.*', '', line)
+        depth = max(0, depth + code.count('{') - code.count('}'))
+        if stripped:
+            previous_closed = depth <= 1 and (stripped.endswith('}') or stripped.endswith(';') or stripped.endswith('{'))
+    return starts
+
+def _boundaries_markdown(lines):
+    return {index for index, line in enumerate(lines) if re.match(r'^#{1,3}\s', line)}
+
+def _boundaries_sql(lines):
+    return {index + 1 for index, line in enumerate(lines) if line.rstrip().endswith(';')}
+
+def _boundaries_blank(lines):
+    return {index + 1 for index, line in enumerate(lines) if not line.strip()}
+
+def split_segments(content, file_name):
+    """
+    Splits the content into segments along syntax-aware boundaries
+    (classes/methods for code, sections for documents, statements for SQL).
+
+    Returns:
+        list[tuple]: (first line number, last line number, text), 1-based and inclusive.
+    """
+
+    lines = content.splitlines(keepends=True)
+    if not lines:
+        return []
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in PYTHON_EXTENSIONS:
+        starts = _boundaries_python(lines)
+    elif ext in BRACE_LANGUAGE_EXTENSIONS:
+        starts = _boundaries_braces(lines)
+    elif ext in MARKDOWN_EXTENSIONS:
+        starts = _boundaries_markdown(lines)
+    elif ext in SQL_EXTENSIONS:
+        starts = _boundaries_sql(lines)
+    else:
+        starts = _boundaries_blank(lines)
+    starts = sorted(start for start in starts | {0} if start < len(lines))
+
+    segments = []
+    for begin, end in zip(starts, starts[1:] + [len(lines)]):
+        segments.append((begin + 1, end, ''.join(lines[begin:end])))
+    return segments
+
+def _split_oversized(segment, max_tokens, count_tokens):
+    first, last, text = segment
+    lines = text.splitlines(keepends=True)
+    pieces = []
+    begin = 0
+    current = []
+    current_tokens = 0
+    for offset, line in enumerate(lines):
+        line_tokens = count_tokens(line)
+        if current and current_tokens + line_tokens > max_tokens:
+            pieces.append((first + begin, first + offset - 1, ''.join(current)))
+            begin, current, current_tokens = offset, [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        pieces.append((first + begin, last, ''.join(current)))
+    return pieces
+
+def chunk_content(content, file_name, max_tokens, count_tokens):
+    """
+    Packs consecutive segments of the content into chunks of at most `max_tokens` tokens.
+    A segment larger than the budget is split by lines.
+
+    Besides the budget, a chunk that is at least half full also ends after a segment whose
+    content hash is a multiple of CHUNK_ANCHOR_MODULUS. These content-defined cut points keep
+    the chunks after an edited segment unchanged, so their cached analyses stay valid.
+
+    Args:
+        content (str): File content.
+        file_name (str): File name, used to pick the boundaries.
+        max_tokens (int): Token budget per chunk.
+        count_tokens (Callable): Function returning the token count of a text.
+
+    Returns:
+        list[tuple]: (first line number, last line number, text) of each chunk.
+    """
+
+    chunks = []
+    current = None
+    current_tokens = 0
+    for segment in split_segments(content, file_name):
+        segment_tokens = count_tokens(segment[2])
+        pieces = [segment] if segment_tokens <= max_tokens else _split_oversized(segment, max_tokens, count_tokens)
+        for piece in pieces:
+            piece_tokens = segment_tokens if len(pieces) == 1 else count_tokens(piece[2])
+            if current and current_tokens + piece_tokens <= max_tokens:
+                current = (current[0], piece[1], current[2] + piece[2])
+                current_tokens += piece_tokens
+            else:
+                if current:
+                    chunks.append(current)
+                current = piece
+                current_tokens = piece_tokens
+            if current_tokens * 2 >= max_tokens and zlib.crc32(piece[2].encode('utf-8')) % CHUNK_ANCHOR_MODULUS == 0:
+                chunks.append(current)
+                current = None
+                current_tokens = 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def merge_unique(lists):
+    """
+    Concatenates lists, dropping duplicates while keeping the first occurrence order.
+    """
+
+    seen = set()
+    merged = []
+    for items in lists:
+        for item in items:
+            if item not in seen:
+                seen.add(item)
+                merged.append(item)
+    return merged
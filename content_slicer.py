@@ -0,0 +1,101 @@
+import math
+import os
+from collections import Counter
+
+from chunking import chunk_content
+from retrieval_index import tokenize
+
+SLICE_TOKENS = 400
+
+class FileContentCache:
+    """
+    Session cache of file contents, split into slices with their token counts.
+
+    An entry is reused while the size and modification time of the file are unchanged,
+    so follow-up questions about the same files do not read or split them again.
+    """
+
+    def __init__(self, count_tokens, slice_tokens=SLICE_TOKENS):
+        self.count_tokens = count_tokens
+        self.slice_tokens = slice_tokens
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """
+        Returns (content, token count, slices) of the file, where slices is a list of
+        (first line, last line, text, token count). Raises OSError if it cannot be read.
+        """
+
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        slices = [(first, last, text, self.count_tokens(text))
+                  for first, last, text in chunk_content(content, os.path.basename(path), self.slice_tokens, self.count_tokens)]
+        value = (content, sum(slice[3] for slice in slices), slices)
+        self._entries[path] = (signature, value)
+        return value
+
+def slice_content(slices, query, token_budget):
+    """
+    Selects the slices of a file most relevant to the query within the token budget.
+
+    Slices are scored by the query terms they contain, weighted by how rare each term
+    is among the slices of the file. The first slice (package, imports, class
+    declaration) is kept for orientation; the selection is rendered in line order
+    with the omitted line ranges marked.
+    """
+
+    if not slices:
+        return '', 0
+
+    query_terms = set(tokenize(query))
+    slice_terms = [query_terms.intersection(tokenize(text)) for _, _, text, _ in slices]
+    document_frequency = Counter(term for terms in slice_terms for term in terms)
+    weights = {term: math.log(1 + len(slices) / count) for term, count in document_frequency.items()}
+    ranked = sorted(range(1, len(slices)), key=lambda i: (-sum(weights[term] for term in slice_terms[i]), i))
+
+    selected = set()
+    used = 0
+    for i in [0] + ranked:
+        tokens = slices[i][3]
+        if used + tokens > token_budget:
+            continue
+        selected.add(i)
+        used += tokens
+
+    parts = []
+    next_line = 1
+    for i in sorted(selected):
+        first, last, text, _ = slices[i]
+        if first > next_line:
+            parts.append(f"... (lines {next_line}-{first - 1} omitted)\n")
+        parts.append(text if text.endswith('\n') else text + '\n')
+        next_line = last + 1
+    if slices and next_line <= slices[-1][1]:
+        parts.append(f"... (lines {next_line}-{slices[-1][1]} omitted)\n")
+    return ''.join(parts), used
+
+def allocate_budget(sizes, token_budget):
+    """
+    Splits the token budget among files of the given token sizes: files smaller than an
+    even share take only what they need, and the rest is shared by the larger ones.
+    """
+
+    budgets = [0] * len(sizes)
+    remaining = token_budget
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        i = pending.pop(0)
+        budgets[i] = min(sizes[i], share)
+        remaining -= budgets[i]
+    return budgets
@@ -0,0 +1,127 @@
+import os
+import re
+
+CONTEXT_STRATEGIES = ['full', 'scoped']
+DEFAULT_CONTEXT_TOKENS = 2000
+
+IMPORT_PATTERNS = [
+    re.compile(r'^\s*import\s+(?:static\s+)?([\w.]+)', re.MULTILINE),                  # Java, Kotlin, Python
+    re.compile(r'^\s*from\s+([\w.]+)\s+import\s', re.MULTILINE),                      # Python
+    re.compile(r'''(?:require\(|from\s+|import\s+)['"]([^'"]+)['"]'''),                 # JavaScript, TypeScript
+    re.compile(r'^\s*#\s*include\s+["<]([^">]+)[">]', re.MULTILINE),                  # C, C++
+    re.compile(r'((?:[\w.-]+/)+[\w-]+\.\w+)'),                                       # paths in scripts and configs
+]
+
+def extract_import_hints(content):
+    """
+    Extracts the imported module paths of the content as '/' separated fragments,
+    e.g. 'jp/hogehoge/back/BackService' for `import jp.hogehoge.back.BackService;`.
+    """
+
+    hints = set()
+    for pattern in IMPORT_PATTERNS:
+        for match in pattern.finditer(content):
+            fragment = match.group(1).strip('./')
+            if not fragment:
+                continue
+            if '/' not in fragment:
+                fragment = fragment.replace('.', '/')
+            hints.add(os.path.splitext(fragment)[0] if '/' in fragment else fragment)
+    return hints
+
+class StructureContext:
+    """
+    Builds a structure text scoped to one file, instead of the tree of the whole repository.
+
+    Directories are added in priority order until the token budget is used: the file's
+    own directory, its ancestors, the directories of the files matching its imports,
+    then its sibling directories. The rest of the tree is summarized as file and
+    directory counts per top-level directory.
+    """
+
+    def __init__(self, repo, token_budget, count_tokens):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.root = repo.directories[0].root if repo.directories else ''
+        self._order = {}
+        self._lines = {}
+        self._tokens = {}
+        self._children = {}
+        self._stems = {}
+        self._top_level = {}
+        self._file_counts = {}
+        for position, directory in enumerate(repo.directories):
+            rel_root = self._relative(directory.root)
+            self._order[directory.root] = position
+            self._lines[directory.root] = f"{rel_root}/: {', '.join(record.name for record in directory.files)}" if directory.files else f"{rel_root}/"
+            self._children.setdefault(os.path.dirname(directory.root), []).append(directory.root)
+            self._file_counts[directory.root] = len(directory.files)
+            for record in directory.files:
+                self._stems.setdefault(os.path.splitext(record.name)[0], []).append(record)
+            top = rel_root.split('/')[0]
+            counts = self._top_level.setdefault(top, [0, 0])
+            counts[0] += len(directory.files)
+            counts[1] += 1
+
+    def _relative(self, path):
+        rel_path = os.path.relpath(path, self.root).replace(os.sep, '/')
+        return '.' if rel_path == '.' else rel_path
+
+    def _line_tokens(self, root):
+        tokens = self._tokens.get(root)
+        if tokens is None:
+            tokens = self._tokens[root] = self.count_tokens(self._lines[root]) + 1
+        return tokens
+
+    def _import_directories(self, content):
+        directories = []
+        for hint in extract_import_hints(content):
+            stem = hint.rsplit('/', 1)[-1]
+            for record in self._stems.get(stem, []):
+                rel_path = self._relative(os.path.splitext(record.path)[0])
+                if rel_path.endswith(hint) or '/' not in hint:
+                    directories.append(record.directory.root)
+        return directories
+
+    def build(self, file_path, content):
+        """
+        Returns the scoped structure text for the file.
+        """
+
+        own = os.path.dirname(file_path)
+        candidates = [own]
+        ancestor = own
+        while ancestor != self.root and os.path.dirname(ancestor) != ancestor:
+            ancestor = os.path.dirname(ancestor)
+            candidates.append(ancestor)
+        candidates += self._import_directories(content)
+        candidates += self._children.get(os.path.dirname(own), [])
+        candidates += self._children.get(own, [])
+
+        selected = set()
+        used = 0
+        for root in candidates:
+            if root in selected or root not in self._lines:
+                continue
+            tokens = self._line_tokens(root)
+            if used + tokens > self.token_budget and selected:
+                continue
+            selected.add(root)
+            used += tokens
+
+        lines = [self._lines[root] for root in sorted(selected, key=self._order.get)]
+        shown = {}
+        for root in selected:
+            if root != self.root:
+                counts = shown.setdefault(self._relative(root).split('/')[0], [0, 0])
+                counts[0] += self._file_counts[root]
+                counts[1] += 1
+        others = []
+        for top, (num_files, num_dirs) in self._top_level.items():
+            shown_files, shown_dirs = shown.get(top, (0, 0))
+            if top != '.' and num_dirs > shown_dirs:
+                others.append(f"{top}/ ({num_files - shown_files} files in {num_dirs - shown_dirs} dirs)")
+        if others:
+            lines.append("")
+            lines.append("Not shown above (file count): " + ', '.join(others))
+        return '\n'.join(lines)
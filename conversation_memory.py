@@ -0,0 +1,67 @@
+DEFAULT_HISTORY_TOKENS = 4000
+DEFAULT_HISTORY_TURNS = 4
+
+class ConversationMemory:
+    """
+    Token-budgeted chat history: the last turns verbatim, older turns folded into a running summary.
+
+    The token count of each message is computed once when the turn is added. When
+    more than `keep_turns` turns are kept, or the history exceeds `token_budget`, the
+    oldest turns are folded into the summary with `summarize(summary, messages)`,
+    which returns (new summary, input tokens, output tokens). The most recent turn is
+    always kept verbatim.
+    """
+
+    def __init__(self, count_tokens, summarize, token_budget=DEFAULT_HISTORY_TOKENS, keep_turns=DEFAULT_HISTORY_TURNS):
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.summary = ''
+        self.summary_tokens = 0
+        self._turns = []
+        self._turn_tokens = []
+
+    @property
+    def tokens(self):
+        """Token count of the history sent with each request."""
+        return self.summary_tokens + sum(self._turn_tokens)
+
+    def add_turn(self, user_content, assistant_content):
+        """
+        Adds a question and its answer, folding older turns into the summary if needed.
+
+        Returns:
+            tuple: Input and output tokens spent on summarizing.
+        """
+
+        turn = [
+            {"role": "user", "content": user_content},
+            {"role": "assistant", "content": assistant_content},
+        ]
+        self._turns.append(turn)
+        self._turn_tokens.append(sum(self.count_tokens(message['content']) for message in turn))
+
+        fold = max(0, len(self._turns) - self.keep_turns)
+        tokens = self.tokens - sum(self._turn_tokens[:fold])
+        while fold < len(self._turns) - 1 and tokens > self.token_budget:
+            tokens -= self._turn_tokens[fold]
+            fold += 1
+        if not fold:
+            return 0, 0
+
+        folded = [message for turn in self._turns[:fold] for message in turn]
+        self.summary, input_tokens, output_tokens = self.summarize(self.summary, folded)
+        self.summary_tokens = self.count_tokens(self.summary)
+        del self._turns[:fold]
+        del self._turn_tokens[:fold]
+        return input_tokens, output_tokens
+
+    def messages(self):
+        """Returns the history messages to send before the new question."""
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"### これまでの会話の要約\n{self.summary}"})
+        for turn in self._turns:
+            messages.extend(turn)
+        return messages
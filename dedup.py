@@ -0,0 +1,94 @@
+import hashlib
+import re
+
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 0.0
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+# 16 bands of 4 rows: pairs with a similarity above about 0.5 share a band and are compared
+LSH_BANDS = 16
+# Files with fewer shingles are too short for a meaningful similarity: only exact copies are grouped
+MIN_SHINGLES = 20
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+def shingles(content):
+    """
+    Returns the 64-bit hashes of the SHINGLE_SIZE-token shingles of the content (whitespace is not significant).
+    """
+
+    tokens = TOKEN_PATTERN.findall(content)
+    return {int.from_bytes(hashlib.blake2b(' '.join(tokens[index:index + SHINGLE_SIZE]).encode('utf-8'), digest_size=8).digest(), 'little')
+            for index in range(max(len(tokens) - SHINGLE_SIZE + 1, 0))}
+
+def minhash(shingle_hashes):
+    """
+    Returns the MinHash signature of a set of shingle hashes, computed in one pass
+    (one-permutation MinHash): the hash space is split into MINHASH_PERMUTATIONS bins
+    and each bin keeps its minimum. An empty bin borrows the value of the next
+    non-empty bin, tagged with the distance, so that signatures stay comparable bin by bin.
+    """
+
+    bins = [None] * MINHASH_PERMUTATIONS
+    for value in shingle_hashes:
+        index, rest = value % MINHASH_PERMUTATIONS, value // MINHASH_PERMUTATIONS
+        if bins[index] is None or rest < bins[index]:
+            bins[index] = rest
+    if all(value is None for value in bins):
+        return tuple(bins)
+    signature = []
+    for index in range(MINHASH_PERMUTATIONS):
+        distance = 0
+        while bins[(index + distance) % MINHASH_PERMUTATIONS] is None:
+            distance += 1
+        signature.append((bins[(index + distance) % MINHASH_PERMUTATIONS], distance))
+    return tuple(signature)
+
+def estimated_similarity(signature, other):
+    """
+    Estimates the Jaccard similarity of the shingles of two files from their signatures.
+    """
+
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+def find_duplicate_groups(contents, threshold=DEFAULT_NEAR_DUPLICATE_THRESHOLD):
+    """
+    Groups identical contents, and with threshold > 0 near-identical contents whose
+    estimated Jaccard similarity of token shingles is at least `threshold`.
+
+    Candidates are found with locality-sensitive hashing over bands of the MinHash
+    signatures, then checked against the representative of a group: a content joins
+    the first earlier representative it is similar enough to, so groups do not drift
+    through chains of small differences.
+
+    Returns:
+        list[list[tuple]]: Groups of at least two (index, similarity to the representative)
+        pairs, the representative (the first index of the group, similarity 1.0) first.
+    """
+
+    exact = {}
+    for index, content in enumerate(contents):
+        exact.setdefault(hashlib.sha256(content.encode('utf-8')).digest(), []).append(index)
+    groups = {indexes[0]: [(index, 1.0) for index in indexes] for indexes in exact.values()}
+
+    if threshold > 0:
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        buckets = {}
+        signatures = {}
+        for first in sorted(groups):
+            shingle_hashes = shingles(contents[first])
+            if len(shingle_hashes) < MIN_SHINGLES:
+                continue
+            signature = minhash(shingle_hashes)
+            bands = [(band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+            candidates = sorted({representative for key in bands for representative in buckets.get(key, ())})
+            for representative in candidates:
+                similarity = estimated_similarity(signature, signatures[representative])
+                if similarity >= threshold:
+                    groups[representative] += [(index, similarity) for index, _ in groups.pop(first)]
+                    break
+            else:
+                signatures[first] = signature
+                for key in bands:
+                    buckets.setdefault(key, []).append(first)
+
+    return [group for _, group in sorted(groups.items()) if len(group) > 1]
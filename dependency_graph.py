@@ -0,0 +1,202 @@
+import json
+import os
+import re
+from collections import deque
+
+from retrieval_index import source_signature
+
+DEPENDENCY_GRAPH_FILENAME = 'dependency_graph.json'
+DEPENDENCY_GRAPH_VERSION = 1
+DEFAULT_IMPACT_DEPTH = 2
+# A reference whose last name matches more files than this is too ambiguous to resolve
+MAX_REFERENCE_CANDIDATES = 3
+REFERENCE_SPLIT_PATTERN = re.compile(r'[/\\.:#()\s,<>]+')
+
+class ReferenceResolver:
+    """
+    Resolves the free-text references of analyses ('jp.hogehoge.back.BackService',
+    'BackService.java', 'src/main.py', 'BackService.save()', ...) to file paths.
+
+    The last name of the reference matching a file name stem gives the candidates;
+    the names before it (package or directories) narrow them down to the files whose
+    relative path ends with them. Names matching too many files resolve to nothing.
+    """
+
+    def __init__(self, paths, root):
+        self._stems = {}
+        self._module_paths = {}
+        for path in paths:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            self._stems.setdefault(stem, []).append(path)
+            self._module_paths[path] = '/' + os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, '/')
+
+    def resolve(self, ref):
+        pieces = [piece for piece in REFERENCE_SPLIT_PATTERN.split(ref) if piece]
+        for position in range(len(pieces) - 1, -1, -1):
+            candidates = self._stems.get(pieces[position])
+            if not candidates:
+                continue
+            if position:
+                suffix = '/' + '/'.join(pieces[:position + 1])
+                narrowed = [path for path in candidates if self._module_paths[path].endswith(suffix)]
+                if narrowed:
+                    return narrowed
+            if len(candidates) <= MAX_REFERENCE_CANDIDATES:
+                return candidates
+            return []
+        return []
+
+class DependencyGraph:
+    """
+    Adjacency index of the files of a repository: forward[path] is the set of files
+    it references (its dependencies), reverse[path] the set of files referencing it
+    (its dependents).
+
+    The graph is built from the `references` of the analyses after an analysis run
+    and saved under .repodoc/, with the signature of the stats file it was built from.
+    """
+
+    def __init__(self, forward=None, source=None):
+        self.forward = {}
+        self.reverse = {}
+        self.source = source
+        for path, targets in (forward or {}).items():
+            for target in targets:
+                self.add_edge(path, target)
+
+    def add_edge(self, path, target):
+        if target == path:
+            return
+        self.forward.setdefault(path, set()).add(target)
+        self.reverse.setdefault(target, set()).add(path)
+
+    def add_references(self, path, references, resolver):
+        """
+        Adds the edges from the file to the files its reference strings resolve to.
+        """
+
+        for ref in references:
+            for target in resolver.resolve(ref):
+                self.add_edge(path, target)
+
+    @classmethod
+    def build(cls, repo, source=None):
+        """
+        Builds the graph from the references of the analyzed files of the repository.
+        """
+
+        root = repo.directories[0].root if repo.directories else ''
+        records = list(repo.iter_files())
+        resolver = ReferenceResolver([record.path for record in records], root)
+        graph = cls(source=source)
+        for record in records:
+            if isinstance(record.analysis, dict):
+                graph.add_references(record.path, record.analysis.get('references', []), resolver)
+        return graph
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != DEPENDENCY_GRAPH_VERSION:
+            raise ValueError(f"Unsupported dependency graph version: {data.get('version')}")
+        return cls(data['forward'], data.get('source'))
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            json.dump({
+                'version': DEPENDENCY_GRAPH_VERSION,
+                'source': self.source,
+                'forward': {path: sorted(targets) for path, targets in sorted(self.forward.items())},
+                'reverse': {path: sorted(sources) for path, sources in sorted(self.reverse.items())},
+            }, file, ensure_ascii=False)
+        os.replace(temp_filename, filename)
+
+    @property
+    def num_edges(self):
+        return sum(len(targets) for targets in self.forward.values())
+
+    def impacted(self, paths, depth=DEFAULT_IMPACT_DEPTH, direction='both'):
+        """
+        Traverses the graph from the given files up to `depth` edges away.
+
+        Args:
+            paths (list[str]): Files to start from.
+            depth (int): Maximum number of edges from a start file.
+            direction (str): 'dependents' (reverse edges), 'dependencies' (forward edges) or 'both'.
+
+        Returns:
+            list[tuple]: (path, distance) of the reached files other than the start files,
+            nearest first, dependents before dependencies at the same distance.
+        """
+
+        adjacency = []
+        if direction in ('dependents', 'both'):
+            adjacency.append(self.reverse)
+        if direction in ('dependencies', 'both'):
+            adjacency.append(self.forward)
+
+        distances = {path: 0 for path in paths}
+        queue = deque(paths)
+        reached = []
+        while queue:
+            path = queue.popleft()
+            distance = distances[path]
+            if distance >= depth:
+                continue
+            for edges in adjacency:
+                for neighbor in sorted(edges.get(path, ())):
+                    if neighbor not in distances:
+                        distances[neighbor] = distance + 1
+                        reached.append((neighbor, distance + 1))
+                        queue.append(neighbor)
+        return reached
+
+    def dependency_order(self, paths):
+        """
+        Orders the files so that each one comes after the files it depends on, among the given files.
+
+        Files in a dependency cycle keep their relative order in `paths` once nothing
+        outside the cycle is left to come first.
+        """
+
+        position = {path: index for index, path in enumerate(paths)}
+        remaining = {path: len(self.forward.get(path, set()).intersection(position)) for path in paths}
+        ready = sorted((path for path, count in remaining.items() if not count), key=position.get)
+        ordered = []
+        while len(ordered) < len(paths):
+            if not ready:
+                # Cycle: release the first remaining file in the original order
+                ready = [min((path for path, count in remaining.items() if count), key=position.get)]
+                remaining[ready[0]] = 0
+            path = ready.pop(0)
+            ordered.append(path)
+            remaining.pop(path)
+            released = []
+            for dependent in self.reverse.get(path, ()):
+                if remaining.get(dependent):
+                    remaining[dependent] -= 1
+                    if not remaining[dependent]:
+                        released.append(dependent)
+            if released:
+                ready = sorted(ready + released, key=position.get)
+        return ordered
+
+def load_or_build_graph(repo, stats_filename, graph_filename):
+    """
+    Loads the dependency graph of the stats file, or builds and saves it if missing or stale.
+    """
+
+    source = source_signature(stats_filename)
+    if os.path.exists(graph_filename):
+        try:
+            graph = DependencyGraph.load(graph_filename)
+            if graph.source == source:
+                return graph
+        except (OSError, ValueError, KeyError):
+            pass
+    graph = DependencyGraph.build(repo, source)
+    graph.save(graph_filename)
+    return graph
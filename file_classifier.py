@@ -0,0 +1,123 @@
+import codecs
+import fnmatch
+import mmap
+import os
+import re
+
+from repo_model import SKIPPED_BINARY, SKIPPED_LARGE, SKIPPED_GENERATED
+
+DEFAULT_MAX_FILE_BYTES = 1024 * 1024
+SNIFF_BYTES = 8192
+# Share of control bytes above which a sample without NUL bytes is still considered binary
+MAX_CONTROL_RATIO = 0.1
+MINIFIED_LINE_LENGTH = 1000
+
+BINARY_SIGNATURES = [
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF87a', b'GIF89a', b'BM', b'II*\x00', b'MM\x00*', b'RIFF', b'\x00\x00\x01\x00',
+    b'%PDF', b'PK\x03\x04', b'PK\x05\x06', b'\x1f\x8b', b'BZh', b'\xfd7zXZ', b'7z\xbc\xaf', b'Rar!',
+    b'\x7fELF', b'MZ', b'\xca\xfe\xba\xbe', b'\xcf\xfa\xed\xfe', b'\xce\xfa\xed\xfe', b'\x00asm',
+    b'SQLite format 3\x00', b'\xd0\xcf\x11\xe0', b'OggS', b'fLaC', b'ID3', b'\x1aE\xdf\xa3', b'wOFF', b'wOF2',
+]
+BINARY_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.icns', '.tif', '.tiff', '.webp', '.psd',
+    '.pdf', '.zip', '.jar', '.war', '.ear', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.class', '.exe', '.dll', '.so', '.dylib', '.o', '.a', '.lib', '.pyc', '.pyo', '.wasm',
+    '.mp3', '.mp4', '.wav', '.ogg', '.flac', '.mov', '.avi', '.mkv', '.webm',
+    '.ttf', '.otf', '.woff', '.woff2', '.eot', '.sqlite', '.db', '.xls', '.xlsx', '.doc', '.docx', '.ppt', '.pptx',
+}
+CONTROL_BYTES = bytes(range(0, 8)) + bytes(range(14, 32)) + b'\x7f'
+
+GENERATED_NAME_PATTERNS = [
+    '*.min.js', '*.min.mjs', '*.min.css', '*.map', '*-min.js', '*.bundle.js', '*.chunk.js',
+    '*.pb.go', '*_pb2.py', '*_pb2_grpc.py', '*.pb.h', '*.pb.cc', '*.g.dart', '*.freezed.dart',
+    '*.designer.cs', '*.Designer.cs', '*.g.cs', '*.generated.*', '*_generated.*',
+]
+VENDORED_DIRECTORIES = {'node_modules', 'vendor', 'bower_components'}
+GENERATED_MARKER_PATTERN = re.compile(
+    rb'@generated|Code generated .{0,80}DO NOT EDIT|<auto-generated|auto-generated by|automatically generated by|'
+    rb'This file (?:is|was) (?:auto(?:matically)?-?)generated|DO NOT EDIT[^\n]{0,40}generated',
+    re.IGNORECASE)
+MINIFIABLE_EXTENSIONS = {'.js', '.mjs', '.cjs', '.css'}
+
+def read_head(path, size):
+    """
+    Reads the first SNIFF_BYTES bytes of the file, through mmap when possible.
+    """
+
+    length = min(size, SNIFF_BYTES)
+    with open(path, 'rb') as file:
+        if length <= 0:
+            return b''
+        try:
+            with mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:length]
+        except (OSError, ValueError):
+            # Special files and some network filesystems cannot be mapped
+            return file.read(length)
+
+def is_binary(head):
+    """
+    Checks whether the first bytes of a file look like binary content.
+    """
+
+    if not head:
+        return False
+    if head.startswith((codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return False
+    control_ratio = sum(1 for byte in head if byte in CONTROL_BYTES) / len(head)
+    # Some signatures are short enough to start a text file: they count with a control byte in the sample
+    if control_ratio > 0 and head.startswith(tuple(BINARY_SIGNATURES)):
+        return True
+    if b'\x00' in head or control_ratio > MAX_CONTROL_RATIO:
+        return True
+    try:
+        # The sample may end in the middle of a character: decode it as an incomplete stream
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+def is_generated(rel_path, head, size):
+    """
+    Checks whether the file is generated, minified or vendored, from its path in the repository and first bytes.
+    """
+
+    name = os.path.basename(rel_path)
+    if any(fnmatch.fnmatch(name, pattern) for pattern in GENERATED_NAME_PATTERNS):
+        return True
+    if VENDORED_DIRECTORIES.intersection(os.path.dirname(rel_path).split(os.sep)):
+        return True
+    if GENERATED_MARKER_PATTERN.search(head[:2048]):
+        return True
+    if os.path.splitext(name)[1].lower() in MINIFIABLE_EXTENSIONS and size > MINIFIED_LINE_LENGTH:
+        lines = head.split(b'\n')
+        # A minified file has very long lines: in a full sample, hardly any line break
+        if max(len(line) for line in lines) >= MINIFIED_LINE_LENGTH and len(head) / len(lines) >= MINIFIED_LINE_LENGTH / 4:
+            return True
+    return False
+
+def classify_file(path, root, max_bytes=DEFAULT_MAX_FILE_BYTES, size=None):
+    """
+    Decides whether a file is skipped without reading it entirely.
+
+    Only the size, the path relative to the repository `root` and the first
+    SNIFF_BYTES bytes are looked at (files with a binary extension are not opened). Files larger than
+    `max_bytes` (0: no limit) are SKIPPED_LARGE, binary files SKIPPED_BINARY, and
+    generated, minified or vendored files SKIPPED_GENERATED.
+
+    Returns:
+        str: The skip status, or None if the file is to be read and analyzed.
+    """
+
+    if size is None:
+        size = os.path.getsize(path)
+    if max_bytes and size > max_bytes:
+        return SKIPPED_LARGE
+    if os.path.splitext(path)[1].lower() in BINARY_EXTENSIONS:
+        return SKIPPED_BINARY
+    head = read_head(path, size)
+    if is_binary(head):
+        return SKIPPED_BINARY
+    if is_generated(os.path.relpath(path, root), head, size):
+        return SKIPPED_GENERATED
+    return None
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+FRAGMENT_CACHE_FILENAME = 'report_cache.sqlite'
+
+def fragment_key(*parts):
+    """
+    Returns the cache key of a fragment rendered from the given JSON-serializable parts.
+    """
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class FragmentCache:
+    """
+    Rendered HTML fragments keyed by a hash of what they are rendered from, stored in SQLite.
+
+    Entries read or written during a run are marked with the run number; prune() drops
+    the entries of previous runs, so the cache only holds the fragments of the last report.
+    """
+
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS fragments (key TEXT PRIMARY KEY, html TEXT NOT NULL, run INTEGER NOT NULL)')
+        self.run = (self.connection.execute('SELECT MAX(run) FROM fragments').fetchone()[0] or 0) + 1
+        self._used = []
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, key):
+        """
+        Returns the cached fragment, or None.
+        """
+
+        row = self.connection.execute('SELECT html FROM fragments WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.append((self.run, key))
+        return row[0]
+
+    def touch(self, keys):
+        """
+        Marks fragments as used in this run without reading them.
+        """
+
+        self._used.extend((self.run, key) for key in keys)
+
+    def put(self, key, fragment):
+        """
+        Stores a fragment.
+        """
+
+        self.connection.execute('INSERT OR REPLACE INTO fragments (key, html, run) VALUES (?, ?, ?)', (key, fragment, self.run))
+
+    def commit(self):
+        """
+        Writes the pending entries and the run marks of the fragments used since the last commit.
+        """
+
+        self.connection.executemany('UPDATE fragments SET run = ? WHERE key = ?', self._used)
+        self._used = []
+        self.connection.commit()
+
+    def prune(self):
+        """
+        Drops the fragments not used in this run.
+        """
+
+        self.commit()
+        self.connection.execute('DELETE FROM fragments WHERE run < ?', (self.run,))
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,179 @@
+import json
+import os
+import subprocess
+import time
+from dataclasses import dataclass, field
+
+GIT_STATE_FILENAME = 'git_state.json'
+REPODOC_FOLDER = '.repodoc'
+# Paths passed to one git ls-tree command, to stay below the command line length limit
+LS_TREE_BATCH_SIZE = 500
+
+@dataclass
+class FileChanges:
+    """
+    Files changed since an analyzed commit, as paths relative to the repository folder ('/' separated).
+
+    Attributes:
+        added (list[str]): New files, including untracked ones not ignored by git.
+        modified (list[str]): Files whose content or type changed.
+        deleted (list[str]): Removed files.
+        renamed (list[tuple]): (old path, new path) of moved files, possibly modified too.
+        old_sizes (dict): Size at the analyzed commit of the modified, deleted and renamed files.
+    """
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    deleted: list[str] = field(default_factory=list)
+    renamed: list[tuple[str, str]] = field(default_factory=list)
+    old_sizes: dict = field(default_factory=dict)
+
+    @property
+    def count(self):
+        return len(self.added) + len(self.modified) + len(self.deleted) + len(self.renamed)
+
+def run_git(folder_path, *args):
+    """
+    Runs a local git command in the folder and returns its output, or None if git fails or is not installed.
+    """
+
+    try:
+        result = subprocess.run(['git', '-C', folder_path, *args], capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.decode('utf-8', errors='surrogateescape')
+
+def head_commit(folder_path):
+    """
+    Returns the commit checked out in the folder, or None if it is not in a git repository with commits.
+    """
+
+    output = run_git(folder_path, 'rev-parse', '--verify', '--quiet', 'HEAD')
+    return output.strip() if output else None
+
+def read_git_state(filename):
+    """
+    Reads the analyzed commit record, or returns None.
+    """
+
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def write_git_state(filename, commit, sizes=None):
+    """
+    Records the commit the analysis corresponds to, with the sizes of the files that
+    differed from it in the analyzed working tree.
+    """
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as file:
+        json.dump({'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'sizes': sizes or {}}, file, indent=4)
+    os.replace(temp_filename, filename)
+
+def _split_z(output):
+    return [part for part in output.split('\0') if part]
+
+def _is_repodoc_path(path):
+    return path == REPODOC_FOLDER or path.startswith(REPODOC_FOLDER + '/')
+
+def changed_files(folder_path, commit, sizes=None, engine=None):
+    """
+    Lists the files of the folder changed since the commit: the diff between the commit
+    and the working tree (staged and unstaged changes, with rename detection) and the
+    untracked files. Only the local repository is used.
+
+    git only applies the .gitignore files: added and modified files ignored by `engine`
+    (ignore_rules.IgnoreEngine, e.g. .repodocignore patterns) are left out, and the
+    .repodoc folder (stats, cache, journal, metrics) always is.
+
+    `sizes` are the sizes recorded with the commit (see write_git_state) of the files
+    that differed from it when analyzed: they are the old sizes of these files, and
+    the ones no longer differing (changes reverted) are listed as modified or deleted.
+
+    Returns:
+        FileChanges: The changes, or None if the commit cannot be compared (not a git
+        repository, unknown commit, git not installed).
+    """
+
+    if run_git(folder_path, 'cat-file', '-e', f'{commit}^{{commit}}') is None:
+        return None
+    diff = run_git(folder_path, 'diff', '--name-status', '-z', '-M', '--relative', '--no-ext-diff', commit, '--')
+    untracked = run_git(folder_path, 'ls-files', '--others', '--exclude-standard', '-z')
+    if diff is None or untracked is None:
+        return None
+
+    changes = FileChanges()
+    parts = _split_z(diff)
+    index = 0
+    while index < len(parts):
+        status = parts[index]
+        if status[0] in 'RC':
+            old_path, new_path = parts[index + 1], parts[index + 2]
+            index += 3
+            if status[0] == 'R':
+                changes.renamed.append((old_path, new_path))
+            else:
+                changes.added.append(new_path)
+            continue
+        path = parts[index + 1]
+        index += 2
+        if status[0] == 'A':
+            changes.added.append(path)
+        elif status[0] == 'D':
+            changes.deleted.append(path)
+        else:
+            # M (modified), T (type changed), U (unmerged)
+            changes.modified.append(path)
+    changes.added += _split_z(untracked)
+
+    def is_tracked(path):
+        return not _is_repodoc_path(path) and not (engine and engine.is_ignored(path))
+
+    changes.added = [path for path in changes.added if is_tracked(path)]
+    changes.modified = [path for path in changes.modified if is_tracked(path)]
+    # Deleted and renamed files are kept: the files of the model they correspond to must go
+    changes.deleted = [path for path in changes.deleted if not _is_repodoc_path(path)]
+    if sizes:
+        sizes = {path: size for path, size in sizes.items() if is_tracked(path)}
+
+    old_paths = changes.modified + changes.deleted + [old_path for old_path, _ in changes.renamed]
+    if old_paths:
+        # Blob sizes at the commit, to keep the total size of the repository without a full walk
+        for start in range(0, len(old_paths), LS_TREE_BATCH_SIZE):
+            batch = old_paths[start:start + LS_TREE_BATCH_SIZE]
+            listing = run_git(folder_path, 'ls-tree', '-r', '-l', '-z', commit, '--', *batch) or ''
+            for entry in _split_z(listing):
+                meta, _, path = entry.partition('\t')
+                size = meta.split()[-1]
+                if size.isdigit():
+                    changes.old_sizes[path] = int(size)
+
+    if sizes:
+        listed = set(changes.added + changes.modified + changes.deleted)
+        listed.update(path for rename in changes.renamed for path in rename)
+        for path in sorted(sizes.keys() - listed):
+            if os.path.isfile(os.path.join(folder_path, *path.split('/'))):
+                changes.modified.append(path)
+            else:
+                changes.deleted.append(path)
+        changes.old_sizes.update(sizes)
+    return changes
+
+def worktree_sizes(folder_path, commit, engine=None):
+    """
+    Returns the sizes of the files of the working tree that differ from the commit
+    (added, modified, renamed and untracked files not ignored by `engine`), to record with it.
+    """
+
+    changes = changed_files(folder_path, commit, engine=engine)
+    if changes is None:
+        return {}
+    sizes = {}
+    for path in changes.added + changes.modified + [new_path for _, new_path in changes.renamed]:
+        try:
+            sizes[path] = os.path.getsize(os.path.join(folder_path, *path.split('/')))
+        except OSError:
+            pass
+    return sizes
@@ -0,0 +1,210 @@
+import os
+import re
+import threading
+
+GITIGNORE_FILENAME = '.gitignore'
+
+# Always ignored: ignore files themselves (as before) and git's own folder
+BUILTIN_PATTERNS = ['.*ignore*', '.git/']
+
+def _translate(pattern):
+    """
+    Translates the body of a gitignore pattern into a regular expression.
+    """
+
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**' and (i == 0 or pattern[i - 1] == '/') and (i + 2 == n or pattern[i + 2] == '/'):
+                if i + 2 == n:
+                    # Trailing '/**' matches everything inside
+                    res.append('.*')
+                    i += 2
+                else:
+                    # '**/' matches zero or more directories
+                    res.append('(?:.*/)?')
+                    i += 3
+                continue
+            while i + 1 < n and pattern[i + 1] == '*':
+                i += 1
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j].replace('\\', '\\\\')
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                res.append(f'[{body}]')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+def compile_rule(line):
+    """
+    Compiles one gitignore line into (regex, negated, dir_only), or None for blank lines and comments.
+
+    The regex matches paths relative to the directory of the ignore file, using '/' separators.
+    """
+
+    line = line.rstrip('\r\n')
+    if not line.strip() or line.startswith('#'):
+        return None
+    # Trailing spaces are ignored unless escaped with a backslash
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped.strip()
+
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+
+    # A pattern with a slash at the beginning or middle is relative to the ignore file's directory,
+    # otherwise it matches at any level below it
+    anchored = '/' in line
+    line = line.lstrip('/')
+    prefix = '' if anchored else '(?:.*/)?'
+    return re.compile(f'^{prefix}{_translate(line)}$', re.DOTALL), negated, dir_only
+
+def compile_rules(lines):
+    """
+    Compiles gitignore lines, skipping blank lines and comments.
+    """
+
+    return [rule for rule in (compile_rule(line) for line in lines) if rule]
+
+def read_ignore_file(path):
+    """
+    Reads the lines of an ignore file, or an empty list if it does not exist.
+    """
+
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            return file.read().splitlines()
+    except OSError:
+        return []
+
+class IgnoreMatcher:
+    """
+    Compiled ignore rules of one directory level, chained to the matcher of its parent level.
+
+    Rules of deeper levels take precedence, and within a level the last matching rule wins,
+    as in git. A level without negated rules is matched with a single combined regex.
+    """
+
+    __slots__ = ('parent', 'base', 'rules', '_file_regex', '_dir_regex')
+
+    def __init__(self, rules, base='', parent=None):
+        self.parent = parent
+        self.base = base
+        self.rules = rules
+        self._file_regex = None
+        self._dir_regex = None
+        if rules and not any(negated for _, negated, _ in rules):
+            file_patterns = [regex.pattern for regex, _, dir_only in rules if not dir_only]
+            self._file_regex = re.compile('|'.join(f'(?:{p})' for p in file_patterns), re.DOTALL) if file_patterns else None
+            self._dir_regex = re.compile('|'.join(f'(?:{regex.pattern})' for regex, _, _ in rules), re.DOTALL)
+
+    def _match_level(self, rel_path, is_dir):
+        if self._dir_regex is not None:
+            regex = self._dir_regex if is_dir else self._file_regex
+            return True if regex is not None and regex.match(rel_path) else None
+        for regex, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                return not negated
+        return None
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """
+        Checks whether the path (relative to the repository root, '/' separated) is ignored.
+        Parent directories of the path are not checked.
+        """
+
+        matcher = self
+        while matcher is not None:
+            if matcher.rules:
+                if not matcher.base:
+                    result = matcher._match_level(rel_path, is_dir)
+                elif rel_path.startswith(matcher.base + '/'):
+                    result = matcher._match_level(rel_path[len(matcher.base) + 1:], is_dir)
+                else:
+                    result = None
+                if result is not None:
+                    return result
+            matcher = matcher.parent
+        return False
+
+class IgnoreEngine:
+    """
+    Ignore rules of a repository: built-in patterns, .gitignore files at every level and
+    the global .repodocignore patterns, compiled once per directory and cached.
+    """
+
+    def __init__(self, folder_path, global_patterns=()):
+        self.folder_path = folder_path
+        root_lines = BUILTIN_PATTERNS + read_ignore_file(os.path.join(folder_path, GITIGNORE_FILENAME)) + list(global_patterns)
+        self._matchers = {'': IgnoreMatcher(compile_rules(root_lines))}
+        self._lock = threading.Lock()
+
+    def matcher_for(self, rel_dir, has_gitignore=None):
+        """
+        Returns the matcher for the entries of a directory (relative to the repository root, '' for the root).
+
+        Args:
+            rel_dir (str): Directory path relative to the repository root, '/' separated.
+            has_gitignore (bool): Whether the directory contains a .gitignore, if already known.
+        """
+
+        matcher = self._matchers.get(rel_dir)
+        if matcher is not None:
+            return matcher
+        parent = self.matcher_for(rel_dir.rpartition('/')[0])
+        lines = []
+        if has_gitignore is not False:
+            lines = read_ignore_file(os.path.join(self.folder_path, *rel_dir.split('/'), GITIGNORE_FILENAME))
+        rules = compile_rules(lines)
+        matcher = IgnoreMatcher(rules, rel_dir, parent) if rules else parent
+        with self._lock:
+            self._matchers[rel_dir] = matcher
+        return matcher
+
+    def is_ignored(self, path, is_dir=False):
+        """
+        Checks whether the path (absolute, or relative to the repository root) is ignored,
+        including by one of its parent directories.
+        """
+
+        rel_path = os.path.relpath(os.path.join(self.folder_path, path), self.folder_path).replace(os.sep, '/')
+        if rel_path == '.':
+            return False
+        if rel_path.startswith('../'):
+            return True
+        parts = rel_path.split('/')
+        for depth in range(1, len(parts) + 1):
+            rel_dir = '/'.join(parts[:depth - 1])
+            if self.matcher_for(rel_dir).is_ignored('/'.join(parts[:depth]), is_dir or depth < len(parts)):
+                return True
+        return False
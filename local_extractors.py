@@ -0,0 +1,336 @@
+import ast
+import fnmatch
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# Registered extractors, tried in registration order: (file name patterns, function)
+EXTRACTORS = []
+
+MAX_LISTED_KEYS = 20
+
+def register_extractor(*patterns):
+    """
+    Registers a local extractor for the file names matching the fnmatch patterns.
+
+    The extractor is called as fn(path, content) and returns a dict with `type`,
+    `file_type`, `references` and `entry_points`, plus `description` when the file
+    is fully analyzed without GPT. It returns None when it cannot handle the file,
+    which is then analyzed by GPT as usual.
+    """
+
+    def decorator(fn):
+        EXTRACTORS.append((patterns, fn))
+        return fn
+    return decorator
+
+def extract_file(path, content):
+    """
+    Runs the first extractor matching the file name.
+
+    Returns:
+        dict: The extracted fields, or None if no extractor handles the file.
+    """
+
+    name = os.path.basename(path)
+    for patterns, fn in EXTRACTORS:
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            try:
+                result = fn(path, content)
+            except Exception:
+                # A failing extractor leaves the file to GPT
+                result = None
+            if result is not None:
+                return result
+    return None
+
+def extract_files(file_contents, workers=1):
+    """
+    Runs the local extractors on (path, content) pairs with up to `workers` processes.
+
+    Returns:
+        list[dict]: The extracted fields of each file (None if not handled), in order.
+    """
+
+    if not file_contents:
+        return []
+    paths = [path for path, _ in file_contents]
+    contents = [content for _, content in file_contents]
+    if workers <= 1:
+        return list(map(extract_file, paths, contents))
+    chunksize = max(1, len(file_contents) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(extract_file, paths, contents, chunksize=chunksize))
+
+def is_complete(extraction):
+    """
+    Checks whether the extraction is a full analysis, so the file does not need GPT.
+    """
+
+    return extraction is not None and 'description' in extraction
+
+def _fields(type, file_type, references=(), entry_points=(), description=None):
+    fields = {'type': type, 'file_type': file_type}
+    if description is not None:
+        fields['description'] = description
+    fields['references'] = list(dict.fromkeys(references))
+    fields['entry_points'] = list(dict.fromkeys(entry_points))
+    return fields
+
+# ---- Lockfiles: analyzed fully, the package count is all there is to say ----
+
+LOCKFILES = {
+    'package-lock.json': ('npm', lambda content: len([key for key in json.loads(content).get('packages', {}) if key])
+                          or len(json.loads(content).get('dependencies', {}))),
+    'npm-shrinkwrap.json': ('npm', lambda content: len([key for key in json.loads(content).get('packages', {}) if key])),
+    'yarn.lock': ('Yarn', lambda content: len(re.findall(r'^"?[^\s#][^\n]*:\s*$', content, re.M))),
+    'pnpm-lock.yaml': ('pnpm', lambda content: len(re.findall(r'^  /?[\'"]?@?[\w.-]+[^\n]*:\s*$', content, re.M))),
+    'poetry.lock': ('Poetry', lambda content: content.count('[[package]]')),
+    'uv.lock': ('uv', lambda content: content.count('[[package]]')),
+    'Cargo.lock': ('Cargo', lambda content: content.count('[[package]]')),
+    'Pipfile.lock': ('Pipenv', lambda content: sum(len(json.loads(content).get(section, {})) for section in ('default', 'develop'))),
+    'composer.lock': ('Composer', lambda content: sum(len(json.loads(content).get(section, [])) for section in ('packages', 'packages-dev'))),
+    'Gemfile.lock': ('Bundler', lambda content: len(re.findall(r'^    \S', content, re.M))),
+    'go.sum': ('Go modules', lambda content: len({line.split()[0] for line in content.splitlines() if line.strip()})),
+    'gradle.lockfile': ('Gradle', lambda content: len([line for line in content.splitlines() if line and not line.startswith('#') and ':' in line])),
+}
+
+@register_extractor(*LOCKFILES)
+def extract_lockfile(path, content):
+    tool, count_packages = LOCKFILES[os.path.basename(path)]
+    description = (f"{tool} が自動生成する、依存パッケージのバージョンを固定するロックファイルです。\n"
+                   f"- パッケージ数: {count_packages(content)}\n"
+                   f"- 依存関係の追加・更新時に {tool} によって書き換えられるため、直接編集しません。")
+    return _fields('config', f"{tool} lockfile", description=description)
+
+# ---- Python: imports and public definitions with ast ----
+
+def _python_arguments(arguments):
+    names = [arg.arg for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs]
+    if arguments.vararg:
+        names.append('*' + arguments.vararg.arg)
+    if arguments.kwarg:
+        names.append('**' + arguments.kwarg.arg)
+    return ', '.join(name for name in names if name not in ('self', 'cls'))
+
+@register_extractor('*.py', '*.pyw')
+def extract_python(path, content):
+    tree = ast.parse(content)
+    references = []
+    entry_points = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            references += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            prefix = '.' * node.level
+            if node.module:
+                references.append(prefix + node.module)
+            else:
+                references += [prefix + alias.name for alias in node.names]
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and not node.name.startswith('_'):
+            entry_points.append(f"{node.name}({_python_arguments(node.args)})")
+        elif isinstance(node, ast.ClassDef) and not node.name.startswith('_'):
+            entry_points.append(node.name)
+            for member in node.body:
+                if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)) and (not member.name.startswith('_') or member.name == '__init__'):
+                    entry_points.append(f"{node.name}.{member.name}({_python_arguments(member.args)})")
+        elif (isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and isinstance(node.test.left, ast.Name)
+              and node.test.left.id == '__name__'):
+            entry_points.append('__main__')
+    return _fields('code', 'Python code', references, entry_points)
+
+# ---- Java: package, imports and public members with regular expressions ----
+
+JAVA_COMMENT_PATTERN = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+JAVA_PACKAGE_PATTERN = re.compile(r'^\s*package\s+([\w.]+)\s*;', re.M)
+JAVA_IMPORT_PATTERN = re.compile(r'^\s*import\s+(?:static\s+)?([\w.]+(?:\.\*)?)\s*;', re.M)
+JAVA_TYPE_PATTERN = re.compile(
+    r'^\s*((?:public|protected|private|abstract|final|static|sealed|non-sealed|strictfp)\s+)*'
+    r'(class|interface|enum|record|@interface)\s+(\w+)([^{]*)\{', re.M)
+JAVA_METHOD_PATTERN = re.compile(
+    r'^\s*public\s+((?:(?:static|final|synchronized|abstract|default|native)\s+)*)(?:<[^>]*>\s+)?'
+    r'(?:([\w.$<>\[\],?\s]+?)\s+)?(\w+)\s*\(([^)]*)\)', re.M)
+JAVA_INTERFACE_METHOD_PATTERN = re.compile(
+    r'^\s*(?:public\s+)?((?:(?:static|default|abstract)\s+)*)(?:<[^>]*>\s+)?([\w.$<>\[\],?\s]+?)\s+(\w+)\s*\(([^)]*)\)\s*[;{]', re.M)
+JAVA_TYPE_NAME_PATTERN = re.compile(r'\b[A-Z]\w*\b')
+JAVA_PARAMETER_PATTERN = re.compile(r'(?:final\s+|@\w+\s+)*([\w.$<>\[\],?\s]+?)\s+(\w+)\s*$')
+
+def _java_parameters(parameters):
+    types = []
+    for parameter in re.split(r',(?![^<]*>)', parameters):
+        match = JAVA_PARAMETER_PATTERN.match(parameter.strip())
+        if match:
+            types.append(f"{' '.join(match.group(1).split())} {match.group(2)}")
+    return ', '.join(types)
+
+@register_extractor('*.java')
+def extract_java(path, content):
+    code = JAVA_COMMENT_PATTERN.sub(lambda match: '""' if match.group(0)[0] == '"' else ' ', content)
+    package_match = JAVA_PACKAGE_PATTERN.search(code)
+    package = package_match.group(1) if package_match else ''
+    references = JAVA_IMPORT_PATTERN.findall(code)
+
+    type_match = JAVA_TYPE_PATTERN.search(code)
+    if type_match is None:
+        return None
+    kind, class_name, heritage = type_match.group(2), type_match.group(3), type_match.group(4)
+    # Classes of the same package are used without import: keep the names matching a sibling .java file
+    directory = os.path.dirname(path)
+    siblings = {os.path.splitext(name)[0] for name in os.listdir(directory) if name.endswith('.java')} if directory and os.path.isdir(directory) else set()
+    used_names = set(JAVA_TYPE_NAME_PATTERN.findall(code))
+    for name in sorted((used_names & siblings) - {class_name}, key=lambda name: (name not in heritage, name)):
+        references.append(f"{package}.{name}" if package else name)
+
+    entry_points = []
+    method_pattern = JAVA_INTERFACE_METHOD_PATTERN if kind == 'interface' else JAVA_METHOD_PATTERN
+    for match in method_pattern.finditer(code):
+        return_type, name, parameters = match.group(2), match.group(3), match.group(4)
+        if name in ('if', 'for', 'while', 'switch', 'catch', 'return', 'new'):
+            continue
+        if return_type is None and name != class_name:
+            continue
+        modifiers = (match.group(1) or '').split()
+        label = f"{class_name}.{name}({_java_parameters(parameters)})" if name != class_name else f"{class_name}({_java_parameters(parameters)})"
+        if 'static' in modifiers:
+            label = 'static ' + label
+        entry_points.append(label)
+    if not entry_points and kind in ('class', 'record', 'enum'):
+        entry_points.append(class_name)
+    file_type = {'interface': 'Java interface', 'enum': 'Java enum', 'record': 'Java record', '@interface': 'Java annotation'}.get(kind, 'Java code')
+    return _fields('code', file_type, references, entry_points)
+
+# ---- Gradle: plugins, dependencies, main class and tasks ----
+
+GRADLE_PLUGIN_PATTERN = re.compile(r'''(?:apply\s+plugin\s*:\s*|\bid\s*\(?\s*)['"]([\w.\-]+)['"]''')
+GRADLE_DEPENDENCY_PATTERN = re.compile(
+    r'''^\s*(?:implementation|api|compileOnly|runtimeOnly|testImplementation|testRuntimeOnly|annotationProcessor|compile|testCompile|classpath)'''
+    r'''\s*\(?\s*(?:platform\s*\(\s*)?['"]([^'"]+)['"]''', re.M)
+GRADLE_PROJECT_PATTERN = re.compile(r'''project\s*\(\s*['"](:[\w\-:]+)['"]\s*\)''')
+GRADLE_MAIN_PATTERN = re.compile(r'''\b(?:main|mainClass|mainClassName)\s*(?:=|\.set\s*\()\s*['"]([\w.$]+)['"]''')
+GRADLE_TASK_PATTERN = re.compile(r'''^\s*(?:task\s+(\w+)|tasks\.(?:register|create)\s*\(\s*['"](\w+)['"])''', re.M)
+
+@register_extractor('*.gradle', '*.gradle.kts')
+def extract_gradle(path, content):
+    name = os.path.basename(path)
+    file_type = 'Gradle settings script' if name.startswith('settings.') else 'Gradle build script'
+    references = GRADLE_PROJECT_PATTERN.findall(content) + GRADLE_MAIN_PATTERN.findall(content) + GRADLE_DEPENDENCY_PATTERN.findall(content)
+    entry_points = [f"plugin {plugin}" for plugin in GRADLE_PLUGIN_PATTERN.findall(content)]
+    entry_points += [f"task {first or second}" for first, second in GRADLE_TASK_PATTERN.findall(content)]
+    return _fields('config', file_type + (' (Kotlin DSL)' if name.endswith('.kts') else ''), references, entry_points)
+
+# ---- JSON: known configuration files, the rest is data analyzed fully ----
+
+JSON_CONFIG_FILES = {
+    'package.json': 'npm package manifest (package.json)',
+    'tsconfig.json': 'TypeScript configuration',
+    'jsconfig.json': 'JavaScript project configuration',
+    'composer.json': 'Composer package manifest',
+    '.eslintrc.json': 'ESLint configuration',
+    '.prettierrc.json': 'Prettier configuration',
+    '.babelrc': 'Babel configuration',
+    'babel.config.json': 'Babel configuration',
+    'launch.json': 'VS Code launch configuration',
+    'settings.json': 'VS Code settings',
+    'tasks.json': 'VS Code tasks configuration',
+    'extensions.json': 'VS Code recommended extensions',
+    'devcontainer.json': 'Dev Container configuration',
+    '.devcontainer.json': 'Dev Container configuration',
+    'renovate.json': 'Renovate configuration',
+    'vercel.json': 'Vercel configuration',
+    'firebase.json': 'Firebase configuration',
+    'angular.json': 'Angular workspace configuration',
+    'nx.json': 'Nx workspace configuration',
+    'lerna.json': 'Lerna configuration',
+    'manifest.json': 'Web app / extension manifest',
+    'appsettings.json': '.NET application settings',
+    'global.json': '.NET SDK configuration',
+}
+JSON_CONFIG_PATTERNS = ['tsconfig.*.json', 'appsettings.*.json', '*.schema.json', '.*rc.json', '*.config.json']
+
+def _json_config_type(name):
+    if name in JSON_CONFIG_FILES:
+        return JSON_CONFIG_FILES[name]
+    if any(fnmatch.fnmatch(name, pattern) for pattern in JSON_CONFIG_PATTERNS):
+        return 'JSON configuration'
+    return None
+
+def _json_shape(value):
+    if isinstance(value, list):
+        keys = list(dict.fromkeys(key for element in value if isinstance(element, dict) for key in element))
+        shape = f"配列（{len(value)}件）"
+        if keys:
+            shape += f"。各要素のキー: {', '.join(keys[:MAX_LISTED_KEYS])}" + (' ...' if len(keys) > MAX_LISTED_KEYS else '')
+        return shape
+    if isinstance(value, dict):
+        keys = list(value)
+        return f"オブジェクト。キー: {', '.join(keys[:MAX_LISTED_KEYS])}" + (' ...' if len(keys) > MAX_LISTED_KEYS else '')
+    return f"値: {json.dumps(value, ensure_ascii=False)[:80]}"
+
+@register_extractor('*.json')
+def extract_json(path, content):
+    data = json.loads(content)
+    name = os.path.basename(path)
+    config_type = _json_config_type(name)
+    if config_type:
+        references = []
+        entry_points = []
+        if isinstance(data, dict):
+            for section in ('dependencies', 'devDependencies', 'peerDependencies', 'require', 'require-dev'):
+                if isinstance(data.get(section), dict):
+                    references += list(data[section])
+            if isinstance(data.get('scripts'), dict):
+                entry_points += [f"npm run {script}" for script in data['scripts']]
+            for key in ('main', 'module', 'bin'):
+                if isinstance(data.get(key), str):
+                    entry_points.append(data[key])
+        return _fields('config', config_type, references, entry_points)
+
+    lines = ["JSON形式のデータファイルです。"]
+    if isinstance(data, dict) and data and all(isinstance(value, (dict, list)) for value in data.values()):
+        for key in list(data)[:MAX_LISTED_KEYS]:
+            lines.append(f"- {key}: {_json_shape(data[key])}")
+        if len(data) > MAX_LISTED_KEYS:
+            lines.append(f"- ほか {len(data) - MAX_LISTED_KEYS} 件のキー")
+    else:
+        lines.append(f"- 全体: {_json_shape(data)}")
+    return _fields('document', 'JSON data', description='\n'.join(lines))
+
+# ---- YAML: kind of file, top-level keys and the names that matter ----
+
+YAML_TOP_LEVEL_KEY_PATTERN = re.compile(r'^([\w.\-"\']+)\s*:', re.M)
+YAML_SECOND_LEVEL_KEY_PATTERN = re.compile(r'^  ([\w.\-]+)\s*:', re.M)
+YAML_USES_PATTERN = re.compile(r'^\s*-?\s*uses\s*:\s*[\'"]?([^\s\'"#]+)', re.M)
+YAML_IMAGE_PATTERN = re.compile(r'^\s*image\s*:\s*[\'"]?([^\s\'"#]+)', re.M)
+
+def _yaml_section(content, key):
+    """Returns the lines of a top-level section of a YAML document."""
+    match = re.search(rf'^{re.escape(key)}\s*:[^\n]*\n((?:[ \t#][^\n]*\n|\n)*)', content + '\n', re.M)
+    return match.group(1) if match else ''
+
+@register_extractor('*.yml', '*.yaml')
+def extract_yaml(path, content):
+    normalized = path.replace(os.sep, '/')
+    name = os.path.basename(path)
+    top_level_keys = [key.strip('"\'') for key in YAML_TOP_LEVEL_KEY_PATTERN.findall(content)]
+    references = []
+    entry_points = []
+    if '/.github/workflows/' in normalized:
+        file_type = 'GitHub Actions workflow YAML'
+        references = YAML_USES_PATTERN.findall(content)
+        entry_points = [f"job {job}" for job in YAML_SECOND_LEVEL_KEY_PATTERN.findall(_yaml_section(content, 'jobs'))]
+    elif name.startswith(('docker-compose', 'compose.')):
+        file_type = 'Docker Compose YAML'
+        references = YAML_IMAGE_PATTERN.findall(content)
+        entry_points = [f"service {service}" for service in YAML_SECOND_LEVEL_KEY_PATTERN.findall(_yaml_section(content, 'services'))]
+    elif 'apiVersion' in top_level_keys and 'kind' in top_level_keys:
+        file_type = 'Kubernetes manifest YAML'
+        references = YAML_IMAGE_PATTERN.findall(content)
+    elif 'openapi' in top_level_keys or 'swagger' in top_level_keys:
+        file_type = 'OpenAPI definition YAML'
+        entry_points = [f"path {api_path}" for api_path in re.findall(r'^  (/[^\s:]*)\s*:', _yaml_section(content, 'paths'), re.M)]
+    else:
+        file_type = 'YAML configuration'
+    return _fields('config', file_type, references, entry_points)
@@ -0,0 +1,274 @@
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+METRICS_FOLDER = 'metrics'
+PROFILES_FOLDER = 'profiles'
+# Run records kept per command and repository (older ones are removed)
+MAX_RUN_RECORDS = 100
+
+# Console verbosity: QUIET prints summaries and errors only, NORMAL adds one line per
+# file, VERBOSE also echoes file contents, structure texts and analysis results
+QUIET = 0
+NORMAL = 1
+VERBOSE = 2
+VERBOSITY_LEVELS = [QUIET, NORMAL, VERBOSE]
+
+_verbosity = VERBOSE
+
+def set_verbosity(level):
+    global _verbosity
+    _verbosity = level
+
+def echo(*args, level=NORMAL, **kwargs):
+    """
+    print() shown from the given verbosity level on.
+    """
+
+    if _verbosity >= level:
+        print(*args, **kwargs)
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))]
+
+def _distribution(values):
+    return {
+        'count': len(values),
+        'sum': sum(values),
+        'mean': sum(values) / len(values) if values else 0.0,
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'max': max(values, default=0.0),
+    }
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RunMetrics:
+    """
+    Collects the metrics of one run of a command: the wall time of each phase, the API
+    calls (latency, input/output/cached tokens), one record per analyzed file, one per
+    chat turn, and counters. `info` (e.g. the mode) is copied to the run record.
+    Safe to use from the worker threads of run_tasks.
+
+    With `profile_phases`, the listed phases ('all': every phase) run under cProfile; a
+    phase entered while another one is profiled is part of that profile. Repeated
+    phases (chat turns, watch rounds) add up into one profile per phase.
+    """
+
+    def __init__(self, command, repository, profile_phases=(), info=None):
+        self.command = command
+        self.repository = repository
+        self.info = info or {}
+        self.profile_phases = set(profile_phases)
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.files = {}
+        self.turns = []
+        self.api_latencies = []
+        self.tokens = {'input': 0, 'output': 0, 'cached': 0}
+        self._profiles = {}
+        self._profiling = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measures the wall time of the block as the phase `name`.
+        """
+
+        profiler = None
+        if not self._profiling and (name in self.profile_phases or 'all' in self.profile_phases) \
+                and threading.current_thread() is threading.main_thread():
+            profiler = self._profiles.setdefault(name, cProfile.Profile())
+            self._profiling = True
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler:
+                profiler.disable()
+                self._profiling = False
+            with self._lock:
+                entry = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+                entry['seconds'] += elapsed
+                entry['count'] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_api_call(self, latency, input_tokens, output_tokens, cached_tokens=0):
+        """
+        Records a completed API request. The usage is also added up per thread until
+        take_api_usage, to attribute it to the file analyzed by the thread.
+        """
+
+        with self._lock:
+            self.api_latencies.append(latency)
+            self.tokens['input'] += input_tokens
+            self.tokens['output'] += output_tokens
+            self.tokens['cached'] += cached_tokens
+        usage = getattr(self._local, 'usage', None)
+        if usage is None:
+            usage = self._local.usage = {'api_calls': 0, 'api_latency': 0.0, 'cached_tokens': 0}
+        usage['api_calls'] += 1
+        usage['api_latency'] += latency
+        usage['cached_tokens'] += cached_tokens
+
+    def take_api_usage(self):
+        """
+        Returns the API usage of the current thread since the last call, and starts over.
+        """
+
+        usage = getattr(self._local, 'usage', None) or {'api_calls': 0, 'api_latency': 0.0, 'cached_tokens': 0}
+        self._local.usage = None
+        return usage
+
+    def record_file(self, path, **values):
+        """
+        Adds values to the record of a file (the values of a later analysis of the same file replace the earlier ones).
+        """
+
+        with self._lock:
+            self.files.setdefault(path, {'path': path}).update(values)
+
+    def record_turn(self, **values):
+        with self._lock:
+            self.turns.append(values)
+
+    def to_record(self):
+        """
+        Returns the run record: a JSON-serializable summary followed by the file and turn records.
+        """
+
+        with self._lock:
+            files = [dict(record) for record in self.files.values()]
+            return {
+                'command': self.command,
+                'repository': self.repository,
+                'info': dict(self.info),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+                'wall_time': time.time() - self.started,
+                'phases': {name: dict(entry) for name, entry in self.phases.items()},
+                'api': {'latency': _distribution(self.api_latencies), 'tokens': dict(self.tokens)},
+                'counters': dict(self.counters),
+                'file_latency': _distribution([record['latency'] for record in files if 'latency' in record]),
+                'file_queue_wait': _distribution([record['queue_wait'] for record in files if 'queue_wait' in record]),
+                'files': files,
+                'turns': list(self.turns),
+            }
+
+    def format_prometheus(self, record):
+        """
+        Formats a run record in the Prometheus text exposition format (for the node_exporter textfile collector).
+        """
+
+        base = f'command="{_label_value(self.command)}",repository="{_label_value(self.repository)}"'
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP repodoc_{name} {help_text}")
+            lines.append(f"# TYPE repodoc_{name} {metric_type}")
+            for suffix, labels, value in samples:
+                label_text = ','.join([base] + [f'{key}="{_label_value(label)}"' for key, label in labels])
+                lines.append(f"repodoc_{name}{suffix}{{{label_text}}} {value}")
+
+        def summary(distribution):
+            return ([('', [('quantile', '0.5')], distribution['p50']), ('', [('quantile', '0.95')], distribution['p95']),
+                     ('_sum', [], distribution['sum']), ('_count', [], distribution['count'])])
+
+        metric('run_start_time_seconds', 'gauge', 'Start time of the last run.', [('', [], self.started)])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the last run.', [('', [], record['wall_time'])])
+        metric('phase_duration_seconds', 'gauge', 'Wall time spent in each phase of the last run.',
+               [('', [('phase', name)], entry['seconds']) for name, entry in sorted(record['phases'].items())])
+        metric('phase_runs', 'gauge', 'Times each phase ran in the last run.',
+               [('', [('phase', name)], entry['count']) for name, entry in sorted(record['phases'].items())])
+        metric('api_latency_seconds', 'summary', 'Latency of the API requests of the last run.', summary(record['api']['latency']))
+        metric('api_tokens', 'gauge', 'Tokens of the API requests of the last run.',
+               [('', [('kind', kind)], value) for kind, value in sorted(record['api']['tokens'].items())])
+        metric('file_latency_seconds', 'summary', 'Latency of the request analyzing each file in the last run.',
+               summary(record['file_latency']))
+        metric('file_queue_wait_seconds', 'summary', 'Time each file waited before its request started (rate limit included).',
+               summary(record['file_queue_wait']))
+        if record['counters']:
+            metric('events', 'gauge', 'Counters of the last run.',
+                   [('', [('name', name)], value) for name, value in sorted(record['counters'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, metrics_dir):
+        """
+        Writes the run record (<command>_<start time>.json), the Prometheus textfile
+        (repodoc_<command>_<repository>.prom) and the profiles (profiles/<command>.<phase>.prof)
+        to `metrics_dir`. May be called again to update the files of a long run.
+
+        Returns:
+            str: The run record filename.
+        """
+
+        os.makedirs(metrics_dir, exist_ok=True)
+        record = self.to_record()
+        name = re.sub(r'[^\w.-]', '_', f"{self.command}_{self.repository}")
+        record_filename = os.path.join(metrics_dir, f"{self.command}_{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}.json")
+        for filename, text in [(record_filename, json.dumps(record, indent=4, ensure_ascii=False)),
+                               (os.path.join(metrics_dir, f"repodoc_{name}.prom"), self.format_prometheus(record))]:
+            temp_filename = filename + '.tmp'
+            with open(temp_filename, 'w', encoding='utf-8') as file:
+                file.write(text)
+            os.replace(temp_filename, filename)
+
+        records = sorted(filename for filename in os.listdir(metrics_dir)
+                         if re.fullmatch(re.escape(self.command) + r'_\d{8}-\d{6}\.json', filename))
+        for filename in records[:-MAX_RUN_RECORDS]:
+            os.remove(os.path.join(metrics_dir, filename))
+
+        if self._profiles:
+            profiles_dir = os.path.join(metrics_dir, PROFILES_FOLDER)
+            os.makedirs(profiles_dir, exist_ok=True)
+            for phase_name, profiler in self._profiles.items():
+                profiler.dump_stats(os.path.join(profiles_dir, f"{self.command}.{phase_name}.prof"))
+        return record_filename
+
+# The run of the current process, used by the module functions below (they do nothing without a run)
+_run = None
+
+def start_run(command, repository, profile_phases=(), info=None):
+    global _run
+    _run = RunMetrics(command, repository, profile_phases, info)
+    return _run
+
+def current_run():
+    return _run
+
+def phase(name):
+    return _run.phase(name) if _run else nullcontext()
+
+def count(name, value=1):
+    if _run:
+        _run.count(name, value)
+
+def record_api_call(latency, input_tokens, output_tokens, cached_tokens=0):
+    if _run:
+        _run.record_api_call(latency, input_tokens, output_tokens, cached_tokens)
+
+def take_api_usage():
+    return _run.take_api_usage() if _run else None
+
+def record_file(path, **values):
+    if _run:
+        _run.record_file(path, **values)
+
+def record_turn(**values):
+    if _run:
+        _run.record_turn(**values)
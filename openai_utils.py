@@ -2,10 +2,24 @@ from pydantic import BaseModel
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 import os
+import time
 import tiktoken
+from metrics import record_api_call
 
 load_dotenv()
 
+ENDPOINT_VARIABLES = ["AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_API_KEY", "AZURE_OPENAI_API_VERSION", "MODEL_DEPLOYMENT_NAME"]
+
+def get_endpoint_setting(name: str, suffix: str = None):
+    """
+    Get an endpoint environment variable, preferring its suffixed variant (e.g. AZURE_OPENAI_ENDPOINT_SHARD2).
+    """
+    if suffix:
+        value = os.getenv(f"{name}_{suffix}")
+        if value:
+            return value
+    return os.getenv(name)
+
 azure_openai_client = AzureOpenAI(
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
     api_key=os.getenv("AZURE_OPENAI_API_KEY"),
@@ -14,6 +28,37 @@ azure_openai_client = AzureOpenAI(
 
 model_deployment_name = os.getenv("MODEL_DEPLOYMENT_NAME")
 
+def configure_endpoint(suffix: str) -> bool:
+    """
+    Switch the client and the deployment to the environment variables with the suffix
+    (AZURE_OPENAI_ENDPOINT_<suffix>, AZURE_OPENAI_API_KEY_<suffix>, AZURE_OPENAI_API_VERSION_<suffix>,
+    MODEL_DEPLOYMENT_NAME_<suffix>), each falling back to the variable without suffix.
+    Used to send each shard of an analysis to its own endpoint or deployment.
+
+    Args:
+        suffix (str): The variable suffix, e.g. "SHARD2".
+
+    Returns:
+        bool: Whether any suffixed variable is set (otherwise nothing changes).
+    """
+    global azure_openai_client, model_deployment_name
+    if not any(os.getenv(f"{name}_{suffix}") for name in ENDPOINT_VARIABLES):
+        return False
+    azure_openai_client = AzureOpenAI(
+        azure_endpoint=get_endpoint_setting("AZURE_OPENAI_ENDPOINT", suffix),
+        api_key=get_endpoint_setting("AZURE_OPENAI_API_KEY", suffix),
+        api_version=get_endpoint_setting("AZURE_OPENAI_API_VERSION", suffix)
+    )
+    model_deployment_name = get_endpoint_setting("MODEL_DEPLOYMENT_NAME", suffix)
+    return True
+
+def get_cached_token_count(usage) -> int:
+    """
+    Get the number of prompt tokens served from the prompt cache (0 if the API version does not report it).
+    """
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', None) or 0
+
 def get_parsed_completion(messages: list[dict], response_format: BaseModel):
     """
     Get parsed completion from Azure OpenAI.
@@ -25,6 +70,7 @@ def get_parsed_completion(messages: list[dict], response_format: BaseModel):
     Returns:
         tuple: Parsed event, input token count, output token count.
     """
+    started = time.perf_counter()
     completion = azure_openai_client.beta.chat.completions.parse(
         model=model_deployment_name,
         messages=messages,
@@ -32,9 +78,97 @@ def get_parsed_completion(messages: list[dict], response_format: BaseModel):
     )
     output_token = completion.usage.completion_tokens
     input_token = completion.usage.prompt_tokens
+    record_api_call(time.perf_counter() - started, input_token, output_token, get_cached_token_count(completion.usage))
     event = completion.choices[0].message.parsed
     return event, input_token, output_token
 
+def get_streamed_parsed_completion(messages: list[dict], response_format: BaseModel, on_content=None):
+    """
+    Get parsed completion from Azure OpenAI, receiving the response as a stream.
+
+    Args:
+        messages (list[dict]): List of message dictionaries.
+        response_format (BaseModel): The response format model.
+        on_content (Callable): Called with the JSON content received so far, each time a chunk arrives.
+
+    Returns:
+        tuple: Parsed event, input token count, output token count, seconds until the first content chunk.
+    """
+    started = time.perf_counter()
+    first_token_latency = None
+    with azure_openai_client.beta.chat.completions.stream(
+        model=model_deployment_name,
+        messages=messages,
+        response_format=response_format,
+        stream_options={"include_usage": True},
+    ) as stream:
+        for event in stream:
+            if event.type == 'content.delta':
+                if first_token_latency is None:
+                    first_token_latency = time.perf_counter() - started
+                if on_content:
+                    on_content(event.snapshot)
+        completion = stream.get_final_completion()
+    message = completion.choices[0].message
+    if completion.usage:
+        input_token = completion.usage.prompt_tokens
+        output_token = completion.usage.completion_tokens
+    else:
+        # Older API versions do not report the usage of streamed completions
+        input_token = sum(get_token_count(m['content']) for m in messages)
+        output_token = get_token_count(message.content or '')
+    record_api_call(time.perf_counter() - started, input_token, output_token, get_cached_token_count(completion.usage))
+    return message.parsed, input_token, output_token, first_token_latency
+
+def get_response_format_param(response_format: BaseModel) -> dict:
+    """
+    Get the response_format request parameter for a response format model,
+    as sent by get_parsed_completion (e.g. for Batch API request files).
+
+    Args:
+        response_format (BaseModel): The response format model.
+
+    Returns:
+        dict: The json_schema response_format parameter.
+    """
+    schema = response_format.model_json_schema()
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_format.__name__,
+            "schema": _to_strict_json_schema(schema, schema.get("$defs", {})),
+            "strict": True,
+        },
+    }
+
+def _to_strict_json_schema(schema, defs):
+    """
+    Converts a pydantic JSON schema to the strict form of Structured Outputs: objects
+    forbid additional properties and require every property, and a $ref with sibling
+    keys is inlined (strict mode does not allow them together).
+    """
+    schema = dict(schema)
+    schema.pop("default", None)
+    ref = schema.get("$ref")
+    if ref and len(schema) > 1:
+        schema.pop("$ref")
+        schema = {**defs[ref.split("/")[-1]], **schema}
+    if schema.get("type") == "object":
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema.get("properties", {}))
+    if "properties" in schema:
+        schema["properties"] = {name: _to_strict_json_schema(value, defs) for name, value in schema["properties"].items()}
+    if "$defs" in schema:
+        schema["$defs"] = {name: _to_strict_json_schema(value, defs) for name, value in schema["$defs"].items()}
+    if "items" in schema:
+        schema["items"] = _to_strict_json_schema(schema["items"], defs)
+    for key in ("anyOf", "allOf"):
+        if key in schema:
+            schema[key] = [_to_strict_json_schema(value, defs) for value in schema[key]]
+    if len(schema.get("allOf", [])) == 1:
+        schema = {**schema, **schema.pop("allOf")[0]}
+    return schema
+
 def get_token_count(text: str) -> int:
     """
     Get the number of tokens in a given text.
@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+
+from dependency_graph import DependencyGraph, DEFAULT_IMPACT_DEPTH
+
+CHAT_ROUTE_LOG_FILENAME = 'chat_routes.jsonl'
+ROUTER_MODES = ['local', 'llm']
+MAX_ROUTED_FILES = 8
+
+# Words asking about the code itself, so the original files should be read
+READ_INTENT_PATTERN = re.compile(
+    r'実装|コード|ソース|処理|ロジック|修正|変更|追加|削除|書き換|リファクタ|バグ|不具合|エラー|例外|テスト|どこ|どの|箇所|中身|内容|詳細|引数|戻り値|メソッド|関数|クラス|'
+    r'\b(?:implement\w*|code|source|fix\w*|bug\w*|error\w*|exception\w*|change\w*|modify|edit|add|remove|refactor\w*|'
+    r'test\w*|where|which|line\w*|method\w*|function\w*|class\w*|argument\w*|return\w*|detail\w*)\b',
+    re.IGNORECASE)
+# Words asking for callers and callees, so the files around the matched ones are read too
+IMPACT_PATTERN = re.compile(
+    r'影響|依存|呼び出し元|呼び出し先|参照元|参照先|波及|\b(?:impact\w*|depend\w*|caller\w*|callee\w*|affect\w*)\b',
+    re.IGNORECASE)
+QUERY_TOKEN_PATTERN = re.compile(r'[A-Za-z_][\w.\-/]*\w|[A-Za-z_]\w*')
+METHOD_PATTERN = re.compile(r'([A-Za-z_]\w{2,})\s*\(')
+
+@dataclass
+class RouteDecision:
+    """
+    Decision of the query router for one chat turn.
+
+    Attributes:
+        need_files (bool): Whether the original files should be read to answer.
+        file_paths (list[str]): Files to read.
+        complex_level (int): Level in the CheckRequest scale (0, 1 or 4 when decided locally).
+        source (str): 'local', or 'llm' when decided by the CheckRequest classifier.
+        reason (str): Why this decision was taken.
+        latency (float): Seconds spent deciding.
+    """
+    need_files: bool
+    file_paths: list[str] = field(default_factory=list)
+    complex_level: int = 0
+    source: str = 'local'
+    reason: str = ''
+    latency: float = 0.0
+
+class QueryRouter:
+    """
+    Decides locally whether a chat turn needs the original files, and which ones.
+
+    Paths, file names, class names and method names (entry points) mentioned in the
+    question are matched against the analyzed structure. For impact questions, the
+    files reached from the matched files in the dependency graph within `impact_depth`
+    edges are added, nearest first.
+    A question asking about code without naming anything known is ambiguous and left
+    to the LLM classifier (route returns None).
+    """
+
+    def __init__(self, repo, graph=None, impact_depth=DEFAULT_IMPACT_DEPTH):
+        self.root = repo.directories[0].root if repo.directories else ''
+        self.graph = graph if graph is not None else DependencyGraph.build(repo)
+        self.impact_depth = impact_depth
+        self._names = {}
+        self._stems = {}
+        self._methods = {}
+        self._relative_paths = {}
+        for record in repo.iter_files():
+            path = record.path
+            stem = os.path.splitext(record.name)[0]
+            self._names.setdefault(record.name.lower(), []).append(path)
+            self._stems.setdefault(stem, []).append(path)
+            self._relative_paths[os.path.relpath(path, self.root).replace(os.sep, '/')] = path
+            if isinstance(record.analysis, dict):
+                for entry_point in record.analysis.get('entry_points', []):
+                    for method in METHOD_PATTERN.findall(entry_point):
+                        self._methods.setdefault(method, []).append(path)
+
+    def match_files(self, query):
+        """
+        Returns the files named in the query, with what matched them.
+        """
+
+        matches = {}
+        for token in QUERY_TOKEN_PATTERN.findall(query):
+            token = token.strip('./')
+            if '/' in token:
+                for rel_path, path in self._relative_paths.items():
+                    if rel_path == token or rel_path.endswith('/' + token):
+                        matches.setdefault(path, token)
+                continue
+            for path in self._names.get(token.lower(), []):
+                matches.setdefault(path, token)
+            for path in self._stems.get(token, []):
+                matches.setdefault(path, token)
+            for path in self._methods.get(token, []):
+                matches.setdefault(path, token + '()')
+        return matches
+
+    def route(self, query):
+        """
+        Routes the query.
+
+        Returns:
+            RouteDecision: The local decision, or None if the query is ambiguous.
+        """
+
+        started = time.perf_counter()
+        matches = self.match_files(query)
+        read_intent = bool(READ_INTENT_PATTERN.search(query))
+        impact = bool(IMPACT_PATTERN.search(query))
+
+        decision = None
+        if matches:
+            file_paths = list(matches)
+            complex_level = 1
+            if impact:
+                complex_level = 4
+                file_paths += [path for path, _ in self.graph.impacted(file_paths, self.impact_depth)]
+            file_paths = list(dict.fromkeys(file_paths))[:MAX_ROUTED_FILES]
+            decision = RouteDecision(True, file_paths, complex_level,
+                                     reason='matched ' + ', '.join(sorted(set(matches.values()))))
+        elif not read_intent and not impact:
+            decision = RouteDecision(False, reason='no file named and no question about the code')
+
+        if decision:
+            decision.latency = time.perf_counter() - started
+        return decision
+
+def log_route(filename, query, decision):
+    """
+    Prints the routing decision and appends it to the route log (JSONL).
+    """
+
+    print(f"ROUTE [{decision.source}] need_files={decision.need_files} files={len(decision.file_paths)} "
+          f"latency={decision.latency * 1000:.1f}ms ({decision.reason})")
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'a', encoding='utf-8') as file:
+        file.write(json.dumps({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'query': query,
+            'source': decision.source,
+            'need_files': decision.need_files,
+            'complex_level': decision.complex_level,
+            'file_paths': decision.file_paths,
+            'reason': decision.reason,
+            'latency_ms': round(decision.latency * 1000, 3),
+        }, ensure_ascii=False) + '\n')
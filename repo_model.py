@@ -0,0 +1,345 @@
+import json
+import os
+from dataclasses import dataclass, field
+
+NOT_ANALYZED = "NOT_ANALYZED"
+FILE_READ_ERROR = "FILE_READ_ERROR"
+SKIPPED_BINARY = "SKIPPED_BINARY"
+SKIPPED_LARGE = "SKIPPED_LARGE"
+SKIPPED_GENERATED = "SKIPPED_GENERATED"
+
+# Labels of the status strings stored in place of an analysis
+STATUS_LABELS = {
+    NOT_ANALYZED: '解析対象外',
+    FILE_READ_ERROR: 'ファイル読み取りエラー',
+    SKIPPED_BINARY: 'バイナリファイルのため解析対象外',
+    SKIPPED_LARGE: 'サイズ上限を超えるため解析対象外',
+    SKIPPED_GENERATED: '自動生成・圧縮・同梱されたファイルのため解析対象外',
+}
+
+STREAM_READ_SIZE = 1024 * 1024
+
+@dataclass(slots=True, eq=False)
+class FileRecord:
+    """
+    A file of the repository and its analysis result.
+
+    Attributes:
+        name (str): File name.
+        directory (DirectoryRecord): Directory containing the file.
+        analysis (dict | str | None): FileContent dict, a status string such as NOT_ANALYZED (see STATUS_LABELS), or None if not processed yet.
+        modified_time (str | None): Modified time of the file when it was analyzed.
+    """
+    name: str
+    directory: 'DirectoryRecord' = field(repr=False)
+    analysis: dict | str | None = None
+    modified_time: str | None = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory.root, self.name)
+
+@dataclass(slots=True, eq=False)
+class DirectoryRecord:
+    """
+    A directory of the repository with its (non-ignored) subdirectory names and files.
+    """
+    root: str
+    dirs: list[str] = field(default_factory=list)
+    files: list[FileRecord] = field(default_factory=list)
+
+def directory_from_item(item):
+    """
+    Builds a directory record from one [root, dirs, files, analyses, modified_times] item of the stats JSON layout.
+    """
+
+    root, dirs, files = item[0], item[1], item[2]
+    analyses = item[3] if len(item) > 3 else []
+    modified_times = item[4] if len(item) > 4 else []
+    directory = DirectoryRecord(root, list(dirs))
+    directory.files = [FileRecord(name, directory) for name in files]
+    for index, record in enumerate(directory.files):
+        if index < len(analyses):
+            record.analysis = analyses[index]
+        if index < len(modified_times):
+            record.modified_time = modified_times[index]
+    return directory
+
+class RepositoryModel:
+    """
+    In-memory model of an analyzed repository, indexed by directory and file path.
+
+    The model is loaded from and saved to the stats JSON layout:
+    {'folder_name', 'num_files', 'num_dirs', 'total_size',
+     'structure': [[root, dirs, files, analyses, modified_times], ...]}
+    """
+
+    __slots__ = ('folder_name', 'num_files', 'num_dirs', 'total_size', 'directories', '_directory_index', '_file_index')
+
+    def __init__(self, folder_name, num_files=0, num_dirs=0, total_size=0):
+        self.folder_name = folder_name
+        self.num_files = num_files
+        self.num_dirs = num_dirs
+        self.total_size = total_size
+        self.directories = []
+        self._directory_index = {}
+        self._file_index = {}
+
+    def add_directory(self, root, dirs, file_names):
+        """
+        Appends a directory and its files to the model and returns its record.
+        """
+
+        directory = DirectoryRecord(root, list(dirs))
+        directory.files = [FileRecord(name, directory) for name in file_names]
+        return self.append_directory(directory)
+
+    def append_directory(self, directory):
+        """
+        Appends a directory record to the model and indexes its files.
+        """
+
+        self.directories.append(directory)
+        self._directory_index[directory.root] = directory
+        for record in directory.files:
+            self._file_index[os.path.join(directory.root, record.name)] = record
+        return directory
+
+    def get_directory(self, root):
+        """
+        Returns the record of the directory, or None.
+        """
+
+        return self._directory_index.get(root)
+
+    def get_file(self, path):
+        """
+        Returns the record of the file, or None.
+        """
+
+        return self._file_index.get(path)
+
+    def add_file(self, path):
+        """
+        Adds a file to the model, creating the records of its missing directories, and returns its record.
+
+        A new directory is placed after the subtree of its parent directory, like the walk order.
+        """
+
+        record = self._file_index.get(path)
+        if record is not None:
+            return record
+        directory = self._ensure_directory(os.path.dirname(path))
+        record = FileRecord(os.path.basename(path), directory)
+        directory.files.append(record)
+        self._file_index[path] = record
+        self.num_files += 1
+        return record
+
+    def _ensure_directory(self, root):
+        directory = self._directory_index.get(root)
+        if directory is not None:
+            return directory
+        parent_root = os.path.dirname(root)
+        if not self.directories or parent_root == root:
+            raise ValueError(f"{root} is outside of the repository")
+        parent = self._ensure_directory(parent_root)
+        parent.dirs.append(os.path.basename(root))
+        self.num_dirs += 1
+        position = self.directories.index(parent) + 1
+        subtree_prefix = parent.root + os.sep
+        while position < len(self.directories) and self.directories[position].root.startswith(subtree_prefix):
+            position += 1
+        directory = DirectoryRecord(root)
+        self.directories.insert(position, directory)
+        self._directory_index[root] = directory
+        return directory
+
+    def remove_file(self, path):
+        """
+        Removes a file from the model, and the directories left empty by it. Returns its record, or None.
+        """
+
+        record = self._file_index.pop(path, None)
+        if record is None:
+            return None
+        directory = record.directory
+        directory.files.remove(record)
+        self.num_files -= 1
+        while not directory.files and not directory.dirs and directory is not self.directories[0]:
+            self.directories.remove(directory)
+            del self._directory_index[directory.root]
+            parent = self._directory_index.get(os.path.dirname(directory.root))
+            if parent is None:
+                break
+            parent.dirs.remove(os.path.basename(directory.root))
+            self.num_dirs -= 1
+            directory = parent
+        return record
+
+    def iter_files(self):
+        """
+        Yields every file record in structure order.
+        """
+
+        for directory in self.directories:
+            yield from directory.files
+
+    def set_analysis(self, path, analysis, modified_time=None):
+        """
+        Stores the analysis result of the file.
+        """
+
+        record = self._file_index[path]
+        record.analysis = analysis
+        record.modified_time = modified_time
+
+    @classmethod
+    def from_stats(cls, stats):
+        """
+        Builds the model from a stats dict in the JSON layout.
+        """
+
+        repo = cls(stats['folder_name'], stats.get('num_files', 0), stats.get('num_dirs', 0), stats.get('total_size', 0))
+        for item in stats['structure']:
+            repo.append_directory(directory_from_item(item))
+        return repo
+
+    def to_stats(self):
+        """
+        Converts the model into a stats dict in the JSON layout.
+        """
+
+        structure = []
+        for directory in self.directories:
+            analyses = []
+            modified_times = []
+            if any(record.analysis is not None for record in directory.files):
+                analyses = [NOT_ANALYZED if record.analysis is None else record.analysis for record in directory.files]
+                modified_times = [record.modified_time for record in directory.files]
+            structure.append([directory.root, directory.dirs, [record.name for record in directory.files], analyses, modified_times])
+        return {
+            'folder_name': self.folder_name,
+            'num_files': self.num_files,
+            'num_dirs': self.num_dirs,
+            'total_size': self.total_size,
+            'structure': structure
+        }
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads the model from a stats JSON file.
+        """
+
+        with open(filename, 'r', encoding='utf-8') as file:
+            return cls.from_stats(json.load(file))
+
+    def save(self, filename):
+        """
+        Writes the model to a stats JSON file. The file is replaced atomically, so that
+        readers never see a partly written file.
+        """
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            json.dump(self.to_stats(), file, indent=4, ensure_ascii=False)
+        os.replace(temp_filename, filename)
+
+class StatsReader:
+    """
+    Reads a stats JSON file incrementally, one directory at a time, with flat memory use.
+
+    The header fields (folder_name, num_files, num_dirs, total_size) written before
+    'structure' are available in `header` after opening; fields written after it are
+    added once the directories have been read.
+    """
+
+    def __init__(self, filename, read_size=STREAM_READ_SIZE):
+        self._file = open(filename, 'r', encoding='utf-8')
+        self._read_size = read_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._in_structure = False
+        self.header = {}
+        self._expect('{')
+        self._read_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _fill(self):
+        chunk = self._file.read(self._read_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position].isspace():
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                raise ValueError("Unexpected end of stats file")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' in stats file")
+        self._position += 1
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A number cut at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            if not self._fill():
+                continue
+
+    def _read_header(self):
+        while self._peek() != '}':
+            key = self._decode()
+            self._expect(':')
+            if key == 'structure':
+                self._expect('[')
+                self._in_structure = True
+                return
+            self.header[key] = self._decode()
+            if self._peek() == ',':
+                self._position += 1
+
+    def directories(self):
+        """
+        Yields the DirectoryRecord of each directory in structure order.
+        """
+
+        if not self._in_structure:
+            return
+        while self._peek() != ']':
+            yield directory_from_item(self._decode())
+            if self._peek() == ',':
+                self._position += 1
+        self._position += 1
+        self._in_structure = False
+        if self._peek() == ',':
+            self._position += 1
+        self._read_header()
@@ -0,0 +1,288 @@
+import json
+import os
+import sqlite3
+import threading
+
+from repo_model import RepositoryModel, DirectoryRecord, FileRecord, StatsReader, NOT_ANALYZED
+
+STATS_STORE_FILENAME = 'stats_final.sqlite'
+STORE_SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS directories (
+    root TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    dirs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    file_type TEXT,
+    analysis TEXT,
+    modified_time TEXT
+);
+CREATE INDEX IF NOT EXISTS directories_position ON directories (position);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory, position);
+CREATE INDEX IF NOT EXISTS files_file_type ON files (file_type);
+"""
+
+HEADER_KEYS = ['folder_name', 'num_files', 'num_dirs', 'total_size']
+
+class RepositoryStore:
+    """
+    SQLite store of an analyzed repository, as an alternative to the stats JSON file.
+
+    Files are rows indexed by path and file type, so a single file can be updated
+    without rewriting the whole repository: during an analysis, add_files() creates
+    the rows of the files to analyze and update_file() commits each result as it
+    arrives (from any worker thread). sync() then writes the whole RepositoryModel in
+    one transaction, touching only the rows that still differ. The store also reads
+    like repo_model.StatsReader (header, directories()) for streaming consumers.
+    """
+
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.filename = filename
+        # update_file is called from the worker threads of an analysis: the connection is shared under a lock
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.executescript(SCHEMA)
+        version = self._meta('schema_version')
+        if version is not None and version != STORE_SCHEMA_VERSION:
+            raise ValueError(f"Unsupported store schema version: {version}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @property
+    def header(self):
+        """
+        The repository totals: folder_name, num_files, num_dirs, total_size.
+        """
+
+        return {key: self._meta(key) for key in HEADER_KEYS}
+
+    def directories(self):
+        """
+        Yields the DirectoryRecord of each directory in structure order, reading one directory at a time.
+        """
+
+        cursor = self.connection.cursor()
+        for root, dirs in cursor.execute('SELECT root, dirs FROM directories ORDER BY position'):
+            directory = DirectoryRecord(root, json.loads(dirs))
+            rows = self.connection.execute(
+                'SELECT name, analysis, modified_time FROM files WHERE directory = ? ORDER BY position', (root,))
+            directory.files = [FileRecord(name, directory, json.loads(analysis) if analysis is not None else None, modified_time)
+                               for name, analysis, modified_time in rows]
+            yield directory
+
+    def load_model(self):
+        """
+        Reads the whole repository into a RepositoryModel.
+        """
+
+        header = self.header
+        repo = RepositoryModel(header['folder_name'], header['num_files'] or 0, header['num_dirs'] or 0, header['total_size'] or 0)
+        for directory in self.directories():
+            repo.append_directory(directory)
+        return repo
+
+    def _write_header(self, repo):
+        connection = self.connection
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('schema_version', json.dumps(STORE_SCHEMA_VERSION)))
+        for key in HEADER_KEYS:
+            connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(getattr(repo, key), ensure_ascii=False)))
+
+    def add_files(self, repo):
+        """
+        Writes the header of the model and inserts its directories and files that are
+        not in the store yet, without an analysis, and leaves the stored rows as they
+        are (an interrupted analysis keeps the results of the previous one, and the
+        store it leaves has the totals of the repository).
+        """
+
+        with self._lock, self.connection:
+            connection = self.connection
+            self._write_header(repo)
+            for position, directory in enumerate(repo.directories):
+                connection.execute('INSERT INTO directories (root, position, dirs) VALUES (?, ?, ?) ON CONFLICT (root) DO NOTHING',
+                                   (directory.root, position, json.dumps(directory.dirs, ensure_ascii=False)))
+                connection.executemany(
+                    'INSERT INTO files (path, directory, position, name) VALUES (?, ?, ?, ?) ON CONFLICT (path) DO NOTHING',
+                    [(record.path, directory.root, index, record.name) for index, record in enumerate(directory.files)])
+
+    def update_file(self, path, analysis, modified_time=None):
+        """
+        Stores the analysis result of one file in its own transaction.
+
+        Raises:
+            KeyError: If the file is not in the store (see add_files).
+        """
+
+        with self._lock, self.connection:
+            updated = self.connection.execute(
+                'UPDATE files SET analysis = ?, file_type = ?, modified_time = ? WHERE path = ?',
+                (self._dump(analysis), self._file_type(analysis), modified_time, path)).rowcount
+        if not updated:
+            raise KeyError(path)
+
+    def query_files(self, file_type=None, path_prefix=None):
+        """
+        Yields (path, analysis) of the files matching the file type and/or path prefix.
+        """
+
+        conditions = []
+        params = []
+        if file_type is not None:
+            conditions.append('file_type = ?')
+            params.append(file_type)
+        if path_prefix is not None:
+            conditions.append("substr(path, 1, ?) = ?")
+            params += [len(path_prefix), path_prefix]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        for path, analysis in self.connection.execute(f'SELECT path, analysis FROM files {where} ORDER BY path', params):
+            yield path, json.loads(analysis) if analysis is not None else None
+
+    @staticmethod
+    def _dump(analysis):
+        return json.dumps(analysis, ensure_ascii=False) if analysis is not None else None
+
+    @staticmethod
+    def _file_type(analysis):
+        return analysis.get('file_type') if isinstance(analysis, dict) else None
+
+    def sync(self, repo):
+        """
+        Writes the model in one transaction: new and changed rows are written, rows of
+        files and directories no longer in the model are deleted, unchanged rows are left as they are.
+        """
+
+        with self._lock, self.connection:
+            connection = self.connection
+            self._write_header(repo)
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS seen_paths (path TEXT PRIMARY KEY)')
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS seen_roots (root TEXT PRIMARY KEY)')
+            connection.execute('DELETE FROM seen_paths')
+            connection.execute('DELETE FROM seen_roots')
+            for position, directory in enumerate(repo.directories):
+                connection.execute("""
+                    INSERT INTO directories (root, position, dirs) VALUES (?, ?, ?)
+                    ON CONFLICT (root) DO UPDATE SET position = excluded.position, dirs = excluded.dirs
+                    WHERE position IS NOT excluded.position OR dirs IS NOT excluded.dirs
+                """, (directory.root, position, json.dumps(directory.dirs, ensure_ascii=False)))
+                connection.execute('INSERT INTO seen_roots (root) VALUES (?)', (directory.root,))
+                rows = [(record.path, directory.root, index, record.name, self._file_type(record.analysis),
+                         self._dump(record.analysis), record.modified_time)
+                        for index, record in enumerate(directory.files)]
+                connection.executemany("""
+                    INSERT INTO files (path, directory, position, name, file_type, analysis, modified_time) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (path) DO UPDATE SET position = excluded.position, file_type = excluded.file_type,
+                        analysis = excluded.analysis, modified_time = excluded.modified_time
+                    WHERE position IS NOT excluded.position OR analysis IS NOT excluded.analysis
+                        OR modified_time IS NOT excluded.modified_time
+                """, rows)
+                connection.executemany('INSERT INTO seen_paths (path) VALUES (?)', [(row[0],) for row in rows])
+            connection.execute('DELETE FROM files WHERE path NOT IN (SELECT path FROM seen_paths)')
+            connection.execute('DELETE FROM directories WHERE root NOT IN (SELECT root FROM seen_roots)')
+
+    def export_json(self, filename):
+        """
+        Writes the store in the stats JSON layout, one directory at a time.
+        """
+
+        header = self.header
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write('{\n')
+            for key in HEADER_KEYS:
+                file.write(f'    {json.dumps(key)}: {json.dumps(header[key], ensure_ascii=False)},\n')
+            file.write('    "structure": [')
+            for position, directory in enumerate(self.directories()):
+                analyses = []
+                modified_times = []
+                if any(record.analysis is not None for record in directory.files):
+                    analyses = [NOT_ANALYZED if record.analysis is None else record.analysis for record in directory.files]
+                    modified_times = [record.modified_time for record in directory.files]
+                item = [directory.root, directory.dirs, [record.name for record in directory.files], analyses, modified_times]
+                file.write((',' if position else '') + '\n        ' + json.dumps(item, ensure_ascii=False))
+            file.write('\n    ]\n}')
+
+def is_store_file(filename):
+    """
+    Checks whether the stats file name designates a SQLite store rather than a JSON file.
+    """
+
+    return filename.endswith('.sqlite')
+
+def latest_stats_filename(*filenames):
+    """
+    Returns the most recently written of the existing stats files, or the first one if none exists.
+    """
+
+    existing = [filename for filename in filenames if os.path.exists(filename)]
+    if not existing:
+        return filenames[0]
+    return max(existing, key=os.path.getmtime)
+
+def load_stats(filename):
+    """
+    Reads a RepositoryModel from a stats JSON file or a store.
+    """
+
+    if is_store_file(filename):
+        with RepositoryStore(filename) as store:
+            return store.load_model()
+    return RepositoryModel.load(filename)
+
+def save_stats(repo, filename):
+    """
+    Writes a RepositoryModel to a stats JSON file, or syncs it into a store.
+    """
+
+    if is_store_file(filename):
+        with RepositoryStore(filename) as store:
+            store.sync(repo)
+    else:
+        repo.save(filename)
+
+def open_stats(filename):
+    """
+    Opens a stats JSON file or a store for streaming reads (header, directories()).
+    """
+
+    return RepositoryStore(filename) if is_store_file(filename) else StatsReader(filename)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Query or export the SQLite store of an analyzed repository.')
+    parser.add_argument('store', help='Path of the store (.repodoc/stats_final.sqlite)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='Export the store in the stats_final.json layout')
+    export_parser.add_argument('output', help='Output JSON file path')
+    query_parser = subparsers.add_parser('query', help='List the files matching a file type and/or path prefix')
+    query_parser.add_argument('--type', dest='file_type', default=None, help='File type (file_type of the analysis)')
+    query_parser.add_argument('--path', dest='path_prefix', default=None, help='Path prefix')
+    args = parser.parse_args()
+
+    with RepositoryStore(args.store) as store:
+        if args.command == 'export':
+            store.export_json(args.output)
+            print(f"Stats have been exported to {args.output}")
+        else:
+            for path, analysis in store.query_files(args.file_type, args.path_prefix):
+                description = analysis.get('description', '').splitlines()[0] if isinstance(analysis, dict) and analysis.get('description') else analysis
+                print(f"{path}\t{description}")
@@ -0,0 +1,84 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ignore_rules import GITIGNORE_FILENAME
+
+def scan_directory(path, rel_dir, engine):
+    """
+    Lists the non-ignored entries of one directory with os.scandir.
+
+    Returns:
+        tuple: Subdirectory names, subdirectory names to descend into (not symlinks),
+        and (file name, size) pairs. Sizes come from the scandir entries.
+    """
+
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return [], [], []
+
+    matcher = engine.matcher_for(rel_dir, has_gitignore=any(entry.name == GITIGNORE_FILENAME for entry in entries))
+    prefix = rel_dir + '/' if rel_dir else ''
+    dirs, walk_dirs, files = [], [], []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if matcher.is_ignored(prefix + entry.name, is_dir):
+            continue
+        if is_dir:
+            dirs.append(entry.name)
+            if not entry.is_symlink():
+                walk_dirs.append(entry.name)
+        else:
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = 0
+            files.append((entry.name, size))
+    return dirs, walk_dirs, files
+
+def walk_repository(folder_path, engine, workers=1):
+    """
+    Walks the repository top-down like os.walk, skipping ignored entries.
+
+    With workers > 1, directories are listed by a thread pool (useful on network
+    filesystems); the output order is the same as the sequential walk.
+
+    Yields:
+        tuple: (root, dirs, files) where files is a list of (file name, size) pairs.
+    """
+
+    if workers <= 1:
+        stack = [(folder_path, '')]
+        while stack:
+            path, rel_dir = stack.pop()
+            dirs, walk_dirs, files = scan_directory(path, rel_dir, engine)
+            yield path, dirs, files
+            prefix = rel_dir + '/' if rel_dir else ''
+            for name in reversed(walk_dirs):
+                stack.append((os.path.join(path, name), prefix + name))
+        return
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, folder_path, '', engine): (folder_path, '')}
+        while pending:
+            future = next(iter(pending))
+            path, rel_dir = pending.pop(future)
+            dirs, walk_dirs, files = future.result()
+            results[path] = (dirs, walk_dirs, files)
+            prefix = rel_dir + '/' if rel_dir else ''
+            for name in walk_dirs:
+                child = os.path.join(path, name)
+                pending[executor.submit(scan_directory, child, prefix + name, engine)] = (child, prefix + name)
+
+    stack = [folder_path]
+    while stack:
+        path = stack.pop()
+        dirs, walk_dirs, files = results[path]
+        yield path, dirs, files
+        for name in reversed(walk_dirs):
+            stack.append(os.path.join(path, name))
@@ -0,0 +1,327 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from git_changes import FileChanges
+from repo_walker import walk_repository
+from ignore_rules import GITIGNORE_FILENAME
+
+WATCH_BACKENDS = ['auto', 'inotify', 'poll']
+DEFAULT_WATCH_DEBOUNCE = 2.0
+DEFAULT_POLL_INTERVAL = 5.0
+# Longest time changes keep being collected while events go on arriving (a long checkout, a build)
+MAX_DEBOUNCE_DELAY = 60.0
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+def _join(rel_dir, name):
+    return f"{rel_dir}/{name}" if rel_dir else name
+
+class InotifyWatcher:
+    """
+    Watches the non-ignored directories of a repository with Linux inotify (through ctypes, no dependency).
+
+    One watch is added per directory, including the directories created later. When the
+    kernel event queue overflows or a .gitignore file changes, `rescan` is set: the
+    changed paths are then unknown.
+
+    Raises:
+        OSError: If inotify is not available, or the watch limit (fs.inotify.max_user_watches) is reached.
+    """
+
+    def __init__(self, folder_path, engine):
+        self.folder_path = folder_path
+        self.engine = engine
+        self.rescan = False
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, f"inotify_init1: {os.strerror(code)}")
+        self._watches = {}
+        try:
+            self._watch_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def _watch_tree(self, rel_dir):
+        """
+        Adds watches to the directory and its non-ignored subdirectories (symlinks are not followed).
+        """
+
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            path = os.path.join(self.folder_path, *rel_dir.split('/')) if rel_dir else self.folder_path
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                code = ctypes.get_errno()
+                if code in (2, 20):
+                    # ENOENT, ENOTDIR: removed or replaced before the watch could be added
+                    continue
+                raise OSError(code, f"inotify_add_watch {path}: {os.strerror(code)}")
+            self._watches[wd] = rel_dir
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        child = _join(rel_dir, entry.name)
+                        if entry.is_dir(follow_symlinks=False) and not self.engine.is_ignored(child, True):
+                            stack.append(child)
+            except OSError:
+                continue
+
+    def _unwatch_tree(self, rel_dir):
+        prefix = rel_dir + '/'
+        for wd, watched in list(self._watches.items()):
+            if watched == rel_dir or watched.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def read_changes(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (None: no limit) for events.
+
+        Returns:
+            set[str]: Paths relative to the repository ('/' separated) of the files and
+            directories created, written, moved or deleted.
+        """
+
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        changes = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.rescan = True
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                # The directory was removed (or moved away): the kernel dropped its watch
+                del self._watches[wd]
+                continue
+            if not name:
+                # Event on the watched directory itself; its parent reports it as well
+                continue
+            rel_path = _join(rel_dir, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if name == GITIGNORE_FILENAME and not is_dir:
+                self.rescan = True
+                continue
+            if self.engine.is_ignored(rel_path, is_dir):
+                continue
+            if is_dir and mask & IN_MOVED_FROM:
+                # Watches follow the moved directory: drop them, the destination is watched again if in the repository
+                self._unwatch_tree(rel_path)
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files created before the watch is added are found by looking at the directory itself
+                self._watch_tree(rel_path)
+            changes.add(rel_path)
+        return changes
+
+    def reset(self, engine):
+        """
+        Uses new ignore rules, watching the directories they no longer ignore.
+        """
+
+        self.engine = engine
+        self.rescan = False
+        self._watch_tree('')
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+class PollingWatcher:
+    """
+    Watches a repository by walking it every `interval` seconds and comparing the
+    modified times and sizes of the non-ignored files and of the .gitignore files
+    (`rescan` is set when one changes). Works on any platform and filesystem, at the
+    cost of one stat per file and scan.
+    """
+
+    def __init__(self, folder_path, engine, interval=DEFAULT_POLL_INTERVAL):
+        self.folder_path = folder_path
+        self.engine = engine
+        self.interval = interval
+        self.rescan = False
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        snapshot = {}
+        for root, _, files in walk_repository(self.folder_path, self.engine):
+            rel_dir = os.path.relpath(root, self.folder_path).replace(os.sep, '/')
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            for name, size in files + [(GITIGNORE_FILENAME, None)]:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                snapshot[_join(rel_dir, name)] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def read_changes(self, timeout=None):
+        """
+        Waits for the next scan (`timeout` is not used: scans are `interval` seconds apart).
+
+        Returns:
+            set[str]: Paths relative to the repository ('/' separated) of the files added, changed or removed.
+        """
+
+        delay = self._next_scan - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        snapshot = self._scan()
+        self._next_scan = time.monotonic() + self.interval
+        changes = {path for path in snapshot.keys() | self._snapshot.keys() if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        if any(path.rpartition('/')[2] == GITIGNORE_FILENAME for path in changes):
+            self.rescan = True
+            changes = {path for path in changes if path.rpartition('/')[2] != GITIGNORE_FILENAME}
+        return changes
+
+    def reset(self, engine):
+        self.engine = engine
+        self.rescan = False
+        self._snapshot = self._scan()
+
+    def close(self):
+        pass
+
+def open_watcher(folder_path, engine, backend='auto', poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Opens an InotifyWatcher, or a PollingWatcher with backend 'poll', outside of Linux or
+    if inotify cannot watch the repository (backend 'auto').
+    """
+
+    if backend in ('auto', 'inotify') and sys.platform.startswith('linux'):
+        try:
+            watcher = InotifyWatcher(folder_path, engine)
+            print(f"Watching {len(watcher._watches)} directories with inotify")
+            return watcher
+        except (OSError, AttributeError) as e:
+            if backend == 'inotify':
+                raise
+            print(f"inotify is not available ({e}): falling back to polling every {poll_interval} seconds")
+    elif backend == 'inotify':
+        raise OSError(f"inotify is not available on {sys.platform}")
+    watcher = PollingWatcher(folder_path, engine, poll_interval)
+    print(f"Watching {len(watcher._snapshot)} files by polling every {poll_interval} seconds")
+    return watcher
+
+def wait_for_changes(watcher, debounce=DEFAULT_WATCH_DEBOUNCE, max_delay=MAX_DEBOUNCE_DELAY):
+    """
+    Blocks until files change, then keeps collecting changes until none arrived for
+    `debounce` seconds (or for at most `max_delay` seconds), so that a burst such as a
+    branch switch is handled at once.
+
+    Returns:
+        tuple: (set of changed paths relative to the repository, True if the whole repository must be rescanned)
+    """
+
+    changes = set()
+    while not changes and not watcher.rescan:
+        # A finite timeout keeps Ctrl-C responsive while waiting
+        changes = watcher.read_changes(1.0)
+    deadline = time.monotonic() + max_delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        rescan = watcher.rescan
+        more = watcher.read_changes(min(debounce, remaining))
+        if not more and watcher.rescan == rescan:
+            break
+        changes |= more
+    rescan, watcher.rescan = watcher.rescan, False
+    return changes, rescan
+
+def changes_from_paths(repo, folder_path, rel_paths, engine, sizes):
+    """
+    Turns the changed paths reported by a watcher into FileChanges against the model.
+
+    Existing files are added or modified, existing directories are looked at as a whole
+    (their files added or modified, the files of the model under them no longer on disk
+    deleted), and other paths deleted with the files of the model under them.
+    `sizes` maps the relative paths of the files of the model to their last known size.
+    """
+
+    root = repo.directories[0].root if repo.directories else folder_path
+    known = {os.path.relpath(record.path, root).replace(os.sep, '/') for record in repo.iter_files()}
+
+    def known_under(rel_dir):
+        if not rel_dir:
+            return set(known)
+        prefix = rel_dir + '/'
+        return {path for path in known if path == rel_dir or path.startswith(prefix)}
+
+    changes = FileChanges()
+    present = set()
+    removed = set()
+    for rel_path in sorted(rel_paths):
+        path = os.path.join(folder_path, *rel_path.split('/')) if rel_path else folder_path
+        if os.path.isdir(path):
+            found = set()
+            for dir_path, dirs, files in os.walk(path):
+                rel_dir = os.path.relpath(dir_path, folder_path).replace(os.sep, '/')
+                rel_dir = '' if rel_dir == '.' else rel_dir
+                dirs[:] = [name for name in dirs
+                           if not os.path.islink(os.path.join(dir_path, name)) and not engine.is_ignored(_join(rel_dir, name), True)]
+                found.update(_join(rel_dir, name) for name in files if not engine.is_ignored(_join(rel_dir, name)))
+            present |= found
+            removed |= known_under(rel_path) - found
+        elif os.path.isfile(path):
+            if not engine.is_ignored(rel_path):
+                present.add(rel_path)
+            else:
+                removed |= known_under(rel_path)
+        else:
+            removed |= known_under(rel_path)
+
+    for rel_path in sorted(present):
+        (changes.modified if rel_path in known else changes.added).append(rel_path)
+    changes.deleted = sorted(removed - present)
+    changes.old_sizes = {path: sizes[path] for path in changes.modified + changes.deleted if path in sizes}
+    return changes
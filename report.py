@@ -1,67 +1,108 @@
-import json
 import markdown2
-import sys
 import os
 import argparse
 import html
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+from repo_model import STATUS_LABELS
+from repo_store import STATS_STORE_FILENAME, open_stats, latest_stats_filename
+from fragment_cache import FragmentCache, FRAGMENT_CACHE_FILENAME, fragment_key
+from metrics import METRICS_FOLDER, start_run, phase, count
 
 STATS_FINAL_FILENAME = 'stats_final.json'
 REPODOC_FOLDER = '.repodoc'
+REPORT_FILENAME = 'repodoc-report.html'
+SHARDED_REPORT_FOLDER = 'repodoc-report'
+SHARDED_PAGES_FOLDER = 'pages'
+SEARCH_INDEX_FILENAME = 'search-index.js'
+SEARCH_DESCRIPTION_LENGTH = 160
+ROOT_PAGE_NAME = '(root)'
+RENDER_BATCH_SIZE = 256
 
-# 引数パーサーを設定
-parser = argparse.ArgumentParser(description='Generate a repository analysis report.')
-parser.add_argument('analysis_path_file', nargs='?', help='File containing the analysis path')
-parser.add_argument('-o', '--output', help='Output file path for the report', default=None)
-args = parser.parse_args()
-
-# 指定されたファイルから解析パスを読み取るか、ユーザーに入力を促す
-if args.analysis_path_file:
-    with open(os.path.abspath(args.analysis_path_file), 'r', encoding='utf-8') as f:
-        analysis_path = f.read().strip()
-else:
-    analysis_path = input("Enter the analysis path: ").strip()
-    analysis_path = os.path.abspath(analysis_path)
-
-stats_final_filename = os.path.join(analysis_path, REPODOC_FOLDER, STATS_FINAL_FILENAME)
+# Bump when the HTML of the rows or tables changes so that cached fragments are not reused
+REPORT_RENDER_VERSION = 2
 
-# stats_final.jsonファイルを読み込む
-with open(stats_final_filename, 'r', encoding='utf-8') as f:
-    data = json.load(f)
+STYLE = """
+        body { font-family: Arial, sans-serif; }
+        h1, h2, h3 { color: #333; }
+        table { width: 100%; border-collapse: collapse; margin-bottom: 20px; }
+        th, td { border: 1px solid #ccc; padding: 8px; text-align: left; }
+        th { background-color: #f4f4f4; }
+        .not-analyzed { color: #999; }
+        .directory { background-color: #a4a4ff; }
+        .file-name { width: 15%; font-size: 1.2em; }
+        .file-type { width: 15%; }
+        .description { width: 50%; font-size:0.9em;}
+        .references { width: 10%; }
+        .entry-points { width: 10%; }
+        #search { width: 50%; padding: 6px; font-size: 1em; }
+        #search-results li { margin: 4px 0; }
+        .search-description { color: #666; font-size: 0.9em; }
+"""
 
-# HTMLコンテンツを生成
-html_content = f"""
+def render_page_head(title):
+    """Render the beginning of an HTML page up to the opening body tag."""
+    return f"""
 <!DOCTYPE html>
 <html lang="ja">
 <head>
     <meta charset="UTF-8">
-    <title>リポジトリ解析レポート</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; }}
-        h1, h2, h3 {{ color: #333; }}
-        table {{ width: 100%; border-collapse: collapse; margin-bottom: 20px; }}
-        th, td {{ border: 1px solid #ccc; padding: 8px; text-align: left; }}
-        th {{ background-color: #f4f4f4; }}
-        .not-analyzed {{ color: #999; }}
-        .directory {{ background-color: #a4a4ff; }}
-        .file-name {{ width: 15%; font-size: 1.2em; }}
-        .file-type {{ width: 15%; }}
-        .description {{ width: 50%; font-size:0.9em;}}
-        .references {{ width: 10%; }}
-        .entry-points {{ width: 10%; }}
-    </style>
+    <title>{html.escape(title)}</title>
+    <style>{STYLE}    </style>
 </head>
 <body>
+"""
+
+def render_page_tail():
+    """Render the end of an HTML page."""
+    return """
+</body>
+</html>
+"""
+
+def render_summary(header):
+    """Render the title and the repository totals."""
+    return f"""
     <h1>リポジトリ解析レポート</h1>
-    <h2>フォルダ: {html.escape(data['folder_name'])}</h2>
-    <p>ファイル数: {data['num_files']}</p>
-    <p>ディレクトリ数: {data['num_dirs']}</p>
-    <p>合計サイズ: {data['total_size']} bytes</p>
+    <h2>フォルダ: {html.escape(header.get('folder_name') or '')}</h2>
+    <p>ファイル数: {header.get('num_files') or 0}</p>
+    <p>ディレクトリ数: {header.get('num_dirs') or 0}</p>
+    <p>合計サイズ: {header.get('total_size') or 0} bytes</p>
 """
 
-for folder in data['structure']:
-    if folder[2]:  # ファイルが存在するフォルダのみ表示
-        escaped_folder_name = html.escape(folder[0])
-        html_content += f"""
+def render_row(name, analysis, row_id=None):
+    """Render the table row of one file."""
+    escaped_file = html.escape(name)
+    row_id_attribute = f' id="{html.escape(row_id)}"' if row_id else ''
+    if isinstance(analysis, dict):
+        escaped_desc = html.escape(analysis['description'])
+        description_html = markdown2.markdown(escaped_desc)
+        escaped_file_type = html.escape(analysis['file_type'])
+        references_str = ', '.join(html.escape(r) for r in analysis['references'])
+        entry_points_str = ', '.join(html.escape(e) for e in analysis['entry_points'])
+        return f"""
+                <tr{row_id_attribute}>
+                    <td class="file-name">{escaped_file}</td>
+                    <td class="file-type">{escaped_file_type}</td>
+                    <td class="description">{description_html}</td>
+                    <td class="references">{references_str}</td>
+                    <td class="entry-points">{entry_points_str}</td>
+                </tr>
+                """
+    status_label = html.escape(STATUS_LABELS.get(analysis, '解析されていません'))
+    return f"""
+                <tr{row_id_attribute}>
+                    <td class="file-name">{escaped_file}</td>
+                    <td colspan="4" class="not-analyzed">{status_label}</td>
+                </tr>
+                """
+
+def render_section(root, rows_html):
+    """Render the table of one directory from its rendered rows."""
+    escaped_folder_name = html.escape(root)
+    return f"""
         <h2 class="directory">ディレクトリ: {escaped_folder_name}</h2>
         <table>
             <thead>
@@ -74,47 +115,267 @@ for folder in data['structure']:
                 </tr>
             </thead>
             <tbody>
-        """
-        for file, analysis in zip(folder[2], folder[3]):
-            escaped_file = html.escape(file)
-            if isinstance(analysis, dict):
-                escaped_desc = html.escape(analysis['description'])
-                description_html = markdown2.markdown(escaped_desc)
-                escaped_file_type = html.escape(analysis['file_type'])
-                references_str = ', '.join(html.escape(r) for r in analysis['references'])
-                entry_points_str = ', '.join(html.escape(e) for e in analysis['entry_points'])
-                html_content += f"""
-                <tr>
-                    <td class="file-name">{escaped_file}</td>
-                    <td class="file-type">{escaped_file_type}</td>
-                    <td class="description">{description_html}</td>
-                    <td class="references">{references_str}</td>
-                    <td class="entry-points">{entry_points_str}</td>
-                </tr>
-                """
-            else:
-                html_content += f"""
-                <tr>
-                    <td class="file-name">{escaped_file}</td>
-                    <td colspan="4" class="not-analyzed">解析されていません</td>
-                </tr>
-                """
-        html_content += """
+        """ + ''.join(rows_html) + """
             </tbody>
         </table>
         """
 
-html_content += """
-</body>
-</html>
+def _render_row_args(args):
+    return render_row(*args)
+
+def render_directories(directories, with_anchors=False, cache=None, workers=1, batch_size=RENDER_BATCH_SIZE):
+    """
+    Render the table of each directory (empty if it has no files), in order.
+
+    With a FragmentCache, each row is cached by a hash of its file name and analysis,
+    and each table by the hashes of its rows, so only what changed is rendered again.
+    Rows to render are processed by a pool of `workers` processes, a batch of
+    directories at a time. With `with_anchors`, each row gets the path relative to
+    the first directory as id, for links from the search page.
+
+    Yields:
+        tuple: DirectoryRecord, rendered HTML.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    top_root = None
+    try:
+        batch = []
+        for directory in directories:
+            if top_root is None:
+                top_root = directory.root
+            batch.append(directory)
+            if len(batch) >= batch_size:
+                yield from _render_batch(batch, top_root if with_anchors else None, cache, executor)
+                batch = []
+        if batch:
+            yield from _render_batch(batch, top_root if with_anchors else None, cache, executor)
+    finally:
+        if executor:
+            executor.shutdown()
+
+def _render_batch(directories, top_root, cache, executor):
+    sections = []
+    pending = []
+    for directory in directories:
+        if not directory.files:  # ファイルが存在するフォルダのみ表示
+            sections.append(None)
+            continue
+        rows = []
+        for record in directory.files:
+            row_id = os.path.relpath(record.path, top_root).replace(os.sep, '/') if top_root else None
+            rows.append((record.name, record.analysis, row_id))
+        row_keys = [fragment_key(REPORT_RENDER_VERSION, *row) for row in rows]
+        section_key = fragment_key(REPORT_RENDER_VERSION, directory.root, row_keys)
+        section_html = cache.get(section_key) if cache else None
+        rows_html = [None] * len(rows)
+        if section_html is not None:
+            # Keep the rows of a reused table for when one of them changes
+            cache.touch(row_keys)
+        else:
+            for index, (row, row_key) in enumerate(zip(rows, row_keys)):
+                rows_html[index] = cache.get(row_key) if cache else None
+                if rows_html[index] is None:
+                    pending.append((rows_html, index, row, row_key))
+        sections.append((directory.root, section_key, section_html, rows_html))
+
+    if executor:
+        rendered = executor.map(_render_row_args, [row for _, _, row, _ in pending], chunksize=32)
+    else:
+        rendered = (render_row(*row) for _, _, row, _ in pending)
+    for (rows_html, index, _, row_key), row_html in zip(pending, rendered):
+        rows_html[index] = row_html
+        if cache:
+            cache.put(row_key, row_html)
+
+    for directory, section in zip(directories, sections):
+        if section is None:
+            yield directory, ''
+            continue
+        root, section_key, section_html, rows_html = section
+        if section_html is None:
+            section_html = render_section(root, rows_html)
+            if cache:
+                cache.put(section_key, section_html)
+        yield directory, section_html
+    if cache:
+        cache.commit()
+
+def write_report(stats_filename, output_filename, cache=None, workers=1):
+    """
+    Write the report as a single HTML file.
+    Directories are read from the stats file and written to the output one at a time.
+    """
+    with open_stats(stats_filename) as reader, open(output_filename, 'w', encoding='utf-8') as f:
+        f.write(render_page_head('リポジトリ解析レポート'))
+        f.write(render_summary(reader.header))
+        for _, section_html in render_directories(reader.directories(), cache=cache, workers=workers):
+            f.write(section_html)
+        f.write(render_page_tail())
+
+def page_filename(top_level_name):
+    """File name of the page of a top-level directory."""
+    slug = re.sub(r'[^\w.-]', '_', top_level_name)
+    return f"{slug}.html"
+
+def render_search_script():
+    """Render the client-side search over the search index loaded by the index page."""
+    return """
+    <script>
+    (function () {
+        var input = document.getElementById('search');
+        var list = document.getElementById('search-results');
+        input.addEventListener('input', function () {
+            var terms = input.value.toLowerCase().split(/\\s+/).filter(Boolean);
+            list.innerHTML = '';
+            if (!terms.length) { return; }
+            var shown = 0;
+            for (var i = 0; i < REPODOC_SEARCH_INDEX.length && shown < 100; i++) {
+                var entry = REPODOC_SEARCH_INDEX[i];
+                var text = (entry.p + ' ' + entry.t + ' ' + entry.d).toLowerCase();
+                if (!terms.every(function (term) { return text.indexOf(term) >= 0; })) { continue; }
+                var item = document.createElement('li');
+                var link = document.createElement('a');
+                link.href = entry.u;
+                link.textContent = entry.p;
+                var description = document.createElement('div');
+                description.className = 'search-description';
+                description.textContent = entry.t + ' ' + entry.d;
+                item.appendChild(link);
+                item.appendChild(description);
+                list.appendChild(item);
+                shown++;
+            }
+        });
+    })();
+    </script>
 """
 
-# 出力ファイルパスを決定
-if args.output:
-    output_html_filename = args.output
-else:
-    output_html_filename = os.path.join(analysis_path, 'repodoc-report.html')
+def write_sharded_report(stats_filename, output_dir, cache=None, workers=1):
+    """
+    Write the report as one HTML page per top-level directory, an index page and a search index.
+
+    Directories are streamed from the stats file; the directories of a top-level
+    directory are contiguous in the stats, so only one page is open at a time.
+    The search index (path, file type and the beginning of the description of each
+    file) is a JSON array written incrementally into a script file, so that the
+    search also works when the report is opened from the local disk.
+    """
+    pages_dir = os.path.join(output_dir, SHARDED_PAGES_FOLDER)
+    os.makedirs(pages_dir, exist_ok=True)
+
+    pages = []
+    used_filenames = set()
+    page = None
+    with open_stats(stats_filename) as reader, \
+            open(os.path.join(output_dir, SEARCH_INDEX_FILENAME), 'w', encoding='utf-8') as search_file:
+        header = reader.header
+        top_root = None
+        search_file.write('var REPODOC_SEARCH_INDEX = [\n')
+        first_entry = True
+        for directory, section_html in render_directories(reader.directories(), True, cache, workers):
+            if top_root is None:
+                top_root = directory.root
+            rel_root = os.path.relpath(directory.root, top_root).replace(os.sep, '/')
+            top_level_name = ROOT_PAGE_NAME if rel_root == '.' else rel_root.split('/')[0]
+            if page is None or page['name'] != top_level_name:
+                if page is not None:
+                    page['file'].write(render_page_tail())
+                    page['file'].close()
+                filename = page_filename(top_level_name)
+                if filename in used_filenames:
+                    filename = f"{os.path.splitext(filename)[0]}-{len(pages)}.html"
+                used_filenames.add(filename)
+                page = {'name': top_level_name, 'filename': filename, 'num_files': 0, 'num_dirs': 0,
+                        'file': open(os.path.join(pages_dir, filename), 'w', encoding='utf-8')}
+                pages.append(page)
+                page['file'].write(render_page_head(f"リポジトリ解析レポート - {top_level_name}"))
+                page['file'].write(f'\n    <p><a href="../index.html">目次に戻る</a></p>\n    <h1>{html.escape(top_level_name)}</h1>\n')
+
+            def anchor_for(record):
+                return os.path.relpath(record.path, top_root).replace(os.sep, '/')
+
+            page['file'].write(section_html)
+            page['num_dirs'] += 1
+            page['num_files'] += len(directory.files)
+
+            for record in directory.files:
+                analysis = record.analysis if isinstance(record.analysis, dict) else {}
+                entry = {
+                    'p': anchor_for(record),
+                    't': analysis.get('file_type', ''),
+                    'd': analysis.get('description', '')[:SEARCH_DESCRIPTION_LENGTH],
+                    'u': f"{SHARDED_PAGES_FOLDER}/{quote(page['filename'])}#{quote(anchor_for(record))}",
+                }
+                search_file.write(('' if first_entry else ',\n') + json.dumps(entry, ensure_ascii=False))
+                first_entry = False
+        if page is not None:
+            page['file'].write(render_page_tail())
+            page['file'].close()
+        search_file.write('\n];\n')
+
+    with open(os.path.join(output_dir, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(render_page_head('リポジトリ解析レポート'))
+        f.write(render_summary(header))
+        f.write('\n    <h2>検索</h2>\n    <input id="search" type="search" placeholder="ファイルパス・ファイルタイプ・説明で検索">\n    <ul id="search-results"></ul>\n')
+        f.write('\n    <h2>目次</h2>\n    <table>\n        <thead><tr><th>ディレクトリ</th><th>ファイル数</th><th>ディレクトリ数</th></tr></thead>\n        <tbody>\n')
+        for page in pages:
+            f.write(f'            <tr><td><a href="{SHARDED_PAGES_FOLDER}/{quote(page["filename"])}">{html.escape(page["name"])}</a></td>'
+                    f'<td>{page["num_files"]}</td><td>{page["num_dirs"]}</td></tr>\n')
+        f.write('        </tbody>\n    </table>\n')
+        f.write(f'\n    <script src="{SEARCH_INDEX_FILENAME}"></script>\n')
+        f.write(render_search_script())
+        f.write(render_page_tail())
+
+if __name__ == "__main__":
+    # 引数パーサーを設定
+    parser = argparse.ArgumentParser(description='Generate a repository analysis report.')
+    parser.add_argument('analysis_path_file', nargs='?', help='File containing the analysis path')
+    parser.add_argument('-o', '--output', help='Output file path for the report (output folder with --sharded)', default=None)
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes rendering the descriptions (useful for a first build)')
+    parser.add_argument('--no-cache', action='store_true', help='Render every file again without the rendered fragment cache')
+    parser.add_argument('--sharded', action='store_true', help='Write one page per top-level directory, an index page and a search index')
+    parser.add_argument('--metrics-dir', help='Output folder of the run record (JSON) and the Prometheus textfile (default: <analysis path>/.repodoc/metrics)', default=None)
+    parser.add_argument('--no-metrics', action='store_true', help='Do not write the run record and metrics')
+    parser.add_argument('--profile', default='', help='Phases to run under cProfile (comma separated, all: every phase), written to <metrics-dir>/profiles/')
+    args = parser.parse_args()
+
+    # 指定されたファイルから解析パスを読み取るか、ユーザーに入力を促す
+    if args.analysis_path_file:
+        with open(os.path.abspath(args.analysis_path_file), 'r', encoding='utf-8') as f:
+            analysis_path = f.read().strip()
+    else:
+        analysis_path = input("Enter the analysis path: ").strip()
+        analysis_path = os.path.abspath(analysis_path)
+
+    stats_final_filename = latest_stats_filename(os.path.join(analysis_path, REPODOC_FOLDER, STATS_FINAL_FILENAME),
+                                                 os.path.join(analysis_path, REPODOC_FOLDER, STATS_STORE_FILENAME))
+
+    # 実行記録: 描画の経過時間と断片キャッシュの利用状況を記録する
+    metrics_dir = None if args.no_metrics else args.metrics_dir or os.path.join(analysis_path, REPODOC_FOLDER, METRICS_FOLDER)
+    run_metrics = start_run('report', os.path.basename(analysis_path), [name.strip() for name in args.profile.split(',') if name.strip()],
+                            {'sharded': args.sharded, 'workers': args.workers})
+
+    # 前回のレポートで描画したHTML断片を再利用し、変更されたファイルのみ描画し直す
+    cache = None if args.no_cache else FragmentCache(os.path.join(analysis_path, REPODOC_FOLDER, FRAGMENT_CACHE_FILENAME))
+
+    # stats_final.json（または stats_final.sqlite）を1ディレクトリずつ読み込み、HTMLを順次書き出す
+    if args.sharded:
+        output_dir = args.output or os.path.join(analysis_path, SHARDED_REPORT_FOLDER)
+        with phase('report_render'):
+            write_sharded_report(stats_final_filename, output_dir, cache, args.workers)
+        print(f"Report has been written to {os.path.join(output_dir, 'index.html')}")
+    else:
+        output_html_filename = args.output or os.path.join(analysis_path, REPORT_FILENAME)
+        with phase('report_render'):
+            write_report(stats_final_filename, output_html_filename, cache, args.workers)
+        print(f"Report has been written to {output_html_filename}")
+
+    if cache:
+        print(f"Rendered fragment cache: {cache.hits} hits / {cache.misses} misses")
+        count('fragment_cache_hits', cache.hits)
+        count('fragment_cache_misses', cache.misses)
+        cache.prune()
+        cache.close()
 
-# HTMLファイルに書き出し
-with open(output_html_filename, "w", encoding="utf-8") as f:
-    f.write(html_content)
\ No newline at end of file
+    if metrics_dir:
+        print(f"Run metrics have been written to {run_metrics.write(metrics_dir)}")
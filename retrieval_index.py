@@ -0,0 +1,174 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+
+RETRIEVAL_INDEX_FILENAME = 'retrieval_index.json'
+RETRIEVAL_INDEX_VERSION = 1
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Terms of the path and the file type weigh more than the words of a long description
+FIELD_WEIGHTS = {
+    'path': 3,
+    'file_type': 2,
+    'entry_points': 2,
+    'references': 1,
+    'description': 1,
+}
+
+WORD_PATTERN = re.compile(r'[A-Za-z0-9_]+|[぀-ヿ㐀-鿿ｦ-ﾟ]+')
+CAMEL_CASE_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+ASCII_PATTERN = re.compile(r'[A-Za-z0-9_]')
+
+def tokenize(text):
+    """
+    Splits a text into index terms.
+
+    ASCII words are lowercased and also split at camelCase and snake_case boundaries
+    ('BackServiceImpl' -> backserviceimpl, back, service, impl). Japanese text has no
+    spaces, so runs of kana and kanji are split into overlapping character bigrams.
+    """
+
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        if ASCII_PATTERN.match(word):
+            lowered = word.lower()
+            terms.append(lowered)
+            parts = [part.lower() for piece in word.split('_') for part in CAMEL_CASE_PATTERN.findall(piece)]
+            if len(parts) > 1:
+                terms.extend(part for part in parts if part != lowered)
+        elif len(word) == 1:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+def document_terms(path, analysis):
+    """
+    Returns the weighted term frequencies of one analyzed file.
+    """
+
+    fields = {'path': path}
+    if isinstance(analysis, dict):
+        fields['file_type'] = analysis.get('file_type', '')
+        fields['description'] = analysis.get('description', '')
+        fields['references'] = ' '.join(analysis.get('references', []))
+        fields['entry_points'] = ' '.join(analysis.get('entry_points', []))
+    frequencies = Counter()
+    for name, text in fields.items():
+        for term in tokenize(text):
+            frequencies[term] += FIELD_WEIGHTS[name]
+    return frequencies
+
+class RetrievalIndex:
+    """
+    BM25 index over the file descriptions of an analyzed repository.
+
+    Documents are the files of the repository (path, file_type, description,
+    references and entry_points). The index is plain JSON, built locally from
+    stats_final.json and rebuilt when the stats file changes.
+    """
+
+    def __init__(self, paths, lengths, postings, source=None):
+        self.paths = paths
+        self.lengths = lengths
+        self.postings = postings
+        self.source = source
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0
+
+    @classmethod
+    def build(cls, repo, source=None):
+        """
+        Builds the index from a RepositoryModel.
+        """
+
+        paths = []
+        lengths = []
+        postings = {}
+        for record in repo.iter_files():
+            frequencies = document_terms(record.path, record.analysis)
+            doc_id = len(paths)
+            paths.append(record.path)
+            lengths.append(sum(frequencies.values()))
+            for term, frequency in frequencies.items():
+                postings.setdefault(term, []).append([doc_id, frequency])
+        return cls(paths, lengths, postings, source)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads the index from a JSON file.
+        """
+
+        with open(filename, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('version') != RETRIEVAL_INDEX_VERSION:
+            raise ValueError(f"Unsupported retrieval index version: {data.get('version')}")
+        return cls(data['paths'], data['lengths'], data['postings'], data.get('source'))
+
+    def save(self, filename):
+        """
+        Saves the index to a JSON file.
+        """
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            json.dump({
+                'version': RETRIEVAL_INDEX_VERSION,
+                'source': self.source,
+                'paths': self.paths,
+                'lengths': self.lengths,
+                'postings': self.postings,
+            }, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_filename, filename)
+
+    def search(self, query, top_k=20):
+        """
+        Ranks the files by BM25 score for the query.
+
+        Returns:
+            list[tuple]: (file path, score) of the best `top_k` files with a positive score.
+        """
+
+        num_docs = len(self.paths)
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / self.average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        return [(self.paths[doc_id], score) for doc_id, score in ranked]
+
+def source_signature(stats_filename):
+    """
+    Identifies the version of the stats file the index is built from.
+    """
+
+    stat = os.stat(stats_filename)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+def load_or_build_index(repo, stats_filename, index_filename):
+    """
+    Loads the index of the stats file, or builds and saves it if missing or stale.
+    """
+
+    source = source_signature(stats_filename)
+    if os.path.exists(index_filename):
+        try:
+            index = RetrievalIndex.load(index_filename)
+            if index.source == source:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    index = RetrievalIndex.build(repo, source)
+    index.save(index_filename)
+    return index
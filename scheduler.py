@@ -0,0 +1,224 @@
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+@dataclass
+class ScheduledTask:
+    """
+    A unit of work for run_tasks.
+
+    Attributes:
+        fn (Callable): Function called without arguments to perform the work.
+        estimated_tokens (int): Estimated tokens consumed by the work, charged to the rate limiter.
+        label (str): Label used in progress output.
+        requests (int): Requests charged to the rate limiter (0 for work that charges its own sub-requests).
+        after (list[int]): Indexes of earlier tasks of the same run that must finish before this one starts.
+    """
+    fn: Callable[[], Any]
+    estimated_tokens: int = 0
+    label: str = ''
+    requests: int = 1
+    after: list[int] = field(default_factory=list)
+
+@dataclass
+class RunStats:
+    """
+    Throughput and latency statistics of a run_tasks call.
+
+    `task_timings` holds (queue wait, rate limit wait, latency) for each task, in the
+    order of the tasks: the queue wait runs from the submission of all the tasks to the
+    start of the task, rate limit wait and the wait for the tasks it runs after included.
+    """
+    num_tasks: int = 0
+    num_failed: int = 0
+    wall_time: float = 0.0
+    wait_time: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    task_timings: list[tuple] = field(default_factory=list)
+
+    def percentile(self, p):
+        """
+        Returns the p-th percentile (0-100) of the task latencies.
+        """
+
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+        return ordered[k]
+
+    def summary(self):
+        """
+        Formats the statistics into a readable string.
+        """
+
+        throughput = self.num_tasks / self.wall_time * 60 if self.wall_time > 0 else 0.0
+        mean = sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+        queue_waits = [timing[0] for timing in self.task_timings if timing]
+        return '\n'.join([
+            f"Requests: {self.num_tasks} (failed: {self.num_failed})",
+            f"Wall time (s): {self.wall_time:.2f}",
+            f"Throughput (requests/min): {throughput:.1f}",
+            f"Latency (s): mean {mean:.2f} / p50 {self.percentile(50):.2f} / p95 {self.percentile(95):.2f} / max {max(self.latencies, default=0.0):.2f}",
+            f"Rate limit wait (s): {self.wait_time:.2f}",
+            f"Queue wait (s): mean {sum(queue_waits) / len(queue_waits) if queue_waits else 0.0:.2f} / max {max(queue_waits, default=0.0):.2f}",
+        ])
+
+class RateLimiter:
+    """
+    Token-bucket limiter enforcing requests-per-minute and tokens-per-minute budgets.
+    A budget of None (or 0) means unlimited.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute or None
+        self.tokens_per_minute = tokens_per_minute or None
+        self._request_allowance = float(self.requests_per_minute or 0)
+        self._token_allowance = float(self.tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_allowance = min(self.requests_per_minute, self._request_allowance + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_allowance = min(self.tokens_per_minute, self._token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=0, requests=1):
+        """
+        Blocks until the requests with the given token estimate fit in the budgets.
+
+        Args:
+            tokens (int): Estimated tokens of the requests.
+            requests (int): Number of requests.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+
+        if not self.requests_per_minute and not self.tokens_per_minute:
+            return 0.0
+        if not requests and not tokens:
+            return 0.0
+        if self.requests_per_minute:
+            requests = min(requests, self.requests_per_minute)
+        if self.tokens_per_minute:
+            # A single request larger than the whole budget would never fit
+            tokens = min(tokens, self.tokens_per_minute)
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                delays = []
+                if self.requests_per_minute and self._request_allowance < requests:
+                    delays.append((requests - self._request_allowance) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self._token_allowance < tokens:
+                    delays.append((tokens - self._token_allowance) * 60 / self.tokens_per_minute)
+                if not delays:
+                    if self.requests_per_minute:
+                        self._request_allowance -= requests
+                    if self.tokens_per_minute:
+                        self._token_allowance -= tokens
+                    return waited
+                delay = max(delays)
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, tokens):
+        """
+        Corrects the token budget after the actual usage of a request is known.
+
+        Args:
+            tokens (int): Actual tokens minus the estimate passed to acquire (may be negative).
+        """
+
+        if not self.tokens_per_minute:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._token_allowance = min(self.tokens_per_minute, self._token_allowance - tokens)
+
+def run_tasks(tasks, concurrency=1, limiter=None, slots=None):
+    """
+    Runs the tasks with up to `concurrency` workers, respecting the rate limiter.
+
+    `slots` (a semaphore shared with nested run_tasks calls) is held while a task
+    runs, so that the tasks of all the calls sharing it stay within its count. Tasks
+    with requests=0, which run their own sub-requests, do not hold a slot: they would
+    otherwise wait for the slots of their own sub-requests.
+
+    A task waits for the tasks listed in its `after` before taking a slot. Workers pick
+    the tasks in order, so the tasks it waits for are already running or finished.
+
+    Exceptions raised by a task are returned in place of its result so that one
+    failure does not stop the others.
+
+    Args:
+        tasks (list[ScheduledTask]): Tasks to run.
+        concurrency (int): Maximum number of tasks running at once.
+        limiter (RateLimiter): Optional rate limiter shared by the tasks.
+        slots (threading.Semaphore): Optional bound on the tasks running at once across calls.
+
+    Returns:
+        tuple: Results in the same order as `tasks`, and RunStats.
+    """
+
+    stats = RunStats(num_tasks=len(tasks), task_timings=[None] * len(tasks))
+    stats_lock = threading.Lock()
+    finished = [threading.Event() for _ in tasks]
+    stopped = threading.Event()
+
+    def run_one(index, task):
+        try:
+            return run_task(index, task)
+        finally:
+            finished[index].set()
+
+    def run_task(index, task):
+        for earlier in task.after:
+            finished[earlier].wait()
+        if stopped.is_set():
+            return CancelledError()
+        slot = slots if slots is not None and task.requests else None
+        if slot:
+            slot.acquire()
+        waited = limiter.acquire(task.estimated_tokens, task.requests) if limiter else 0.0
+        started = time.monotonic()
+        try:
+            return task.fn()
+        except Exception as e:
+            with stats_lock:
+                stats.num_failed += 1
+            return e
+        finally:
+            if slot:
+                slot.release()
+            latency = time.monotonic() - started
+            with stats_lock:
+                stats.latencies.append(latency)
+                stats.wait_time += waited
+                stats.task_timings[index] = (started - submitted, waited, latency)
+
+    submitted = time.monotonic()
+    if concurrency <= 1:
+        results = [run_one(index, task) for index, task in enumerate(tasks)]
+    else:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = [executor.submit(run_one, index, task) for index, task in enumerate(tasks)]
+            results = [future.result() for future in futures]
+        except BaseException:
+            # e.g. Ctrl-C: do not start the queued tasks, nor the ones waiting for earlier tasks
+            stopped.set()
+            for event in finished:
+                event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+    stats.wall_time = time.monotonic() - submitted
+    return results, stats
@@ -0,0 +1,141 @@
+import glob
+import hashlib
+import json
+import os
+import re
+
+from repo_model import RepositoryModel
+
+SHARDS_FOLDER = 'shards'
+SHARD_FILENAME_PATTERN = re.compile(r'stats_shard_(\d+)of(\d+)\.json$')
+
+def parse_shard(text):
+    """
+    Parses a shard specification 'i/N' (1 <= i <= N) into (i, N).
+    """
+
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text)
+    if not match:
+        raise ValueError(f"Invalid shard '{text}': expected i/N, e.g. 1/4")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{text}': i must be between 1 and N")
+    return index, count
+
+def shard_of(rel_path, count):
+    """
+    Returns the shard (1 to count) of a file from its path relative to the repository.
+
+    The hash does not depend on the process, the machine or the checkout folder, so
+    every shard agrees on the split without communicating.
+    """
+
+    digest = hashlib.sha1(rel_path.replace(os.sep, '/').encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+def relative_path(repo, path):
+    return os.path.relpath(path, repo.directories[0].root).replace(os.sep, '/')
+
+def shard_paths(repo, index, count):
+    """
+    Returns the paths of the files of the repository that belong to the shard.
+    """
+
+    return [record.path for record in repo.iter_files() if shard_of(relative_path(repo, record.path), count) == index]
+
+def shard_filename(folder_path, repodoc_folder, name, index, count):
+    """
+    Returns the path of a per-shard file in the shards folder, e.g. stats_shard_1of4.json for name 'stats_shard.json'.
+    """
+
+    base, extension = os.path.splitext(name)
+    return os.path.join(folder_path, repodoc_folder, SHARDS_FOLDER, f"{base}_{index}of{count}{extension}")
+
+def write_partial(repo, filename, index, count, commit=None):
+    """
+    Writes the result of a shard: the whole structure, the analyses of the files of the
+    shard, and the shard header used by merge_partials.
+    """
+
+    stats = repo.to_stats()
+    stats['shard'] = {'index': index, 'count': count, 'commit': commit}
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', encoding='utf-8') as file:
+        json.dump(stats, file, indent=4, ensure_ascii=False)
+    os.replace(temp_filename, filename)
+
+def find_partials(shards_folder):
+    """
+    Returns the partial result files of the shards folder, by shard count.
+
+    Returns:
+        dict: {count: [filenames]}
+    """
+
+    partials = {}
+    for filename in sorted(glob.glob(os.path.join(shards_folder, 'stats_shard_*of*.json'))):
+        match = SHARD_FILENAME_PATTERN.search(filename)
+        if match:
+            partials.setdefault(int(match.group(2)), []).append(filename)
+    return partials
+
+def merge_partials(filenames, folder_path):
+    """
+    Merges the partial results of all the shards of a run into one model rooted at `folder_path`.
+
+    Each file takes the analysis of the shard it belongs to, whatever the other shards
+    stored for it, so the result does not depend on the order of the partials. The
+    shards may have run in different checkout folders; they must have seen the same
+    files. num_files and num_dirs are counted again from the merged structure, like
+    analyze_folder does.
+
+    Returns:
+        tuple: (RepositoryModel, commit shared by the shards or None)
+
+    Raises:
+        ValueError: If shards are missing or duplicated, or did not see the same files.
+    """
+
+    partials = {}
+    count = None
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf-8') as file:
+            stats = json.load(file)
+        shard = stats.get('shard')
+        if not shard:
+            raise ValueError(f"{filename} is not a shard result")
+        if count is not None and shard['count'] != count:
+            raise ValueError(f"{filename} belongs to a run with {shard['count']} shards, not {count}")
+        count = shard['count']
+        if shard['index'] in partials:
+            raise ValueError(f"Shard {shard['index']}/{count} is given twice")
+        partials[shard['index']] = (RepositoryModel.from_stats(stats), shard.get('commit'))
+    missing = [index for index in range(1, (count or 0) + 1) if index not in partials]
+    if not partials or missing:
+        raise ValueError(f"Missing shard results: {', '.join(f'{index}/{count}' for index in missing) or 'all'}")
+
+    first, _ = partials[1]
+    reference_paths = {relative_path(first, record.path) for record in first.iter_files()}
+    for index, (partial, _) in sorted(partials.items()):
+        paths = {relative_path(partial, record.path) for record in partial.iter_files()}
+        if paths != reference_paths or partial.total_size != first.total_size:
+            raise ValueError(f"Shard {index}/{count} did not see the same files as shard 1/{count} "
+                             f"({len(paths ^ reference_paths)} files differ): run all the shards on the same tree")
+
+    merged = RepositoryModel(os.path.basename(folder_path), total_size=first.total_size)
+    first_root = first.directories[0].root
+    for directory in first.directories:
+        rel_root = os.path.relpath(directory.root, first_root)
+        root = folder_path if rel_root == '.' else os.path.join(folder_path, rel_root)
+        merged.add_directory(root, directory.dirs, [record.name for record in directory.files])
+    for record in merged.iter_files():
+        rel_path = relative_path(merged, record.path)
+        partial, _ = partials[shard_of(rel_path, count)]
+        source = partial.get_file(os.path.join(partial.directories[0].root, *rel_path.split('/')))
+        record.analysis, record.modified_time = source.analysis, source.modified_time
+    merged.num_files = sum(len(directory.files) for directory in merged.directories)
+    merged.num_dirs = sum(len(directory.dirs) for directory in merged.directories)
+
+    commits = {commit for _, commit in partials.values()}
+    return merged, commits.pop() if len(commits) == 1 else None
@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repo_model import RepositoryModel
+from repo_store import RepositoryStore, latest_stats_filename, load_stats
+from report import render_summary
+
+def build_model(root):
+    repo = RepositoryModel('sample', num_files=3, num_dirs=2, total_size=1234)
+    repo.add_directory(root, ['src'], ['README.md'])
+    repo.add_directory(os.path.join(root, 'src'), [], ['main.py', 'util.py'])
+    return repo
+
+def test_interrupted_store_is_reloaded_with_its_header(tmp_path):
+    root = str(tmp_path / 'sample')
+    json_filename = str(tmp_path / 'stats_final.json')
+    store_filename = str(tmp_path / 'stats_final.sqlite')
+    repo = build_model(root)
+    repo.save(json_filename)
+    time.sleep(0.01)
+
+    # An analysis interrupted after its first result: add_files and update_file, but no sync
+    analysis = {'type': 'code', 'file_type': 'Python', 'description': 'main', 'references': [], 'entry_points': []}
+    with RepositoryStore(store_filename) as store:
+        store.add_files(repo)
+        store.update_file(os.path.join(root, 'src', 'main.py'), analysis, 'Mon Jan  1 00:00:00 2024')
+
+    filename = latest_stats_filename(json_filename, store_filename)
+    assert filename == store_filename
+    loaded = load_stats(filename)
+    assert (loaded.folder_name, loaded.num_files, loaded.num_dirs, loaded.total_size) == ('sample', 3, 2, 1234)
+    assert [record.path for record in loaded.iter_files()] == [record.path for record in repo.iter_files()]
+    assert loaded.get_file(os.path.join(root, 'src', 'main.py')).analysis == analysis
+    assert loaded.get_file(os.path.join(root, 'src', 'util.py')).analysis is None
+
+def test_render_summary_without_header_values():
+    html_text = render_summary({'folder_name': None, 'num_files': None, 'num_dirs': None, 'total_size': None})
+    assert 'フォルダ: </h2>' in html_text
+    assert 'ファイル数: 0' in html_text